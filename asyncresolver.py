@@ -0,0 +1,430 @@
+import asyncio
+import contextvars
+import itertools
+import dns.asyncquery
+from dnsresolver import *
+from dnssecresolver import *
+
+# Per-query state lives in context variables, every task awaiting resolve() gets its own copy
+_query_context = contextvars.ContextVar("query_context", default=None)
+_pending_nameservers = contextvars.ContextVar("pending_nameservers", default=frozenset())
+
+
+class AsyncDNSResolver(DNSResolver):
+    """
+    Non-blocking variant of DNSResolver. Runs the same iterative algorithm on top of
+    dns.asyncquery, so thousands of tasks can await resolve() concurrently on one event
+    loop while sharing the delegation, address and answer caches.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.inflight = AsyncSingleFlight()
+
+
+    def _query_context(self):
+        return _query_context.get()
+
+
+    def _begin_query(self, hostname, type):
+        context = self.logger.begin(hostname, type)
+        _query_context.set(context)
+        return context
+
+
+    async def _query_server(self, zone_name, query, servers):
+        """ Coroutine version of DNSResolver._query_server """
+        if self.race:
+            return await self._race_servers(zone_name, query, servers)
+
+        failed = set()
+        sent = 0
+        for _ in range(self.max_attempts):
+            for server in self._order_servers(servers):
+                if server in failed:
+                    continue
+                try:
+                    server_ip = await self._server_ip(server)
+                except ResolutionError:
+                    failed.add(server)
+                    continue
+
+                self._record_send(sent > 0)
+                sent += 1
+                start_time = time.monotonic()
+                try:
+                    sent_query = self._query_for(query, server_ip)
+                    response = await self._udp_exchange(sent_query, server_ip)
+                    response = await self._complete_exchange(sent_query, server_ip, response)
+                except (dns.exception.DNSException, OSError, EOFError):
+                    self._record_timeout(server_ip)
+                    continue
+
+                if self._accept_response(server, server_ip, response, time.monotonic() - start_time, failed):
+                    return response, server_ip
+
+        raise ResolutionError(zone_name, servers)
+
+
+    async def _race_servers(self, zone_name, query, servers):
+        """ Coroutine version of DNSResolver._race_servers, every query in flight is a task """
+        ranked = self._order_servers(servers)
+        candidates = list(ranked)
+        attempts = defaultdict(int)
+        failed = set()
+        pending = set()
+        runners = {}
+        index = 0
+
+        try:
+            while index < len(candidates) or pending:
+                stagger = None
+                if index < len(candidates) and len(pending) < self.race_width:
+                    server = candidates[index]
+                    attempts[server] += 1
+                    task = asyncio.ensure_future(self._race_one(query, server, ranked.index(server), failed,
+                                                                attempts[server] > 1))
+                    runners[task] = server
+                    pending.add(task)
+                    index += 1
+                    if index < len(candidates):
+                        stagger = self.race_stagger
+
+                done, pending = await asyncio.wait(pending, timeout=stagger, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        response, server_ip, position = task.result()
+                        self.selector.record_race(position)
+                        return response, server_ip
+
+                    # Timed out, queued again until it was tried 'max_attempts' times
+                    server = runners.pop(task)
+                    if server not in failed and attempts[server] < self.max_attempts:
+                        candidates.append(server)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise ResolutionError(zone_name, servers)
+
+
+    async def _race_one(self, query, server, position, failed, retry=False):
+        """ One runner of the race, returns None if 'server' did not give a usable response """
+        try:
+            server_ip = await self._server_ip(server)
+        except ResolutionError:
+            failed.add(server)
+            return None
+
+        self._record_send(retry)
+        start_time = time.monotonic()
+        try:
+            sent_query = self._query_for(query, server_ip)
+            response = await self._udp_exchange(sent_query, server_ip)
+            response = await self._complete_exchange(sent_query, server_ip, response)
+        except (dns.exception.DNSException, OSError, EOFError):
+            self._record_timeout(server_ip)
+            return None
+
+        if self._accept_response(server, server_ip, response, time.monotonic() - start_time, failed):
+            return response, server_ip, position
+        return None
+
+
+    async def _udp_exchange(self, query, server_ip):
+        """ Coroutine version of DNSResolver._udp_exchange """
+        if self.udp_transport is not None:
+            return await self.udp_transport.query_async(query, server_ip, self.port, self.selector.timeout(server_ip))
+        return await dns.asyncquery.udp(query, server_ip, timeout=self.selector.timeout(server_ip), port=self.port)
+
+
+    async def _complete_exchange(self, query, server_ip, response):
+        """ Coroutine version of DNSResolver._complete_exchange """
+        if self._edns_rejected(query, response):
+            self._log("%s does not support EDNS, retrying without it", server_ip)
+            self.metrics.increment("edns_fallback")
+            self.selector.record_no_edns(server_ip)
+            query = self._query_for(query, server_ip)
+            response = await self._udp_exchange(query, server_ip)
+        return await self._untruncate(query, server_ip, response)
+
+
+    async def _untruncate(self, query, server_ip, response):
+        """ Coroutine version of DNSResolver._untruncate, the pooled TCP exchange runs in the default executor """
+        if not response.flags & dns.flags.TC:
+            return response
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, DNSResolver._untruncate, self, query, server_ip, response)
+
+
+    async def _get_resource_records(self, zone_name, type, nameservers):
+        """ Coroutine version of DNSResolver._get_resource_records """
+        query = self._make_query(zone_name, type, self.want_dnssec)
+
+        main_response, ns_ip = await self._query_server(zone_name, query, nameservers)
+
+        return self._answer_records(main_response), ns_ip, main_response
+
+
+    async def _server_ip(self, server):
+        """ Coroutine version of DNSResolver._server_ip """
+        if str(server).replace(".","").isnumeric():
+            return server
+
+        addresses = self.cache.get_addresses(server)
+        if addresses is not None:
+            return addresses.addresses[0]
+
+        # A nameserver whose address depends on itself can never be resolved
+        pending = _pending_nameservers.get()
+        if server in pending:
+            raise ResolutionError(server, [])
+
+        token = _pending_nameservers.set(pending | {server})
+        start_time = time.monotonic()
+        try:
+            self._log("Resolving nameserver '%s'", server)
+            answer, _, _ = await self._iterate(server, "A")
+            self._raise_negative(answer)
+        finally:
+            _pending_nameservers.reset(token)
+        self.metrics.observe("nameserver_lookup", time.monotonic() - start_time)
+
+        addresses = NameserverAddresses(server, [a_record.address for a_record in answer.records], answer.ttl)
+        self.cache.add_addresses(addresses)
+        return addresses.addresses[0]
+
+
+    async def _iterate(self, hostname, type):
+        """ Coroutine version of DNSResolver._iterate """
+        nameservers = self.root_servers_ip
+        zone = "."
+        redirection_history = []
+
+        # Skip the levels whose delegations are already cached
+        for delegation in self._cached_chain(hostname):
+            redirection_history += [(zone, tuple(nameservers))]
+            self._log("Cached delegation for '%s'", delegation.zone)
+            self._prefetch_delegation(delegation, zone, nameservers)
+            nameservers = self._delegation_servers(delegation)
+            zone = delegation.zone
+
+        for _ in range(self.max_referrals):
+            # Query the nameservers iteratively, concurrent lookups below the same zone cut share the query
+            start_time = time.monotonic()
+            rrsets, ns_ip, main_response = await self.inflight.do(self._flight_key(hostname, type, zone),
+                lambda: self._get_resource_records(hostname, self.rdatatype[type], nameservers))
+            if not self._shared_response_usable(hostname, zone, main_response):
+                rrsets, ns_ip, main_response = await self._get_resource_records(hostname, self.rdatatype[type], nameservers)
+            redirection_history += [(zone, ns_ip)]
+            self._record_hop(hostname, zone, ns_ip, main_response, time.monotonic() - start_time)
+
+            answer, delegation = self._follow(hostname, type, zone, rrsets, main_response, nameservers)
+            if answer is not None:
+                return answer, redirection_history, main_response
+
+            nameservers = self._delegation_servers(delegation)
+            zone = delegation.zone
+
+        raise ResolutionError(hostname, nameservers)
+
+
+    async def lookup(self, hostname, type):
+        """ Coroutine version of DNSResolver.lookup """
+        answer = self.cache.get_answer(hostname, type)
+        if answer is not None:
+            self._cache_hit()
+            self._prefetch_answer(answer)
+        else:
+            self._cache_miss()
+            answer = await self._refresh_or_stale(hostname, type)
+
+        return answer
+
+
+    async def _refresh_answer(self, hostname, type):
+        """ Coroutine version of DNSResolver._refresh_answer """
+        answer, _, _ = await self._iterate(hostname, type)
+        self.cache.add_answer(answer)
+        return answer
+
+
+    async def _refresh_or_stale(self, hostname, type):
+        """ Coroutine version of DNSResolver._refresh_or_stale, late resolutions go on as tasks of the event loop """
+        stale = self._stale_answer(hostname, type)
+        if stale is None:
+            return await self._refresh_answer(hostname, type)
+
+        key = (hostname, type)
+        if self._stale_holds.get(key, 0) > time.monotonic():
+            return self._serve_stale(stale)
+
+        if self.stale_deadline is None:
+            try:
+                answer = await self._refresh_answer(hostname, type)
+            except Exception:
+                self._hold_stale(key)
+                return self._serve_stale(stale)
+            self._stale_holds.pop(key, None)
+            return answer
+
+        task = self._stale_refreshes.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(self._in_background(hostname, type, self._refresh_answer, hostname, type))
+            self._stale_refreshes[key] = task
+            task.add_done_callback(self._stale_refresh_done(key))
+        try:
+            answer = await asyncio.wait_for(asyncio.shield(task), self.stale_deadline)
+        except asyncio.TimeoutError:
+            self._log("No answer for '%s' within %s seconds", hostname, self.stale_deadline)
+            return self._serve_stale(stale)
+        except Exception:
+            self._hold_stale(key)
+            return self._serve_stale(stale)
+
+        self._stale_holds.pop(key, None)
+        return answer
+
+
+    def _stale_refresh_done(self, key):
+        def done(task):
+            self._stale_refreshes.pop(key, None)
+            # Nobody may be waiting on the task any more, its failure must not be reported as unhandled
+            if not task.cancelled() and task.exception() is not None:
+                self._hold_stale(key)
+        return done
+
+
+    async def _in_background(self, hostname, type, coroutine_function, *args):
+        """ Coroutine version of DNSResolver._in_background """
+        _query_context.set(QueryContext(hostname, type, False))
+        _pending_nameservers.set(frozenset())
+        return await coroutine_function(*args)
+
+
+    async def _refresh_delegation(self, zone, parent, nameservers):
+        """ Coroutine version of DNSResolver._refresh_delegation """
+        rrsets, _, main_response = await self._get_resource_records(zone, dns.rdatatype.NS, nameservers)
+        self._follow(zone, "NS", parent, rrsets, main_response, nameservers)
+
+
+    def _prefetch(self, key, hostname, type, coroutine_function, *args):
+        """ DNSResolver._prefetch, the refresh runs as a task of the event loop """
+        if self.prefetcher.submit_async(key, lambda: self._in_background(hostname, type, coroutine_function, *args)):
+            self.metrics.increment("prefetch", key[0])
+
+
+    async def resolve(self, hostname, type, structured=False):
+        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
+
+        hostname = self._normalize(hostname)
+
+        context = self._begin_query(hostname, type)
+        try:
+            answer = await self.lookup(hostname, type)
+            self._raise_negative(answer)
+        except Exception as e:
+            self._end_query(context, error=e)
+            raise
+        self._end_query(context, answer)
+
+        result = ResolutionResult(context, answer)
+        return result if structured else "\n" + result.reply
+
+
+    async def resolve_many(self, queries, concurrency=256, structured=False):
+        """ Asynchronous generator version of DNSResolver.resolve_many, with at most 'concurrency' lookups in flight """
+        queries = iter(queries)
+        pending = {}
+        try:
+            while True:
+                for hostname, type in itertools.islice(queries, concurrency - len(pending)):
+                    pending[asyncio.ensure_future(self.resolve(hostname, type, structured))] = (hostname, type)
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    hostname, type = pending.pop(task)
+                    error = task.exception()
+                    yield hostname, type, None if error is not None else task.result(), error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncDNSSECResolver(AsyncDNSResolver, DNSSECResolver):
+    """
+    Non-blocking variant of DNSSECResolver. Referrals are followed on the event loop,
+    the chain of trust (TCP fetches and signature checks) runs in the loop's default
+    executor so that validation never blocks other lookups.
+    """
+
+    async def lookup(self, hostname, type):
+        """ Coroutine version of DNSSECResolver.lookup """
+        # Only answers which went through the chain of trust can be reused, NS records are never validated
+        answer = self.cache.get_answer(hostname, type)
+        if answer is not None and (answer.secure or type == "NS"):
+            self._cache_hit()
+            self._prefetch_answer(answer)
+            return answer
+
+        answer = self._denied_answer(hostname, type)
+        if answer is not None:
+            self._cache_hit()
+        else:
+            self._cache_miss()
+            answer = await self._refresh_or_stale(hostname, type)
+
+        return answer
+
+
+    async def _refresh_answer(self, hostname, type):
+        """ Coroutine version of DNSSECResolver._refresh_answer """
+        answer, redirection_history, main_response = await self._iterate(hostname, type)
+
+        # Run DNSSec on top of DNS, negative answers are proven by the signed SOA and NSEC records
+        if type in ("A", "MX"):
+            redirection_history = await self._resolve_history(redirection_history)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._check_trust, hostname, main_response, redirection_history)
+            answer.secure = True
+            if answer.negative is not None:
+                self._learn_denials(answer, redirection_history[-1][0], main_response)
+        self.cache.add_answer(answer)
+        return answer
+
+
+    async def _history_ip(self, zone, servers):
+        """ Coroutine version of DNSSECResolver._history_ip """
+        for server in self._order_servers(servers):
+            try:
+                return await self._server_ip(server)
+            except ResolutionError:
+                continue
+        raise ResolutionError(zone, list(servers))
+
+
+    async def _resolve_history(self, redirection_history):
+        """ Coroutine version of DNSSECResolver._resolve_history """
+        top = self._trusted_level(redirection_history)
+        return [(zone, await self._history_ip(zone, server) if isinstance(server, tuple) and i >= top else server)
+                for i, (zone, server) in enumerate(redirection_history)]
+
+
+    async def resolve(self, hostname, type, structured=False):
+        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
+
+        hostname = self._normalize(hostname)
+
+        context = self._begin_query(hostname, type)
+        try:
+            answer = await self.lookup(hostname, type)
+            self._raise_negative(answer)
+        except Exception as e:
+            self._end_query(context, error=e)
+            raise
+        self._end_query(context, answer)
+
+        result = ResolutionResult(context, answer)
+        return result if structured else result.reply
@@ -0,0 +1,190 @@
+"""
+Offline benchmark of the resolvers against a loopback stand-in hierarchy (see fakehierarchy.py).
+
+Every run resolves all the generated names with fresh caches (cold pass), then once more (warm pass),
+and reports throughput, latency percentiles, upstream queries per resolution and memory as JSON, e.g:
+
+$ python3 benchmark.py --names 1000 --dnssec --delay 0.002 --jitter 0.002 --output before.json
+$ python3 benchmark.py --names 1000 --dnssec --delay 0.002 --jitter 0.002 --output after.json
+$ python3 benchmark.py --compare before.json after.json
+"""
+from asyncresolver import *
+from fakehierarchy import *
+import argparse
+import asyncio
+import dns.version
+import json
+import os
+import platform
+import resource
+import subprocess
+import tracemalloc
+
+MODES = ("sync", "batch", "async")
+
+
+def _percentile(values, p):
+    return round(values[min(int(p * len(values)), len(values)-1)] * 1000, 3) if values else None
+
+
+def _make_resolver(resolver_class, hierarchy, race, udp_sockets=0):
+    """ Resolver with its own cache, selector, connections and metrics, pointed at the stand-in hierarchy """
+    resolver = resolver_class(cache=DNSCache(), selector=ServerSelector(), tcp_pool=TCPConnectionPool(), race=race,
+                              logger=QueryLogger(level=LOG_OFF), metrics=Metrics(),
+                              udp_transport=UDPMultiplexer(udp_sockets) if udp_sockets > 0 else None)
+    if isinstance(resolver, DNSSECResolver):
+        resolver.verifier = SignatureVerifier()
+    resolver.port = hierarchy.port
+    resolver.root_servers_ip = hierarchy.root_servers
+    return resolver
+
+
+def _resolve_all(resolver, mode, names, type, concurrency):
+    """ Resolve 'names' in the given mode, returns the ResolutionResult objects and the number of failures """
+    queries = [(name, type) for name in names]
+    if mode == "sync":
+        results, errors = [], 0
+        for name, type in queries:
+            try:
+                results += [resolver.resolve(name, type, structured=True)]
+            except Exception:
+                errors += 1
+        return results, errors
+
+    if mode == "batch":
+        outcomes = list(resolver.resolve_many(queries, max_workers=concurrency, structured=True))
+    else:
+        async def run():
+            return [outcome async for outcome in resolver.resolve_many(queries, concurrency=concurrency, structured=True)]
+        outcomes = asyncio.run(run())
+    return [result for _, _, result, error in outcomes if error is None], sum(1 for outcome in outcomes if outcome[3] is not None)
+
+
+def run_benchmark(hierarchy, resolver_name, mode, type="A", concurrency=64, race=False, trace_memory=False, udp_sockets=0):
+    """
+    @params:
+    - hierarchy: Started FakeHierarchy object
+    - resolver_name: "dns" or "dnssec"
+    - mode: "sync" (one resolve() after the other), "batch" (resolve_many in threads) or "async" (asyncio resolve_many)
+    - type: string in ("A", "NS", "MX") determining the type of dns record
+    - concurrency: Lookups in flight in the batch and async modes
+    - udp_sockets: Number of sockets of a shared UDPMultiplexer, 0 for a socket per query
+
+    @returns:
+    - report: Python dictionary with one entry per pass (cold, warm)
+    """
+    if mode == "async":
+        resolver_class = AsyncDNSSECResolver if resolver_name == "dnssec" else AsyncDNSResolver
+    else:
+        resolver_class = DNSSECResolver if resolver_name == "dnssec" else DNSResolver
+    resolver = _make_resolver(resolver_class, hierarchy, race, udp_sockets)
+
+    report = {"resolver": resolver_name, "mode": mode, "type": type, "concurrency": 1 if mode == "sync" else concurrency}
+    for pass_name in ("cold", "warm"):
+        if trace_memory:
+            tracemalloc.start()
+        upstream_before = hierarchy.queries()
+        start_time = time.monotonic()
+
+        results, errors = _resolve_all(resolver, mode, hierarchy.names, type, concurrency)
+
+        elapsed = time.monotonic() - start_time
+        latencies = sorted(result.elapsed for result in results)
+        report[pass_name] = {
+            "resolutions": len(results),
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "qps": round(len(results) / elapsed, 1) if elapsed > 0 else None,
+            "p50_ms": _percentile(latencies, 0.50),
+            "p90_ms": _percentile(latencies, 0.90),
+            "p99_ms": _percentile(latencies, 0.99),
+            "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+            "upstream_queries_per_resolution": round((hierarchy.queries() - upstream_before) / max(len(results), 1), 3),
+            "cache_hits": sum(1 for result in results if result.cached),
+            "cache_entries": len(resolver.cache),
+        }
+        if trace_memory:
+            report[pass_name]["traced_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+
+    report["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    resolver.tcp_pool.close()
+    if resolver.udp_transport is not None:
+        resolver.udp_transport.close()
+    return report
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "dnspython": dns.version.version,
+            "platform": platform.platform()}
+
+
+def compare(before, after):
+    """ Relative change of every numeric metric between two benchmark outputs, matched by resolver/mode/type """
+    def runs(report):
+        return {(run["resolver"], run["mode"], run["type"]): run for run in report["runs"]}
+
+    before_runs, after_runs = runs(before), runs(after)
+    changes = {}
+    for key in sorted(set(before_runs) & set(after_runs)):
+        for pass_name in ("cold", "warm"):
+            for metric, old in before_runs[key][pass_name].items():
+                new = after_runs[key][pass_name].get(metric, None)
+                if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+                    change = f"{(new - old) / old * 100:+.1f}%" if old else None
+                    changes["/".join(key) + f"/{pass_name}/{metric}"] = {"before": old, "after": new, "change": change}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark of the resolvers against a loopback DNS hierarchy")
+    parser.add_argument("--names", type=int, default=1000, help="number of generated second-level zones")
+    parser.add_argument("--tlds", type=str, default="com,org")
+    parser.add_argument("--servers", type=int, default=4, help="number of authoritative servers")
+    parser.add_argument("--dnssec", action='store_true', help="sign the zones and benchmark DNSSECResolver as well")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds added at random")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of udp queries dropped")
+    parser.add_argument("--truncate", action='store_true', help="truncate every udp response")
+    parser.add_argument("--no-edns", action='store_true', help="servers answer FORMERR to queries with EDNS")
+    parser.add_argument("--port", type=int, default=5300)
+    parser.add_argument("--modes", type=str, default=",".join(MODES))
+    parser.add_argument("--type", type=str, default="A")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--race", action='store_true')
+    parser.add_argument("--udp-sockets", type=int, default=0, help="share this many udp sockets between upstream queries")
+    parser.add_argument("--trace-memory", action='store_true', help="report the peak of traced allocations (slower)")
+    parser.add_argument("--output", type=str, default=None, help="write the JSON report to this file")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BEFORE", "AFTER"), help="compare two reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            print(json.dumps(compare(json.load(before), json.load(after)), indent=2))
+        return
+
+    hierarchy = FakeHierarchy(args.names, tuple(args.tlds.split(",")), args.servers, dnssec=args.dnssec, port=args.port,
+                              delay=args.delay, jitter=args.jitter, loss=args.loss, truncate=args.truncate,
+                              no_edns=args.no_edns)
+    parameters = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    report = {"environment": _environment(), "parameters": parameters, "runs": []}
+    with hierarchy:
+        for resolver_name in (("dns", "dnssec") if args.dnssec else ("dns",)):
+            for mode in args.modes.split(","):
+                report["runs"] += [run_benchmark(hierarchy, resolver_name, mode, args.type, args.concurrency, args.race,
+                                                 args.trace_memory, args.udp_sockets)]
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,60 @@
+class _DNSError(Exception):
+    """ Base of the exceptions below, rebuilt from the arguments of their constructor when unpickled (see ShardedResolver) """
+    def __init__(self, msg, *params):
+        super().__init__(msg)
+        self.params = params
+
+    def __reduce__(self):
+        return (self.__class__, self.params)
+
+
 
-class ResolutionError(Exception):
+class ResolutionError(_DNSError):
     def __init__(self, zone_name, nameservers):
         msg = f"""
         Cannot find Resource Records for {zone_name} in any of the following nameservers: 
         {nameservers}
         """
-        super().__init__(msg)
+        super().__init__(msg, zone_name, nameservers)
+
+
+class NXDomainError(ResolutionError):
+    def __init__(self, zone_name):
+        msg = f"{zone_name} does not exist (NXDOMAIN)"
+        _DNSError.__init__(self, msg, zone_name)
 
 
-class ResourceRecordTypeError(Exception):
+class NoDataError(ResolutionError):
+    def __init__(self, zone_name, type):
+        msg = f"{zone_name} exists but has no {type} records (NODATA)"
+        _DNSError.__init__(self, msg, zone_name, type)
+
+
+class ResourceRecordTypeError(_DNSError):
     def __init__(self, type):
         msg = f"{type} is not a valid resource record type"
-        super().__init__(msg)
+        super().__init__(msg, type)
 
 
-class KSKVerificationError(Exception):
+class KSKVerificationError(_DNSError):
     def __init__(self, zone_name):
         msg = f"KSK verification for '{zone_name}' failed."
-        super().__init__(msg)
+        super().__init__(msg, zone_name)
 
 
-class ZSKVerificationError(Exception):
+class ZSKVerificationError(_DNSError):
     def __init__(self, zone_name):
         msg = f"ZSK verification for '{zone_name}' failed."
-        super().__init__(msg)
+        super().__init__(msg, zone_name)
 
 
-class RRSetVerificationError(Exception):
+class RRSetVerificationError(_DNSError):
     def __init__(self, zone_name):
         msg = f"RRSet verification for '{zone_name}' failed."
-        super().__init__(msg)
+        super().__init__(msg, zone_name)
 
 
-class NoDNSSECSupportError(Exception):
+class NoDNSSECSupportError(_DNSError):
     def __init__(self, zone_name):
         msg = f"DNSSEC not enabled for '{zone_name}'"
-        super().__init__(msg)
+        super().__init__(msg, zone_name)
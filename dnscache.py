@@ -0,0 +1,278 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+import dns.name
+import dns.rdatatype
+from nsecindex import *
+
+
+class Delegation():
+    """
+    A zone cut learnt from a referral: the NS names of the child zone and the
+    glue addresses that came with them in the additional section
+    """
+    __slots__ = ("zone", "nameservers", "glue", "ttl", "expires", "hits")
+
+    def __init__(self, zone, nameservers, glue, ttl, expires=None):
+        self.zone = zone
+        self.nameservers = nameservers
+        self.glue = glue
+        self.ttl = ttl
+        self.expires = expires
+        self.hits = 0
+
+
+    def addresses(self):
+        """ Glue addresses of the nameservers, in the order the NS records were received """
+        addresses = []
+        for nameserver in self.nameservers:
+            addresses += self.glue.get(nameserver, [])
+        return addresses
+
+
+class CachedAnswer():
+    """
+    Final answer for a (name, type) pair. 'secure' marks answers which passed
+    DNSSEC validation, so that DNSSECResolver never returns records cached by
+    the plain resolver.
+
+    Negative answers (RFC 2308) have no records, 'negative' is "NXDOMAIN" or "NODATA"
+    and 'soa' holds the SOA RRSet of the zone which gave the answer.
+
+    'stale' marks copies of expired answers served while upstream resolution fails (RFC 8767)
+    """
+    __slots__ = ("name", "type", "records", "ttl", "expires", "secure", "negative", "soa", "hits", "stale")
+
+    def __init__(self, name, type, records, ttl, expires=None, secure=False, negative=None, soa=None):
+        self.name = name
+        self.type = type
+        self.records = records
+        self.ttl = ttl
+        self.expires = expires
+        self.secure = secure
+        self.negative = negative
+        self.soa = soa
+        self.hits = 0
+        self.stale = False
+
+
+class NameserverAddresses():
+    """ Addresses of a nameserver, learnt from glue or from resolving the NS name ourselves """
+    __slots__ = ("name", "addresses", "ttl", "expires", "hits")
+
+    def __init__(self, name, addresses, ttl, expires=None):
+        self.name = name
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expires = expires
+        self.hits = 0
+
+
+class TrustedKeys():
+    """
+    DNSKEY RRSet of a zone whose chain of trust has been verified. Expires with the
+    TTLs involved or with the first of its signatures, whichever comes first
+    """
+    __slots__ = ("zone", "keys", "ttl", "expires", "hits")
+
+    def __init__(self, zone, keys, ttl, expires=None):
+        self.zone = zone
+        self.keys = keys
+        self.ttl = ttl
+        self.expires = expires
+        self.hits = 0
+
+
+class DNSCache():
+    """
+    Thread-safe, TTL-respecting cache of delegations (zone cuts), nameserver addresses,
+    final answers and DNSSEC keys proven secure.
+
+    Each table is an LRU bounded by 'max_entries'. Entries are dropped when their
+    TTL runs out or when they are the least recently used entry of a full table.
+    Hits, misses, expirations and evictions are counted per table in 'stats',
+    and every entry counts its own hits, see Prefetcher.
+
+    Expired entries are kept 'stale_window' more seconds, so that answers can be
+    served stale when upstream resolution fails (RFC 8767), see get_stale_answer.
+
+    Validated NSEC/NSEC3 records are kept per zone as ranges (RFC 8198), so that names
+    they prove nonexistent are answered without asking upstream, see get_denial.
+    """
+
+    def __init__(self, max_entries=10000, clock=time.time, stale_window=0) -> None:
+        self.max_entries = max_entries
+        self.clock = clock
+        self.stale_window = stale_window
+        self.stats = defaultdict(int)
+
+        self._delegations = OrderedDict()
+        self._addresses = OrderedDict()
+        self._answers = OrderedDict()
+        self._keys = OrderedDict()
+        self._denials = OrderedDict()
+        self._lock = threading.RLock()
+
+
+    def _get(self, table, name, key):
+        with self._lock:
+            entry = table.get(key, None)
+            if entry is not None and entry.expires <= self.clock():
+                if entry.expires + self.stale_window <= self.clock():
+                    del table[key]
+                    self.stats[name+"_expirations"] += 1
+                entry = None
+
+            if entry is None:
+                self.stats[name+"_misses"] += 1
+                return None
+
+            table.move_to_end(key)
+            entry.hits += 1
+            self.stats[name+"_hits"] += 1
+            return entry
+
+
+    def _put(self, table, name, key, entry):
+        with self._lock:
+            entry.expires = self.clock() + entry.ttl
+            self._insert(table, name, key, entry)
+
+
+    def _insert(self, table, name, key, entry):
+        """ Store 'entry' as is, its expiry time already set """
+        with self._lock:
+            table[key] = entry
+            table.move_to_end(key)
+
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+                self.stats[name+"_evictions"] += 1
+
+
+    def get_delegation(self, zone):
+        return self._get(self._delegations, "delegation", zone)
+
+
+    def add_delegation(self, delegation):
+        self._put(self._delegations, "delegation", delegation.zone, delegation)
+
+
+    def delegation_chain(self, hostname):
+        """
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+
+        @returns:
+        - chain: Cached delegations for the ancestors of 'hostname', starting below the root, each one a
+          descendant of the previous one. Labels which are not zone cuts (e.g. co.jp.) or which are missing
+          from the cache are skipped, so the chain always ends at the deepest delegation cached
+        """
+        labels = hostname.rstrip(".").split(".")
+        chain = []
+        for i in range(len(labels)-1, -1, -1):
+            delegation = self.get_delegation(".".join(labels[i:])+".")
+            if delegation is not None:
+                chain += [delegation]
+        return chain
+
+
+    def get_addresses(self, nameserver):
+        return self._get(self._addresses, "address", nameserver)
+
+
+    def add_addresses(self, addresses):
+        self._put(self._addresses, "address", addresses.name, addresses)
+
+
+    def get_answer(self, hostname, type):
+        return self._get(self._answers, "answer", (hostname, type))
+
+
+    def add_answer(self, answer):
+        self._put(self._answers, "answer", (answer.name, answer.type), answer)
+
+
+    def get_stale_answer(self, hostname, type):
+        """ Answer for (hostname, type), expired or not, as long as it is within the stale window. Or None """
+        with self._lock:
+            entry = self._answers.get((hostname, type), None)
+            if entry is None or entry.expires + self.stale_window <= self.clock():
+                return None
+            self.stats["answer_stale_hits"] += 1
+            return entry
+
+
+    def get_trusted_keys(self, zone):
+        return self._get(self._keys, "key", zone)
+
+
+    def add_trusted_keys(self, keys):
+        self._put(self._keys, "key", keys.zone, keys)
+
+
+    def add_denial(self, zone, soa, rrset, ttl):
+        """
+        @params:
+        - zone: Zone which signed the records. E.g: stonybrook.edu.
+        - soa: SOA RRSet of the zone, returned with the answers synthesized from the records
+        - rrset: NSEC or NSEC3 RRSet whose signature was validated
+        - ttl: Seconds the records may be used, bounded by the SOA minimum and their signatures
+        """
+        with self._lock:
+            denials = self._denials.get(zone, None)
+            if denials is None:
+                denials = self._denials[zone] = ZoneDenials(zone)
+            self._denials.move_to_end(zone)
+            while len(self._denials) > self.max_entries:
+                self._denials.popitem(last=False)
+                self.stats["denial_evictions"] += 1
+
+            denials.soa = soa
+            expires = self.clock() + ttl
+            for rdata in rrset:
+                if rrset.rdtype == dns.rdatatype.NSEC:
+                    denials.add_nsec(rrset.name, rdata, expires)
+                else:
+                    denials.add_nsec3(rrset.name, rdata, expires)
+
+
+    def get_denial(self, hostname, type):
+        """
+        @returns:
+        - (negative, soa, ttl): "NXDOMAIN" or "NODATA" if the cached NSEC/NSEC3 ranges of the deepest zone
+          known for 'hostname' prove it, the SOA RRSet of that zone and the seconds left. Or None
+        """
+        name = dns.name.from_text(hostname)
+        with self._lock:
+            zone = name
+            while zone.to_text() not in self._denials and zone != dns.name.root:
+                zone = zone.parent()
+            denials = self._denials.get(zone.to_text(), None)
+            now = self.clock()
+            proof = denials.deny(hostname, dns.rdatatype.from_text(type), now) if denials is not None else None
+            if proof is None:
+                self.stats["denial_misses"] += 1
+                return None
+            self.stats["denial_hits"] += 1
+            negative, expires = proof
+            return negative, denials.soa, int(expires - now)
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._delegations) + len(self._addresses) + len(self._answers) + len(self._keys)
+
+
+    def clear(self):
+        with self._lock:
+            self._delegations.clear()
+            self._addresses.clear()
+            self._answers.clear()
+            self._keys.clear()
+            self._denials.clear()
+            self.stats.clear()
+
+
+# Cache shared by every resolver which is not given a cache of its own
+default_cache = DNSCache()
@@ -1,48 +1,164 @@
-import datetime
-import sys
+import concurrent.futures
+import itertools
+import dns.exception
+import dns.flags
 import dns.query
-import dns.resolver
 import time
 import os
+import selectors
+import socket
+import threading
 from collections import defaultdict
 from dns_exceptions import *
+from dnscache import *
+from metrics import *
+from prefetch import *
+from querylog import *
+from rootzone import *
+from resolutionresult import *
+from serverselection import *
+from singleflight import *
+from tcppool import *
+from udptransport import *
 
 class DNSResolver():
 
-    def __init__(self) -> None:
+    # Upper bound on the number of referrals followed for a single query
+    max_referrals = 30
+
+    # Number of passes over the nameservers of a zone before giving up
+    max_attempts = 2
+
+    # UDP payload size advertised with EDNS0 (RFC 6891) in every query. 1232 bytes avoids IP fragmentation
+    # on virtually every path (DNS flag day 2020), larger responses come back truncated and are fetched over TCP
+    edns_payload = 1232
+
+    # Serve-stale (RFC 8767): TTL of the stale answers returned, and seconds during which a name whose
+    # resolution just failed is answered stale without asking upstream again
+    stale_ttl = 30
+    stale_refresh_time = 30
+
+    def __init__(self, cache=None, selector=None, tcp_pool=None, race=False, race_stagger=0.05, race_width=3,
+                 logger=None, metrics=None, prefetcher=None, stale_deadline=None, udp_transport=None, root_zone=None) -> None:
         self.root_servers_ip = ['198.41.0.4', '199.9.14.201', '192.33.4.12', '199.7.91.13', '192.203.230.10',\
             '192.5.5.241', '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129',\
             '199.7.83.42', '202.12.27.33']
 
-        self.logs = []
-        self.resolver = dns.resolver.get_default_resolver()
+        # The query context and the glueless-lookup guard belong to the lookup running in the current thread
+        self._local = threading.local()
+
         self.rdatatype = {"A":dns.rdatatype.A, "NS": dns.rdatatype.NS, "MX": dns.rdatatype.MX}
+        self.want_dnssec = False
+
+        # Port the nameservers listen on, only ever changed to point the resolver at a test hierarchy
+        self.port = 53
+
+        # Racing mode: the query goes to the best ranked server, then to the next ones every 'race_stagger'
+        # seconds (at most 'race_width' in flight) and the first usable response wins
+        self.race = race
+        self.race_stagger = race_stagger
+        self.race_width = race_width
+
+        # Identical upstream queries issued by concurrent lookups are only sent once
+        self.inflight = SingleFlight()
+
+        # Delegations and answers are shared between resolvers unless a cache is given explicitly
+        self.cache = cache if cache is not None else default_cache
+
+        # Round trip times and hold-downs of the nameservers are shared the same way
+        self.selector = selector if selector is not None else default_selector
+
+        # Keep-alive TCP connections, for truncated responses and DNSSEC fetches
+        self.tcp_pool = tcp_pool if tcp_pool is not None else default_tcp_pool
+
+        # Shared UDP sockets for upstream queries (see UDPMultiplexer), otherwise every query opens its own socket.
+        # The racing mode of the threaded resolvers uses sockets of its own
+        self.udp_transport = udp_transport
+
+        # Query records are buffered and written in the background, shared between resolvers the same way
+        self.logger = logger if logger is not None else default_logger
+
+        # Latency histograms and counters, see Metrics.snapshot and Metrics.prometheus
+        self.metrics = metrics if metrics is not None else default_metrics
+
+        # Local copy of the root zone (see LocalRootZone), TLD referrals are then taken from it instead of a root server
+        self.root_zone = root_zone
+
+        # Refresh-ahead of popular answers and delegations, disabled unless a Prefetcher is given
+        self.prefetcher = prefetcher
+
+        # Expired answers kept by the cache (see DNSCache.stale_window) are returned when resolution fails,
+        # or when it takes more than 'stale_deadline' seconds, the resolution then goes on in the background
+        self.stale_deadline = stale_deadline
+        self._stale_refreshes = {}
+        self._stale_holds = {}
+        self._stale_lock = threading.Lock()
+        self._stale_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="stale-refresh")
+
+
+    def _query_context(self):
+        return getattr(self._local, "context", None)
+
+
+    def _begin_query(self, hostname, type):
+        context = self.logger.begin(hostname, type)
+        self._local.context = context
+        return context
 
-        dir = os.path.dirname(os.path.abspath(__file__))
-        self.logs_path = os.path.join(dir,'logs')
-        if not os.path.exists(self.logs_path):
-            os.makedirs(self.logs_path)
 
+    def _end_query(self, context, answer=None, error=None):
+        if error is not None:
+            self.logger.end(context, error=f"{error.__class__.__name__}: {' '.join(str(error).split())}")
+            self.metrics.increment("errors", error.__class__.__name__)
+        elif answer.negative is not None:
+            self.logger.end(context, negative=answer.negative, ttl=answer.ttl, stale=answer.stale)
+        else:
+            self.logger.end(context, records=answer.records, ttl=answer.ttl, stale=answer.stale)
+        self.metrics.observe("resolve", context.elapsed)
 
-    def _log(self, msg):
-        self.logs += [msg]
 
+    def _log(self, msg, *args):
+        """ Per-hop event of the current query, 'msg' % 'args' is only formatted if the event is written """
+        context = self._query_context()
+        if context is not None and context.events is not None:
+            context.event(msg, args)
 
-    def _flush_logs(self, hostname, type):
-        with open(self.logs_path+"/"+hostname+"-"+type+".txt", "w") as fp:
-            fp.write("\n".join(self.logs))
 
+    def _zone_level(self, zone):
+        """ 0 for the root, 1 for TLDs, 2 for their children, ... """
+        return 0 if zone == "." else zone.rstrip(".").count(".") + 1
 
-    def _current_timestamp(self):
-        current_time_object = datetime.datetime.now()
-        weekday = current_time_object.strftime("%a")
-        month = current_time_object.strftime("%b")
-        date = current_time_object.strftime("%d")
-        time = current_time_object.strftime('%H:%M:%S')
-        year = current_time_object.strftime("%Y")
-        timestamp = f"{weekday} {month} {date} {time} {year}"
-        
-        return timestamp
+
+    def _record_hop(self, hostname, zone, ns_ip, main_response, latency):
+        self.metrics.observe("hop", latency, level=self._zone_level(zone))
+        context = self._query_context()
+        if context is not None:
+            context.hops.append(Hop(hostname, zone, ns_ip, latency, main_response))
+        self._log("Redirecting to %s", ns_ip)
+
+
+    def _cache_hit(self):
+        context = self._query_context()
+        if context is not None:
+            context.cached = True
+        self.metrics.increment("cache", "hit")
+        self._log("Answered from cache")
+
+
+    def _cache_miss(self):
+        self.metrics.increment("cache", "miss")
+
+
+    def _record_timeout(self, server_ip):
+        self._log("No response from %s", server_ip)
+        self.selector.record_timeout(server_ip)
+        self.metrics.increment("timeouts")
+
+
+    def _record_send(self, retry):
+        self.metrics.increment("upstream_queries")
+        if retry:
+            self.metrics.increment("retries")
 
 
     def _query_server(self, zone_name, query, servers):
@@ -53,35 +169,245 @@ class DNSResolver():
         - servers: Python list of strings which are urls/ip-addresses of the nameservers
 
         @function:
-        - Selects a nameserver from 'servers'
-        - Determines the ip address of this nameserver
-        - Sends the query to this nameserver
-        - In case of failure, it retries everything by selecting the next server in the list
+        - Ranks the nameservers in 'servers' by smoothed round trip time, see ServerSelector
+        - Determines the ip address of the selected nameserver from the address cache, or by resolving it iteratively
+        - Sends the query to this nameserver, with a timeout derived from its round trip time
+        - In case of failure, it retries everything by selecting the next server in the list.
+          Servers which time out get an exponentially longer timeout on the next pass
 
         @returns:
         - response: Unprocessed/unfiltered response from the server
         - ns_ip: Ip address of the name server selected and queried for the response
         """
-        i=0
-        while True:
-            try:
-                # Check if 'servers' contain ip-addresses which are all numeric 
-                if not str(servers[0]).replace(".","").isnumeric():
-                    server_ip = self.resolver.resolve(servers[i]).rrset[0].to_text()
-                else:
-                    server_ip = servers[i] 
+        if self.race:
+            return self._race_servers(zone_name, query, servers)
+
+        failed = set()
+        sent = 0
+        for _ in range(self.max_attempts):
+            for server in self._order_servers(servers):
+                if server in failed:
+                    continue
+                try:
+                    server_ip = self._server_ip(server)
+                except ResolutionError:
+                    failed.add(server)
+                    continue
+
+                self._record_send(sent > 0)
+                sent += 1
+                start_time = time.monotonic()
+                try:
+                    sent_query = self._query_for(query, server_ip)
+                    response = self._udp_exchange(sent_query, server_ip)
+                    response = self._complete_exchange(sent_query, server_ip, response)
+                except (dns.exception.DNSException, OSError, EOFError):
+                    self._record_timeout(server_ip)
+                    continue
 
-                response = dns.query.udp(query, server_ip)
+                if self._accept_response(server, server_ip, response, time.monotonic() - start_time, failed):
+                    return response, server_ip
+
+        raise ResolutionError(zone_name, servers)
 
-                if response.rcode() != dns.rcode.NOERROR:
-                    i+=1
-                else:
-                    break
-                
-            except IndexError:
-                raise ResolutionError(zone_name, servers)
 
-        return response, server_ip
+    def _race_servers(self, zone_name, query, servers):
+        """ 
+        @params:
+        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
+        - query: Dnspython dns.message object, containing the query to be sent to the server
+        - servers: Python list of strings which are urls/ip-addresses of the nameservers
+
+        @function:
+        - Sends the query to the best ranked nameserver, then to the next one every 'race_stagger' seconds
+          until 'race_width' queries are in flight. A server which fails is replaced by the next one at once
+        - A server which times out is queued again, with its longer timeout, until it has been sent the
+          query 'max_attempts' times like in the sequential mode
+        - Returns the first usable response and abandons the other queries
+        - Records the rank of the winner, see ServerSelector.race_stats
+
+        @returns:
+        - response: Unprocessed/unfiltered response from the server
+        - ns_ip: Ip address of the name server selected and queried for the response
+        """
+        ranked = self._order_servers(servers)
+        candidates = list(ranked)
+        attempts = defaultdict(int)
+        failed = set()
+        in_flight = {}
+        index = 0
+        next_launch = time.monotonic()
+        events = selectors.DefaultSelector()
+
+        def drop(sock):
+            events.unregister(sock)
+            sock.close()
+            return in_flight.pop(sock)
+
+        def timed_out(server, server_ip):
+            self._record_timeout(server_ip)
+            if server not in failed and attempts[server] < self.max_attempts:
+                candidates.append(server)
+
+        try:
+            while index < len(candidates) or in_flight:
+                can_launch = index < len(candidates) and len(in_flight) < self.race_width
+                if can_launch and (not in_flight or time.monotonic() >= next_launch):
+                    server = candidates[index]
+                    index += 1
+                    try:
+                        server_ip = self._server_ip(server)
+                        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    except ResolutionError:
+                        failed.add(server)
+                        continue
+
+                    sock.setblocking(False)
+                    attempts[server] += 1
+                    self._record_send(attempts[server] > 1)
+                    start_time = time.monotonic()
+                    try:
+                        sock.sendto(self._query_for(query, server_ip).to_wire(), (server_ip, self.port))
+                    except OSError:
+                        sock.close()
+                        timed_out(server, server_ip)
+                        continue
+
+                    events.register(sock, selectors.EVENT_READ)
+                    in_flight[sock] = (server, server_ip, ranked.index(server), start_time,
+                                       start_time + self.selector.timeout(server_ip))
+                    next_launch = time.monotonic() + self.race_stagger
+                    continue
+
+                # Sleep until a response arrives, a query times out or the next server is due
+                wake_up = min(deadline for _, _, _, _, deadline in in_flight.values())
+                if can_launch:
+                    wake_up = min(wake_up, next_launch)
+
+                for key, _ in events.select(max(wake_up - time.monotonic(), 0)):
+                    server, server_ip, position, start_time, _ = in_flight[key.fileobj]
+                    try:
+                        response = dns.message.from_wire(key.fileobj.recv(65535))
+                    except dns.exception.DNSException:
+                        continue
+                    except OSError:
+                        drop(key.fileobj)
+                        timed_out(server, server_ip)
+                        continue
+
+                    # Ignore anything which does not match our question and message id
+                    if not query.is_response(response):
+                        continue
+
+                    drop(key.fileobj)
+                    try:
+                        response = self._complete_exchange(self._query_for(query, server_ip), server_ip, response)
+                    except (dns.exception.DNSException, OSError, EOFError):
+                        timed_out(server, server_ip)
+                        continue
+
+                    if self._accept_response(server, server_ip, response, time.monotonic() - start_time, failed):
+                        self.selector.record_race(position)
+                        return response, server_ip
+
+                now = time.monotonic()
+                for sock, (server, server_ip, _, _, deadline) in list(in_flight.items()):
+                    if deadline <= now:
+                        drop(sock)
+                        timed_out(server, server_ip)
+
+        finally:
+            for sock in list(in_flight):
+                drop(sock)
+            events.close()
+
+        raise ResolutionError(zone_name, servers)
+
+
+    def _udp_exchange(self, query, server_ip):
+        """ Send 'query' to 'server_ip' over udp and wait for the response, with the timeout given by the selector """
+        if self.udp_transport is not None:
+            return self.udp_transport.query(query, server_ip, self.port, self.selector.timeout(server_ip))
+        return dns.query.udp(query, server_ip, timeout=self.selector.timeout(server_ip), port=self.port)
+
+
+    def _make_query(self, zone_name, rdtype, want_dnssec):
+        """ Query advertising 'edns_payload' bytes with EDNS0, and the DO bit if 'want_dnssec' """
+        return dns.message.make_query(zone_name, rdtype, use_edns=0, payload=self.edns_payload, want_dnssec=want_dnssec)
+
+
+    def _query_for(self, query, server_ip):
+        """ 'query' as it should be sent to 'server_ip': without EDNS if the server is known to reject it """
+        if query.edns < 0 or self.selector.supports_edns(server_ip):
+            return query
+        plain = dns.message.make_query(query.question[0].name, query.question[0].rdtype, use_edns=False)
+        plain.id = query.id
+        plain.flags = query.flags
+        return plain
+
+
+    def _edns_rejected(self, query, response):
+        """ Servers which don't implement EDNS answer FORMERR or NOTIMP, without an OPT record (RFC 6891) """
+        return query.edns >= 0 and response.edns < 0 and response.rcode() in (dns.rcode.FORMERR, dns.rcode.NOTIMP)
+
+
+    def _complete_exchange(self, query, server_ip, response):
+        """  
+        @params:
+        - query: Query sent to 'server_ip' over udp
+        - response: Response received for it
+
+        @function:
+        - If the server rejected EDNS, remember it and repeat the query without EDNS
+        - If the response came back truncated, repeat the query over TCP
+
+        @returns:
+        - response: Complete response of the server
+        """
+        if self._edns_rejected(query, response):
+            self._log("%s does not support EDNS, retrying without it", server_ip)
+            self.metrics.increment("edns_fallback")
+            self.selector.record_no_edns(server_ip)
+            query = self._query_for(query, server_ip)
+            response = self._udp_exchange(query, server_ip)
+        return self._untruncate(query, server_ip, response)
+
+
+    def _untruncate(self, query, server_ip, response):
+        """ Repeat the query over a pooled TCP connection if the udp response came back truncated """
+        if not response.flags & dns.flags.TC:
+            return response
+        self._log("Truncated response from %s, retrying over TCP", server_ip)
+        self.metrics.increment("truncated")
+        start_time = time.monotonic()
+        response = self.tcp_pool.query(query, server_ip, port=self.port, timeout=self.selector.max_timeout)
+        self.metrics.observe("tcp", time.monotonic() - start_time, server=server_ip)
+        return response
+
+
+    def _order_servers(self, servers):
+        """ Nameservers with known addresses ranked by the selector, then the names still to be resolved """
+        ips = [server for server in servers if str(server).replace(".","").isnumeric()]
+        names = [server for server in servers if not str(server).replace(".","").isnumeric()]
+        return self.selector.rank(ips) + names
+
+
+    def _accept_response(self, server, server_ip, response, rtt, failed):
+        """ Record the round trip time of 'server_ip' and decide whether its response can be used """
+        self.selector.record_rtt(server_ip, rtt)
+        self.metrics.observe("exchange", rtt, server=server_ip)
+        self.metrics.increment("rcode", dns.rcode.to_text(response.rcode()))
+        if response.rcode() == dns.rcode.NOERROR:
+            return True
+
+        # An authoritative NXDOMAIN is final (RFC 2308), asking the other servers would get the same answer
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            if response.flags & dns.flags.AA:
+                return True
+        else:
+            self.selector.record_lame(server_ip)
+        failed.add(server)
+        return False
 
 
     def _get_resource_records(self, zone_name, type, nameservers):  
@@ -93,20 +419,25 @@ class DNSResolver():
 
         @function:
         - Send the query for the 'zone_name'-'type' and get the response
-        - Organize the results in a python dictionary indexed by the record types
+        - Organize the records of the answer section in a python dictionary indexed by the record types
 
         @returns:
-        - rrsets_dict: Dictionary containing resource records indexed by the record types 
+        - rrsets_dict: Dictionary containing answer records indexed by the record types 
         - ns_ip: Ip address of the name server selected and queried for the response
+        - main_response: Unprocessed response, referrals are extracted from it by '_referral'
         """
-        query = dns.message.make_query(zone_name, type)
+        query = self._make_query(zone_name, type, self.want_dnssec)
 
         main_response, ns_ip = self._query_server(zone_name, query, nameservers)
-        rrsets = main_response.authority + main_response.answer
 
+        return self._answer_records(main_response), ns_ip, main_response
+
+
+    def _answer_records(self, main_response):
+        """ Organize the records of the answer section in a python dictionary indexed by the record types """
         rrsets_dict = defaultdict(list)
 
-        for rrset in rrsets:
+        for rrset in main_response.answer:
             for resource_record in rrset:
                 if resource_record.rdtype == dns.rdatatype.A:
                     rrsets_dict["A"] += [resource_record]
@@ -115,60 +446,447 @@ class DNSResolver():
                 elif resource_record.rdtype == dns.rdatatype.NS:
                     rrsets_dict["NS"] += [resource_record]
 
-        return rrsets_dict, ns_ip
+        return rrsets_dict
 
 
-    def resolve(self, hostname, type):
-        self.logs = []
-        self._log(f"Querying '{hostname}' for {type}-record\n")
-        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
+    def _referral(self, response, zone):
+        """  
+        @params:
+        - response: Dnspython dns.message object received from a nameserver
+        - zone: Zone served by the nameserver which sent the response. E.g: edu.
 
-        timestamp = self._current_timestamp()
-        start_time = time.time()
-
-        hostname = hostname.replace("https://","").replace("http://","").replace("www.","").rstrip(".")+"."
-        n = len(hostname.split("."))-1
-        i=0
-        while i<n:
-            if i==0:
-                nameservers = self.root_servers_ip
-
-            # Query the nameservers iteratively
-            rrsets, ns_ip = self._get_resource_records(hostname, self.rdatatype[type], nameservers)
-            self._log(f"Redirecting to {ns_ip}")
-
-            # Get the IP-addresses/URLs of the nameservers
-            A_records = rrsets.get("A", None)
-            NS_records = rrsets.get("NS", None)
-            if  A_records is not None :
-                nameservers = []
-                try:
-                    for i in range(len(A_records.items)):
-                        nameservers += [A_records.items[i].address]
-                except:
-                    nameservers = A_records
+        @function:
+        - Extract the zone cut from the NS records in the authority section
+        - Collect the glue addresses of those nameservers from the additional section.
+          Glue for names outside 'zone' is ignored, the server is not authoritative for it
+
+        @returns:
+        - delegation: Delegation object, or None if the response is not a referral
+        """
+        for rrset in response.authority:
+            if rrset.rdtype != dns.rdatatype.NS:
+                continue
+
+            nameservers = [ns_record.target.to_text().lower() for ns_record in rrset]
+            glue = defaultdict(list)
+            ttl = rrset.ttl
+            for additional in response.additional:
+                name = additional.name.to_text().lower()
+                if additional.rdtype == dns.rdatatype.A and name in nameservers \
+                        and additional.name.is_subdomain(dns.name.from_text(zone)):
+                    glue[name] += [a_record.address for a_record in additional]
+                    ttl = min(ttl, additional.ttl)
+
+            return Delegation(rrset.name.to_text().lower(), nameservers, dict(glue), ttl)
+
+        return None
+
+
+    def _delegation_servers(self, delegation):
+        """ Glue addresses of a delegation first, then the NS names which came without glue """
+        return delegation.addresses() + [ns for ns in delegation.nameservers if ns not in delegation.glue]
+
+
+    def _server_ip(self, server):
+        """  
+        @params:
+        - server: Ip address or name of a nameserver
+
+        @function:
+        - Look the nameserver up in the address cache, which is fed by glue from referrals
+        - On a miss, resolve the name iteratively (glueless delegation) and cache its addresses
+
+        @returns:
+        - server_ip: Ip address of the nameserver
+        """
+        if str(server).replace(".","").isnumeric():
+            return server
+
+        addresses = self.cache.get_addresses(server)
+        if addresses is not None:
+            return addresses.addresses[0]
+
+        # A nameserver whose address depends on itself can never be resolved
+        pending = getattr(self._local, "pending_nameservers", set())
+        if server in pending:
+            raise ResolutionError(server, [])
+
+        self._local.pending_nameservers = pending | {server}
+        start_time = time.monotonic()
+        try:
+            self._log("Resolving nameserver '%s'", server)
+            answer, _, _ = self._iterate(server, "A")
+            self._raise_negative(answer)
+        finally:
+            self._local.pending_nameservers = pending
+        self.metrics.observe("nameserver_lookup", time.monotonic() - start_time)
+
+        addresses = NameserverAddresses(server, [a_record.address for a_record in answer.records], answer.ttl)
+        self.cache.add_addresses(addresses)
+        return addresses.addresses[0]
+
+
+    def _cached_chain(self, hostname):
+        """ Cached delegations of the ancestors of 'hostname', starting with the TLD from the local root zone if any """
+        chain = self.cache.delegation_chain(hostname)
+        if self.root_zone is not None and (not chain or chain[0].zone.count(".") > 1):
+            tld = self.root_zone.referral(hostname)
+            if tld is not None:
+                chain = [tld] + chain
+        return chain
+
+
+    def _iterate(self, hostname, type):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+
+        @function:
+        - Start from the deepest delegation of 'hostname' present in the cache, or from the TLD referral
+          of the local root zone, or from the root
+        - Follow referrals downwards, caching every zone cut on the way, until a server answers
 
-            elif NS_records is not None:
-                nameservers = [ns_record.target for ns_record in NS_records]
+        @returns:
+        - answer: CachedAnswer object holding the records and their TTL (not yet added to the cache)
+        - redirection_history: (zone, ip address) of the nameserver queried per zone level, starting with the root.
+          Levels taken from the cache hold the tuple of their nameservers instead, their addresses are only looked
+          up if DNSSECResolver needs them, see DNSSECResolver._resolve_history
+        - main_response: Response which carried the answer
+        """
+        nameservers = self.root_servers_ip
+        zone = "."
+        redirection_history = []
+
+        # Skip the levels whose delegations are already cached
+        for delegation in self._cached_chain(hostname):
+            redirection_history += [(zone, tuple(nameservers))]
+            self._log("Cached delegation for '%s'", delegation.zone)
+            self._prefetch_delegation(delegation, zone, nameservers)
+            nameservers = self._delegation_servers(delegation)
+            zone = delegation.zone
+
+        for _ in range(self.max_referrals):
+            # Query the nameservers iteratively, concurrent lookups below the same zone cut share the query
+            start_time = time.monotonic()
+            rrsets, ns_ip, main_response = self.inflight.do(self._flight_key(hostname, type, zone),
+                lambda: self._get_resource_records(hostname, self.rdatatype[type], nameservers))
+            if not self._shared_response_usable(hostname, zone, main_response):
+                rrsets, ns_ip, main_response = self._get_resource_records(hostname, self.rdatatype[type], nameservers)
+            redirection_history += [(zone, ns_ip)]
+            self._record_hop(hostname, zone, ns_ip, main_response, time.monotonic() - start_time)
+
+            answer, delegation = self._follow(hostname, type, zone, rrsets, main_response, nameservers)
+            if answer is not None:
+                return answer, redirection_history, main_response
+
+            nameservers = self._delegation_servers(delegation)
+            zone = delegation.zone
+
+        raise ResolutionError(hostname, nameservers)
+
+
+    def _flight_key(self, hostname, type, zone):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+        - zone: Zone whose nameservers are about to be queried
+
+        @returns:
+        - key: Identifies upstream queries which can be shared. Below the final zone, every name under the
+          same child of 'zone' gets the same referral, so the key only holds that child. E.g: (edu., stonybrook.edu.)
+        """
+        labels = hostname.rstrip(".").split(".")
+        zone_labels = 0 if zone == "." else len(zone.rstrip(".").split("."))
+        child = ".".join(labels[len(labels)-zone_labels-1:])+"."
+        if child == hostname:
+            return (zone, hostname, type)
+        return (zone, child)
+
+
+    def _shared_response_usable(self, hostname, zone, main_response):
+        """ A response to a coalesced query for another name is only usable if it refers us towards 'hostname' """
+        if main_response.question[0].name == dns.name.from_text(hostname):
+            return True
+
+        delegation = self._referral(main_response, zone)
+        return len(main_response.answer) == 0 and delegation is not None \
+            and dns.name.from_text(hostname).is_subdomain(dns.name.from_text(delegation.zone))
+
+
+    def _follow(self, hostname, type, zone, rrsets, main_response, nameservers):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+        - zone: Zone served by the nameserver which sent 'main_response'
+        - rrsets, main_response: Output of '_get_resource_records'
+        - nameservers: Nameservers of 'zone', reported when resolution fails
+
+        @function:
+        - Decide whether 'main_response' answers the query or refers us to a child zone
+        - Cache the zone cut and its glue when it is a referral, only ever moving down towards 'hostname'
+
+        @returns:
+        - answer: CachedAnswer object if the response carries the records or is an authoritative
+          NXDOMAIN/NODATA, otherwise None
+        - delegation: Delegation object to follow if the response is a referral, otherwise None
+        """
+        records = rrsets.get(type, None)
+        if records is not None:
+            ttl = min(rrset.ttl for rrset in main_response.answer if rrset.rdtype == self.rdatatype[type])
+            return CachedAnswer(hostname, type, records, ttl), None
 
-            i+=1
-        
-        # In case of A and MX records, query the final authoritative nameserver to get the result
-        if type in ("A", "MX") and rrsets.get(type, None) is None:
-            rrsets, ns_ip = self._get_resource_records(hostname, self.rdatatype[type], nameservers)
+        answer = self._negative_answer(hostname, type, main_response)
+        if answer is not None:
+            return answer, None
 
-        records = "\n".join([record.to_text() for record in rrsets[type]])
-        response = str(records).rstrip("\n")
+        delegation = self._referral(main_response, zone)
+        if delegation is None or delegation.zone == zone \
+                or not dns.name.from_text(hostname).is_subdomain(dns.name.from_text(delegation.zone)) \
+                or not dns.name.from_text(delegation.zone).is_subdomain(dns.name.from_text(zone)):
+            raise ResolutionError(hostname, nameservers)
 
-        msg_size = sys.getsizeof(response)
-        end_time = time.time()
+        self.cache.add_delegation(delegation)
+        for nameserver, addresses in delegation.glue.items():
+            self.cache.add_addresses(NameserverAddresses(nameserver, addresses, delegation.ttl))
 
-        time_elapsed = int(round((end_time - start_time) * 1000)) 
+        return None, delegation
 
-        reply = f"\nQUESTION SECTION:\n{hostname}\t\tIN\t{type}\n\nANSWER SECTION:\n{response}\
-            \n\nQuery time: {time_elapsed} msec\nWHEN: {timestamp}\n\nMSG SIZE rcvd: {msg_size}\n"
 
-        self._log(reply)
-        self._flush_logs(hostname, type)
+    def _negative_answer(self, hostname, type, response):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+        - response: Response accepted by '_accept_response' which does not carry records of 'type'
+
+        @function:
+        - An NXDOMAIN, or an authoritative response with an empty answer section (NODATA), answers the query
+        - Following RFC 2308, the answer is cached for the smaller of the SOA TTL and the SOA minimum field.
+          Without a SOA record the answer is not cached at all
+
+        @returns:
+        - answer: Negative CachedAnswer object, or None if the response is neither
+        """
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            negative = "NXDOMAIN"
+        elif response.flags & dns.flags.AA and len(response.answer) == 0:
+            negative = "NODATA"
+        else:
+            return None
+
+        soa = next((rrset for rrset in response.authority if rrset.rdtype == dns.rdatatype.SOA), None)
+        ttl = min(soa.ttl, soa[0].minimum) if soa is not None else 0
+        return CachedAnswer(hostname, type, [], ttl, negative=negative, soa=soa)
+
+
+    def _raise_negative(self, answer):
+        """ Raise NXDomainError or NoDataError if 'answer' is a negative answer """
+        if answer.negative == "NXDOMAIN":
+            raise NXDomainError(answer.name)
+        if answer.negative == "NODATA":
+            raise NoDataError(answer.name, answer.type)
+
+
+    def _normalize(self, hostname):
+        return hostname.replace("https://","").replace("http://","").replace("www.","").rstrip(".").lower()+"."
+
+
+    def lookup(self, hostname, type):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot, taken as is. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+
+        @function:
+        - Answer from the cache, or resolve iteratively and cache the answer
+
+        @returns:
+        - answer: CachedAnswer object, its expiry tells how long the records remain valid.
+          NXDOMAIN and NODATA are returned as negative answers, see '_negative_answer'
+        """
+        answer = self.cache.get_answer(hostname, type)
+        if answer is not None:
+            self._cache_hit()
+            self._prefetch_answer(answer)
+        else:
+            self._cache_miss()
+            answer = self._refresh_or_stale(hostname, type)
+
+        return answer
+
+
+    def _stale_answer(self, hostname, type):
+        """ Expired answer which may be served stale, or None """
+        return self.cache.get_stale_answer(hostname, type)
+
+
+    def _serve_stale(self, stale):
+        """ Copy of the 'stale' answer, marked as such, which clients may cache for 'stale_ttl' seconds """
+        self._log("Serving stale answer for '%s'", stale.name)
+        self.metrics.increment("cache", "stale")
+        answer = CachedAnswer(stale.name, stale.type, stale.records, self.stale_ttl, self.cache.clock() + self.stale_ttl,
+                              stale.secure, stale.negative, stale.soa)
+        answer.stale = True
+        return answer
+
+
+    def _hold_stale(self, key):
+        with self._stale_lock:
+            self._stale_holds[key] = time.monotonic() + self.stale_refresh_time
+
+
+    def _refresh_or_stale(self, hostname, type):
+        """  
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+
+        @function:
+        - Resolve iteratively as '_refresh_answer' does when there is no stale answer to fall back on
+        - Otherwise, return the stale answer if resolution fails or takes more than 'stale_deadline'. A late
+          resolution goes on in the background and caches its answer, concurrent lookups of the name wait on it
+        - After a failure, the name is answered stale for 'stale_refresh_time' seconds without asking upstream
+
+        @returns:
+        - answer: CachedAnswer object, a stale copy if resolution did not succeed in time
+        """
+        stale = self._stale_answer(hostname, type)
+        if stale is None:
+            return self._refresh_answer(hostname, type)
+
+        key = (hostname, type)
+        with self._stale_lock:
+            if self._stale_holds.get(key, 0) > time.monotonic():
+                return self._serve_stale(stale)
+
+        if self.stale_deadline is None:
+            try:
+                answer = self._refresh_answer(hostname, type)
+            except Exception:
+                self._hold_stale(key)
+                return self._serve_stale(stale)
+            with self._stale_lock:
+                self._stale_holds.pop(key, None)
+            return answer
+
+        with self._stale_lock:
+            future = self._stale_refreshes.get(key, None)
+            if future is None:
+                future = self._stale_executor.submit(self._in_background, hostname, type, self._refresh_answer,
+                                                     hostname, type)
+                self._stale_refreshes[key] = future
+                future.add_done_callback(lambda _: self._stale_refreshes.pop(key, None))
+        try:
+            answer = future.result(timeout=self.stale_deadline)
+        except concurrent.futures.TimeoutError:
+            self._log("No answer for '%s' within %s seconds", hostname, self.stale_deadline)
+            return self._serve_stale(stale)
+        except Exception:
+            self._hold_stale(key)
+            return self._serve_stale(stale)
+
+        with self._stale_lock:
+            self._stale_holds.pop(key, None)
+        return answer
+
+
+    def _refresh_answer(self, hostname, type):
+        """ Resolve 'hostname' iteratively, whatever the cache holds for it, and cache the answer """
+        answer, _, _ = self._iterate(hostname, type)
+        self.cache.add_answer(answer)
+        return answer
+
+
+    def _refresh_delegation(self, zone, parent, nameservers):
+        """ Ask the nameservers of the 'parent' zone for the zone cut of 'zone' again, '_follow' caches it """
+        rrsets, _, main_response = self._get_resource_records(zone, dns.rdatatype.NS, nameservers)
+        self._follow(zone, "NS", parent, rrsets, main_response, nameservers)
+
+
+    def _in_background(self, hostname, type, function, *args):
+        """ Run 'function' in the current thread under a query context of its own, which is never logged """
+        self._local.context = QueryContext(hostname, type, False)
+        try:
+            return function(*args)
+        finally:
+            self._local.context = None
+
+
+    def _prefetch(self, key, hostname, type, function, *args):
+        """ Run 'function' in a prefetcher thread, see '_in_background' """
+        if self.prefetcher.submit(key, lambda: self._in_background(hostname, type, function, *args)):
+            self.metrics.increment("prefetch", key[0])
+
+
+    def _prefetch_answer(self, answer):
+        if self.prefetcher is not None and self.prefetcher.due(answer, self.cache.clock()):
+            self._prefetch(("answer", answer.name, answer.type), answer.name, answer.type,
+                           self._refresh_answer, answer.name, answer.type)
+
+
+    def _prefetch_delegation(self, delegation, parent, nameservers):
+        """ Refresh a popular zone cut from the nameservers of its 'parent' zone before it expires """
+        if self.prefetcher is not None and self.prefetcher.due(delegation, self.cache.clock()):
+            self._prefetch(("delegation", delegation.zone), delegation.zone, "NS",
+                           self._refresh_delegation, delegation.zone, parent, nameservers)
+
+
+    def resolve(self, hostname, type, structured=False):
+        """  
+        @params:
+        - hostname: Domain name to resolve. E.g: cs.stonybrook.edu
+        - type: string in ("A", "NS", "MX") determining the type of dns record
+        - structured: Return a ResolutionResult object instead of the formatted reply
+
+        @returns:
+        - reply: dig-style reply, or ResolutionResult object if 'structured' is set
+        """
+        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
+
+        hostname = self._normalize(hostname)
+
+        context = self._begin_query(hostname, type)
+        try:
+            answer = self.lookup(hostname, type)
+            self._raise_negative(answer)
+        except Exception as e:
+            self._end_query(context, error=e)
+            raise
+        self._end_query(context, answer)
+
+        result = ResolutionResult(context, answer)
+        return result if structured else "\n" + result.reply
+
+
+    def resolve_many(self, queries, max_workers=32, structured=False):
+        """  
+        @params:
+        - queries: Iterable of (hostname, type) tuples, consumed lazily
+        - max_workers: Number of lookups running at the same time
+        - structured: Yield ResolutionResult objects instead of formatted replies, see resolve()
+
+        @function:
+        - Resolve the queries concurrently in a thread pool. The lookups share the cache, and an upstream
+          query needed by several lookups at the same time is only sent once (see '_flight_key')
+        - Yield every result as soon as its lookup finishes, without waiting for the whole batch
+
+        @yields:
+        - (hostname, type, reply, error): 'reply' is the output of resolve(), 'error' the exception raised instead
+        """
+        queries = iter(queries)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            pending = {}
+            while True:
+                for hostname, type in itertools.islice(queries, 2*max_workers - len(pending)):
+                    pending[executor.submit(self.resolve, hostname, type, structured)] = (hostname, type)
+                if not pending:
+                    break
 
-        return reply
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    hostname, type = pending.pop(future)
+                    error = future.exception()
+                    yield hostname, type, None if error is not None else future.result(), error
@@ -1,49 +1,22 @@
-import datetime
-import sys
+import concurrent.futures
+import dns.dnssec
 import dns.query
-import dns.resolver
-import time
-import os
-from collections import defaultdict
-from dns_exceptions import *
+import dns.rdataclass
+from dnsresolver import *
+from dnssecverify import *
 
-class DNSSECResolver():
+class DNSSECResolver(DNSResolver):
 
-    def __init__(self) -> None:
-        self.root_servers_ip = ['198.41.0.4', '199.9.14.201', '192.33.4.12', '199.7.91.13', '192.203.230.10',\
-            '192.5.5.241', '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129',\
-            '199.7.83.42', '202.12.27.33']
+    # Number of DNSKEY/DS fetches of one chain of trust sent at the same time
+    max_fetches = 16
 
-        self.logs = []
+    def __init__(self, *args, verifier=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.want_dnssec = True
 
-        # Create a resolver object to resolve ips for the urls of the nameservers
-        self.resolver = dns.resolver.get_default_resolver()
-
-        dir =  os.path.dirname(os.path.abspath(__file__))
-        self.logs_path = os.path.join(dir,'logs')
-        if not os.path.exists(self.logs_path):
-            os.makedirs(self.logs_path)
-
-
-    def _log(self, msg):
-        self.logs += [msg]
-
-
-    def _flush_logs(self, hostname, type):
-        with open(self.logs_path+"/"+hostname+"-"+type+".txt", "w") as fp:
-            fp.write("\n".join(self.logs))
-
-
-    def _current_timestamp(self):
-        current_time_object = datetime.datetime.now()
-        weekday = current_time_object.strftime("%a")
-        month = current_time_object.strftime("%b")
-        date = current_time_object.strftime("%d")
-        time = current_time_object.strftime('%H:%M:%S')
-        year = current_time_object.strftime("%Y")
-        timestamp = f"{weekday} {month} {date} {time} {year}"
-        
-        return timestamp
+        # Signature checks and DS digests are memoized across resolvers unless a verifier is given explicitly
+        self.verifier = verifier if verifier is not None else default_verifier
+        self._fetch_executor = concurrent.futures.ThreadPoolExecutor(self.max_fetches)
 
 
     def _verify_ksk(self, zone_name, ksks, ds_response_from_parent):
@@ -55,48 +28,32 @@ class DNSSECResolver():
 
         @function:
         - Extract all hashed KSKs from the parent's DS record
-        - Hash all of the KSKs received from the DNSKEY record and compare them with every hashed KSK from the DS record
-        - On finding a match, break the loop and return True
+        - Compare the digest of every KSK received from the DNSKEY record with every hashed KSK from the DS record.
+          Digests are computed once per key and compared as raw bytes, see SignatureVerifier
         """
-        ds_rrsets = ds_response_from_parent.authority + [ds_response_from_parent.additional] + ds_response_from_parent.answer
+        ds_rrsets = ds_response_from_parent.authority + ds_response_from_parent.answer
         
         # Gather all the hashes in the DS record from the parent
         hashed_ksks_from_ds = []
-        digest_types = []
         for rrset in ds_rrsets:
             for rr in rrset:
                 if rr.rdtype == dns.rdatatype.DS:
                     hashed_ksks_from_ds += [rr]
-                    digest_types += [rr.digest_type]
 
-        # Determine the hashing algorithm used in the DS records and the hex digests of the hashes
-        hashing_algo = {1: "SHA1", 2: "SHA256"}
-        ds_record_hex_digests = [str(hashed_ksks_from_ds[i]).split(" ")[-1] for i in range(len(hashed_ksks_from_ds))]
-        
-        # For every ksk, hash it and compare it with all the hashes in the DS record
-        # On finding a match, break the loop and return true
-        match = False
-        for i, ds_record in enumerate(ds_record_hex_digests):
-            for ksk in ksks:
-                hash_ksk_calculated = dns.dnssec.make_ds(zone_name, ksk, hashing_algo[digest_types[i]])
-                hash_ksk_calculated_hex_digest = str(hash_ksk_calculated).split(" ")[-1]
-
-                if hash_ksk_calculated_hex_digest == ds_record:
-                    match = True
-                    break
-        
-        return match
+        return self.verifier.match_ds(zone_name, ksks, hashed_ksks_from_ds)
         
 
-    def _verify_rrset(self, zone_name, response, dnskey_response):
+    def _verify_rrset(self, zone_name, response, keys):
         """  
         @params:
-        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
+        - zone_name: Zone which signed the response. E.g: stonybrook.edu.
         - response: Response to the original DNS query for A/NS/MX records
-        - dnskey_response: Response to the DNSKEY query
+        - keys: DNSKEY RRSet of 'zone_name' whose chain of trust has been verified
 
         @function:
-        - Validate the RRSet and RRSig from the original response using the keys from the dnskey_response
+        - Validate the RRSet and RRSig from the original response using the keys of the zone
+        - An answer without any RRSig cannot be validated and fails. A negative answer (NXDOMAIN/NODATA)
+          needs a signed SOA and signed NSEC/NSEC3 records in its authority section
         """
         
         try:
@@ -105,23 +62,51 @@ class DNSSECResolver():
 
             for rrset in response.answer+response.authority:
                 if rrset.rdtype == dns.rdatatype.RRSIG:
-                    RRSigs[rrset.covers] = rrset
+                    RRSigs[(rrset.name, rrset.covers)] = rrset
                 else:
-                    RRSets[rrset.rdtype] = rrset
-
-            zsks_and_ksks = dnskey_response.answer[0]
-            zone_name = dns.name.from_text(zone_name)
-            record_types = list(RRSigs.keys())
+                    RRSets[(rrset.name, rrset.rdtype)] = rrset
+
+            signed_types = {record_type for _, record_type in RRSigs}
+            if response.answer:
+                if not any((rrset.name, rrset.rdtype) in RRSigs for rrset in response.answer):
+                    return False
+            elif dns.rdatatype.SOA not in signed_types or not signed_types & {dns.rdatatype.NSEC, dns.rdatatype.NSEC3}:
+                return False
             
-            for record_type in record_types:
-                dns.dnssec.validate(RRSets[record_type], RRSigs[record_type], {zone_name: zsks_and_ksks})
+            for key in RRSigs:
+                self.verifier.validate(RRSets[key], RRSigs[key], keys)
             
             return True
 
-        except dns.dnssec.ValidationFailure:
+        except (dns.dnssec.ValidationFailure, KeyError):
             return False
     
 
+    def _verify_ds(self, zone_name, ds_response, parent_zone, parent_keys):
+        """  
+        @params:
+        - zone_name: Zone whose DS record was queried. E.g: stonybrook.edu.
+        - ds_response: DS query response from the parent
+        - parent_zone, parent_keys: Parent zone and its DNSKEY RRSet, already proven secure
+
+        @function:
+        - Verify that the DS RRSet was signed by the parent, so that the hashed KSKs it holds can be trusted
+        """
+        try:
+            ds_rrset = ds_response.find_rrset(ds_response.answer, dns.name.from_text(zone_name),
+                dns.rdataclass.IN, dns.rdatatype.DS)
+        except KeyError:
+            raise NoDNSSECSupportError(zone_name)
+
+        try:
+            rrsig_ds = ds_response.find_rrset(ds_response.answer, dns.name.from_text(zone_name),
+                dns.rdataclass.IN, dns.rdatatype.RRSIG, dns.rdatatype.DS)
+            self.verifier.validate(ds_rrset, rrsig_ds, parent_keys)
+            return True
+        except (dns.dnssec.ValidationFailure, KeyError):
+            return False
+
+
     def _verify_zsk(self, zone_name, dnskey_response):
         """  
         @params:
@@ -132,204 +117,296 @@ class DNSSECResolver():
         - Sign ZSK with KSK and compare it with RRSig to verify 
         """
         try:
-            zsks_and_ksks = dnskey_response.answer[0]
-            rrsig_zsk = dnskey_response.answer[1]
-            dns.dnssec.validate(zsks_and_ksks, rrsig_zsk, {dns.name.from_text(zone_name): zsks_and_ksks})
+            zsks_and_ksks = dnskey_response.find_rrset(dnskey_response.answer, dns.name.from_text(zone_name),
+                dns.rdataclass.IN, dns.rdatatype.DNSKEY)
+            rrsig_zsk = dnskey_response.find_rrset(dnskey_response.answer, dns.name.from_text(zone_name),
+                dns.rdataclass.IN, dns.rdatatype.RRSIG, dns.rdatatype.DNSKEY)
+            self.verifier.validate(zsks_and_ksks, rrsig_zsk, zsks_and_ksks)
             return True
-        except dns.dnssec.ValidationFailure:
+        except (dns.dnssec.ValidationFailure, KeyError):
             return False
 
 
-    def _check_trust(self, zone_name, main_response, redirection_history):
-        """ 
+    def _fetch(self, zone_name, type, server_ip):
+        """
+        DNSKEY/DS query with the DO bit, over udp first. The RRSig records make these responses large, a truncated
+        response is fetched again over a pooled tcp connection, as is one which never came back over udp.
+        The root DNSKEY and the DS of the TLDs come from the local root zone when there is one
+        """
+        if self.root_zone is not None and zone_name.count(".") <= 1:
+            response = self.root_zone.response(zone_name, type)
+            if response is not None:
+                return response
+
+        query = self._make_query(zone_name, type, True)
+        start_time = time.monotonic()
+        try:
+            # Called by name, '_fetch' also runs in the executor of the asyncio resolver
+            response = DNSResolver._udp_exchange(self, query, server_ip)
+            response = DNSResolver._untruncate(self, query, server_ip, response)
+        except (dns.exception.DNSException, OSError, EOFError):
+            response = self.tcp_pool.query(query, server_ip, port=self.port, timeout=self.selector.max_timeout)
+        self.metrics.observe("dnssec_fetch", time.monotonic() - start_time, level=self._zone_level(zone_name), server=server_ip)
+        return response
+
+
+    def _fetch_all(self, fetches):
+        """  
         @params:
-        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
-        - main_response: Response to the original DNS query for A/NS/MX records
-        - redirection_history: List of all the IPs of the previous nameservers queried 
+        - fetches: Python list of (zone, type, ip) DNSKEY/DS queries
 
         @function:
-        - Get the ZSK, KSK and RRSig by sending the DNSKEY query to the final authoritative nameserver
-        - Trace the route upwards and verify the KSKs for each zone.
-        - If all the KSKs up the chain are valid, ZSK and RRSig can be consequently verified using it
-        - Verify ZSK for the domain using the validated KSK (chain of trust)
-        - Verify RRSet using ZSK for the domain
+        - Send all the queries at once, none of them depends on another one
+
+        @returns:
+        - responses: Python dictionary of responses indexed by (zone, type)
         """
-        n = len(redirection_history)-1
+        futures = {(zone, type): self._fetch_executor.submit(self._fetch, zone, type, server_ip)
+                   for zone, type, server_ip in fetches}
+        return {key: future.result() for key, future in futures.items()}
 
-        # Query FINAL authoritative nameserver for DNSKEY record 
-        # For querying DNSKEY records use tcp instead of udp otherwise you won't get RRsig record if you go with udp
-        dnskey_query = dns.message.make_query(zone_name, dns.rdatatype.DNSKEY, want_dnssec=True)
-        dnskey_response = dns.query.tcp(dnskey_query, redirection_history[n]) 
 
-        main_dnskey_response = dnskey_response
-        
-        # DNSSec is not enabled if response to the DNSKEY record is empty
-        if len(dnskey_response.answer)==0:
+    def _dnskey_rrset(self, zone_name, dnskey_response):
+        """ DNSKEY RRSet from a DNSKEY response. DNSSec is not enabled if the response is empty """
+        try:
+            return dnskey_response.find_rrset(dnskey_response.answer, dns.name.from_text(zone_name),
+                dns.rdataclass.IN, dns.rdatatype.DNSKEY)
+        except KeyError:
             raise NoDNSSECSupportError(zone_name)
 
-        # Traverse up the chain and verify the KSKs for each zone
-        for i in range(n, 1, -1):
-
-            # Get hashed KSK of the child from the parent via DS record
-            ds_query = dns.message.make_query(zone_name, dns.rdatatype.DS, want_dnssec=True)
-            ds_response = dns.query.tcp(ds_query, redirection_history[i-1])
-
-            # Extract KSK from the dnskey_response 
-            # ZSKs and KSKs are present in answer[0] and RRSig in answer[1]
-            ksks = []
-            for key in dnskey_response.answer[0]:
-                if key.flags == 257:
-                    ksks += [key]
-
-            # Verify KSK for the current zone
-            ksk_check = self._verify_ksk(zone_name, ksks, ds_response)
-            if not ksk_check:
-                raise KSKVerificationError(zone_name)
-                
-            # Query intermediate nameservers for the DNSKEY record to verify KSKS for all of them
-            dnskey_query = dns.message.make_query(zone_name, dns.rdatatype.DNSKEY, want_dnssec=True)
-            dnskey_response = dns.query.tcp(dnskey_query, redirection_history[i-1])
-        
-        # Verify ZSK for the final authoritative nameserver
-        zsk_check = self._verify_zsk(zone_name, main_dnskey_response)
-        if zsk_check==False: 
-            raise ZSKVerificationError(zone_name)
 
-        # Verify RRSet received as the response
-        rrset_check = self._verify_rrset(zone_name, main_response, main_dnskey_response)
-        if rrset_check==False: 
-            raise RRSetVerificationError(zone_name)
+    def _signature_ttl(self, response, ttl):
+        """ 'ttl' capped by the time left until the first RRSig of 'response' expires """
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.RRSIG:
+                ttl = min(ttl, rrset.ttl, *[rrsig.expiration - int(time.time()) for rrsig in rrset])
+        return max(ttl, 0)
 
 
-    def _query_server(self, zone_name, query, servers):
+    def _trusted_root_keys(self, root_ip, dnskey_response=None):
+        """ 
+        The root has no parent to vouch for its keys. As before, they are taken on trust,
+        after checking that the KSK signed the root DNSKEY RRSet
+        """
+        trusted = self.cache.get_trusted_keys(".")
+        if trusted is not None:
+            return trusted.keys
+
+        if dnskey_response is None:
+            dnskey_response = self._fetch(".", dns.rdatatype.DNSKEY, root_ip)
+        keys = self._dnskey_rrset(".", dnskey_response)
+        if not self._verify_zsk(".", dnskey_response):
+            raise ZSKVerificationError(".")
+
+        self.cache.add_trusted_keys(TrustedKeys(".", keys, self._signature_ttl(dnskey_response, keys.ttl)))
+        return keys
+
+
+    def _verify_zone(self, zone_name, dnskey_response, ds_response, parent_zone, parent_keys):
         """ 
         @params:
-        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
-        - query: Dnspython dns.message object, containing the query to be sent to the server
-        - servers: Python list of strings which are urls/ip-addresses of the nameservers
+        - zone_name: Zone whose link in the chain of trust is verified. E.g: stonybrook.edu.
+        - dnskey_response: Response to the DNSKEY query sent to the zone's nameserver
+        - ds_response: Response to the DS query sent to the parent's nameserver
+        - parent_zone, parent_keys: Parent zone and its DNSKEY RRSet, already proven secure
 
         @function:
-        - Selects a nameserver from 'servers'
-        - Determines the ip address of this nameserver
-        - Sends the query to this nameserver
-        - In case of failure, it retries everything by selecting the next server in the list
+        - Verify the DS RRSet with the parent's keys, a KSK of the zone against the DS and the ZSK with the KSK
+        - Cache the zone's keys, now proven secure
 
         @returns:
-        - response: Unprocessed/unfiltered response from the server
-        - ns_ip: Ip address of the name server selected and queried for the response
+        - keys: DNSKEY RRSet of the zone
         """
-        i=0
-        while True:
+        keys = self._dnskey_rrset(zone_name, dnskey_response)
+
+        # Extract KSK from the dnskey_response 
+        ksks = [key for key in keys if key.flags == 257]
+
+        # Verify KSK for the current zone, using the hashed KSKs signed by the parent
+        if not self._verify_ds(zone_name, ds_response, parent_zone, parent_keys) \
+                or not self._verify_ksk(zone_name, ksks, ds_response):
+            raise KSKVerificationError(zone_name)
+
+        # Verify ZSK for the current zone
+        if not self._verify_zsk(zone_name, dnskey_response):
+            raise ZSKVerificationError(zone_name)
+
+        ttl = min([keys.ttl] + [rrset.ttl for rrset in ds_response.answer])
+        self.cache.add_trusted_keys(TrustedKeys(zone_name, keys, self._signature_ttl(dnskey_response, ttl)))
+        return keys
+
+
+    def _trusted_level(self, redirection_history):
+        """ Index in 'redirection_history' of the deepest zone whose keys are already trusted, 0 for the root """
+        top = len(redirection_history)-1
+        while top > 0 and self.cache.get_trusted_keys(redirection_history[top][0]) is None:
+            top -= 1
+        return top
+
+
+    def _history_ip(self, zone, servers):
+        """ Address of one of the nameservers of 'zone', trying the next one when a glueless lookup fails """
+        for server in self._order_servers(servers):
             try:
-                # Check if 'servers' contain ip-addresses which are all numeric 
-                if not str(servers[0]).replace(".","").isnumeric():
-                    server_ip = self.resolver.resolve(servers[i]).rrset[0].to_text()
-                else:
-                    server_ip = servers[i] 
-                response = dns.query.udp(query, server_ip)
-                if response.rcode() != dns.rcode.NOERROR:
-                    i+=1
-                else:
-                    break
-            except IndexError:
-                raise ResolutionError(zone_name, servers)
-        return response, server_ip
+                return self._server_ip(server)
+            except ResolutionError:
+                continue
+        raise ResolutionError(zone, list(servers))
 
 
-    def _get_resource_records(self, zone_name, type, nameservers):  
-        """  
+    def _resolve_history(self, redirection_history):
+        """
         @params:
-        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
-        - type: string in ("A", "NS", "MX") determining the type of dns record
-        - nameservers: Python list of strings which are urls/ip-addresses of the nameservers
-
-        @function:
-        - Send the query for the 'zone_name'-'type' and get the response
-        - Organize the results in a python dictionary indexed by the record types
+        - redirection_history: Output of '_iterate', levels taken from the cache hold a tuple of nameservers
 
         @returns:
-        - rrsets_dict: Dictionary containing resource records indexed by the record types 
-        - ns_ip: Ip address of the name server selected and queried for the response
+        - redirection_history: List of (zone, ip) as '_check_trust' needs it. Only the levels below the deepest
+          zone already trusted get an address, the ones above are never queried
         """
-        main_query = dns.message.make_query(zone_name, type, want_dnssec=True)
-        
-        main_response, ns_ip = self._query_server(zone_name, main_query, nameservers)
-        rrsets = main_response.authority + main_response.answer
+        top = self._trusted_level(redirection_history)
+        return [(zone, self._history_ip(zone, server) if isinstance(server, tuple) and i >= top else server)
+                for i, (zone, server) in enumerate(redirection_history)]
 
-        rrsets_dict = defaultdict(list)
 
-        for rrset in rrsets:
-            for resource_record in rrset:
-                if resource_record.rdtype == dns.rdatatype.A:
-                    rrsets_dict["A"] += [resource_record]
-                elif resource_record.rdtype == dns.rdatatype.MX:
-                    rrsets_dict["MX"] += [resource_record]
-                elif resource_record.rdtype in (dns.rdatatype.NS, dns.rdatatype.CNAME):
-                    rrsets_dict["NS"] += [resource_record]
+    def _check_trust(self, zone_name, main_response, redirection_history):
+        """ 
+        @params:
+        - zone_name: Complete domain name rather than zones. E.g: cs.stonybrook.edu
+        - main_response: Response to the original DNS query for A/NS/MX records
+        - redirection_history: List of (zone, ip) of a nameserver for every zone level, root first, see '_resolve_history'
 
-        return rrsets_dict, ns_ip, main_response
+        @function:
+        - Trace the route upwards from the zone which signed the answer, until a zone whose keys are
+          already proven secure (cached). Only the links below it need to be verified
+        - Get the DNSKEY of each of these zones and the DS from its parent, all at the same time
+        - Going back down, verify the KSKs and ZSK (chain of trust) over the collected responses and cache the keys
+        - Verify RRSet using the keys of the zone which signed it
+        """
+        start_time = time.monotonic()
+
+        # Find the deepest zone whose keys are already trusted
+        top = self._trusted_level(redirection_history)
+        trusted = self.cache.get_trusted_keys(redirection_history[top][0]) if top > 0 else None
+        if (top > 0 and trusted is None) or any(isinstance(ip, tuple) for _, ip in redirection_history[top:]):
+            # The trusted keys expired since '_resolve_history' looked up the addresses
+            raise KSKVerificationError(redirection_history[top][0])
+
+        # Fetch everything the links below it need concurrently
+        fetches = []
+        if top == 0 and self.cache.get_trusted_keys(".") is None:
+            fetches += [(".", dns.rdatatype.DNSKEY, redirection_history[0][1])]
+        for i in range(top+1, len(redirection_history)):
+            zone, ns_ip = redirection_history[i]
+            parent_ip = redirection_history[i-1][1]
+            fetches += [(zone, dns.rdatatype.DNSKEY, ns_ip), (zone, dns.rdatatype.DS, parent_ip)]
+        responses = self._fetch_all(fetches)
+
+        if top == 0:
+            keys = self._trusted_root_keys(redirection_history[0][1], responses.get((".", dns.rdatatype.DNSKEY), None))
+        else:
+            keys = trusted.keys
+
+        # Traverse down the chain and verify the KSKs and ZSKs for each zone
+        for i in range(top+1, len(redirection_history)):
+            zone = redirection_history[i][0]
+            parent_zone = redirection_history[i-1][0]
+            keys = self._verify_zone(zone, responses[(zone, dns.rdatatype.DNSKEY)], responses[(zone, dns.rdatatype.DS)],
+                parent_zone, keys)
+
+        # Verify RRSet received as the response
+        rrset_check = self._verify_rrset(redirection_history[-1][0], main_response, keys)
+        if rrset_check==False: 
+            raise RRSetVerificationError(zone_name)
 
+        self.metrics.observe("dnssec_validate", time.monotonic() - start_time, level=self._zone_level(redirection_history[-1][0]))
 
-    def resolve(self, hostname, type):
-        self.logs = []
-        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
 
-        rdatatype = {"A":dns.rdatatype.A, "NS": dns.rdatatype.NS, "MX": dns.rdatatype.MX}
+    def lookup(self, hostname, type):
+        """ DNSResolver.lookup, A and MX answers are only returned once their chain of trust is verified """
+        # Only answers which went through the chain of trust can be reused, NS records are never validated
+        answer = self.cache.get_answer(hostname, type)
+        if answer is not None and (answer.secure or type == "NS"):
+            self._cache_hit()
+            self._prefetch_answer(answer)
+            return answer
 
-        timestamp = self._current_timestamp()
-        start_time = time.time()
+        answer = self._denied_answer(hostname, type)
+        if answer is not None:
+            self._cache_hit()
+        else:
+            self._cache_miss()
+            answer = self._refresh_or_stale(hostname, type)
 
-        hostname = hostname.replace("https://","").replace("http://","").replace("www.","").rstrip(".")+"."
-        n = len(hostname.split("."))-1
+        return answer
 
-        i=0
-        redirection_history = []
-        main_response = None
-        while i<n:
-            
-            if i==0:
-                nameservers = self.root_servers_ip
-
-            # Query the nameservers iteratively
-            rrsets, ip, main_response = self._get_resource_records(hostname, rdatatype[type], nameservers)
-            redirection_history += [ip]
-
-            # Get the IP-addresses/URLs of the nameservers
-            A_records = rrsets.get("A", None)
-            NS_records = rrsets.get("NS", None)
-            if  A_records is not None :
-                nameservers = []
-                try:
-                    for i in range(len(A_records.items)):
-                        nameservers += [A_records.items[i].address]
-                except:
-                    nameservers = A_records
-
-            elif NS_records is not None:
-                nameservers = [ns_record.target for ns_record in NS_records]
-
-            i+=1
-        
-        # In case of A and MX records, query the final authoritative nameserver to get the result
-        # Run DNSSec on top of DNS
-        if type in ("A", "MX") and rrsets.get(type, None) is None:
-            rrsets, ip, main_response = self._get_resource_records(hostname, rdatatype[type], nameservers)
-            redirection_history += [ip]
-            self._check_trust(hostname, main_response, redirection_history)
-            
-        elif type in ("A", "MX") and rrsets.get(type, None) is not None:
-            self._check_trust(hostname, main_response, redirection_history)
 
-        records = "\n".join([record.to_text() for record in rrsets[type]])
-        response = str(records).rstrip("\n")
+    def _denied_answer(self, hostname, type):
+        """ Negative answer synthesized from the cached NSEC/NSEC3 ranges (RFC 8198), or None """
+        denial = self.cache.get_denial(hostname, type)
+        if denial is None:
+            return None
+        negative, soa, ttl = denial
+        self._log("Denied by cached NSEC records")
+        return CachedAnswer(hostname, type, [], ttl, self.cache.clock() + ttl, True, negative, soa)
 
-        msg_size = sys.getsizeof(response)
-        end_time = time.time()
 
-        time_elapsed = int(round((end_time - start_time) * 1000)) 
+    def _learn_denials(self, answer, zone_name, main_response):
+        """
+        @params:
+        - answer: Negative CachedAnswer whose response went through the chain of trust
+        - zone_name: Zone which signed the response
+        - main_response: Response which carried the answer
 
-        reply = f"QUESTION SECTION:\n{hostname}\t\tIN\t{type}\n\nANSWER SECTION:\n{response}\
-            \n\nQuery time: {time_elapsed} msec\nWHEN: {timestamp}\n\nMSG SIZE rcvd: {msg_size}\n"
+        @function:
+        - Cache the NSEC/NSEC3 records of the authority section, their signatures are valid. They may be used
+          as long as the negative answer itself and until the first of their signatures expires
+        """
+        signatures = {(rrset.name, rrset.covers): rrset for rrset in main_response.authority
+                      if rrset.rdtype == dns.rdatatype.RRSIG}
+        for rrset in main_response.authority:
+            rrsig = signatures.get((rrset.name, rrset.rdtype), None)
+            if rrset.rdtype not in (dns.rdatatype.NSEC, dns.rdatatype.NSEC3) or rrsig is None:
+                continue
+            ttl = min([answer.ttl, rrset.ttl] + [signature.expiration - int(time.time()) for signature in rrsig])
+            if ttl > 0:
+                self.cache.add_denial(zone_name, answer.soa, rrset, ttl)
+
+
+    def _stale_answer(self, hostname, type):
+        """ DNSResolver._stale_answer, only answers which went through the chain of trust are served stale """
+        answer = self.cache.get_stale_answer(hostname, type)
+        if answer is not None and (answer.secure or type == "NS"):
+            return answer
+        return None
+
+
+    def _refresh_answer(self, hostname, type):
+        """ DNSResolver._refresh_answer, A and MX answers (negative ones too) go through the chain of trust before being cached """
+        answer, redirection_history, main_response = self._iterate(hostname, type)
+
+        # Run DNSSec on top of DNS, negative answers are proven by the signed SOA and NSEC records
+        if type in ("A", "MX"):
+            self._check_trust(hostname, main_response, self._resolve_history(redirection_history))
+            answer.secure = True
+            if answer.negative is not None:
+                self._learn_denials(answer, redirection_history[-1][0], main_response)
+        self.cache.add_answer(answer)
+        return answer
+
+
+    def resolve(self, hostname, type, structured=False):
+        if type not in ("A", "NS", "MX"): raise ResourceRecordTypeError(type)
 
-        return reply
+        hostname = self._normalize(hostname)
 
+        context = self._begin_query(hostname, type)
+        try:
+            answer = self.lookup(hostname, type)
+            self._raise_negative(answer)
+        except Exception as e:
+            self._end_query(context, error=e)
+            raise
+        self._end_query(context, answer)
+
+        result = ResolutionResult(context, answer)
+        return result if structured else result.reply
@@ -0,0 +1,150 @@
+import concurrent.futures
+import threading
+import time
+from collections import OrderedDict, defaultdict
+import dns.dnssec
+import dns.name
+import dns.rdataclass
+import dns.rrset
+
+# Digest types of DS records understood by dns.dnssec.make_ds
+DIGEST_TYPES = {1: "SHA1", 2: "SHA256", 4: "SHA384"}
+
+
+def _rrset_args(rrset):
+    """ Picklable form of an RRSet, for the worker processes """
+    return rrset.name.to_text(), rrset.ttl, rrset.rdtype, [rdata.to_text() for rdata in rrset]
+
+
+def _rrset_from_args(name, ttl, rdtype, texts):
+    return dns.rrset.from_text_list(name, ttl, dns.rdataclass.IN, rdtype, texts)
+
+
+def _validate_in_worker(rrset_args, rrsigs_args, keys_args):
+    """ Runs in a worker process: True if one of the RRSigs of the RRSet validates with the keys """
+    keys = _rrset_from_args(*keys_args)
+    try:
+        dns.dnssec.validate(_rrset_from_args(*rrset_args), _rrset_from_args(*rrsigs_args), {keys.name: keys})
+        return True
+    except dns.dnssec.ValidationFailure:
+        return False
+
+
+class SignatureVerifier():
+    """
+    Memoizing layer over dns.dnssec, shared by the DNSSEC resolvers.
+
+    - DS digests are computed once per (zone, key, digest type) and compared as raw bytes
+    - Results of RRSet validations are remembered per (RRSet, RRSigs, keys) until the first of
+      the signatures expires, failures for 'failure_ttl' seconds
+    - With 'processes' > 0, signature checks which are not memoized run in a process pool,
+      so validation does not serialize on one core under load
+    """
+
+    def __init__(self, max_entries=10000, failure_ttl=60, processes=0, clock=time.time) -> None:
+        self.max_entries = max_entries
+        self.failure_ttl = failure_ttl
+        self.clock = clock
+        self.stats = defaultdict(int)
+
+        self._digests = OrderedDict()
+        self._validations = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ProcessPoolExecutor(processes) if processes > 0 else None
+
+
+    def _remember(self, table, key, value):
+        with self._lock:
+            table[key] = value
+            table.move_to_end(key)
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+
+
+    def ds_digest(self, zone_name, key, digest_type):
+        """ Raw digest of 'key' for a DS record of type 'digest_type' """
+        memo_key = (zone_name.lower(), key.to_digestable(), digest_type)
+        with self._lock:
+            digest = self._digests.get(memo_key, None)
+            if digest is not None:
+                self._digests.move_to_end(memo_key)
+                self.stats["digest_hits"] += 1
+                return digest
+
+        self.stats["digest_misses"] += 1
+        digest = dns.dnssec.make_ds(zone_name, key, DIGEST_TYPES[digest_type]).digest
+        self._remember(self._digests, memo_key, digest)
+        return digest
+
+
+    def match_ds(self, zone_name, ksks, ds_records):
+        """
+        @params:
+        - zone_name: Zone of the keys. E.g: stonybrook.edu.
+        - ksks: Python list of the KSKs received in the DNSKEY record
+        - ds_records: Python list of the DS records received from the parent
+
+        @returns:
+        - match: True if one of the KSKs hashes to one of the DS records
+        """
+        for ds in ds_records:
+            if ds.digest_type not in DIGEST_TYPES:
+                continue
+            for ksk in ksks:
+                if ksk.algorithm != ds.algorithm or dns.dnssec.key_id(ksk) != ds.key_tag:
+                    continue
+                if self.ds_digest(zone_name, ksk, ds.digest_type) == ds.digest:
+                    return True
+        return False
+
+
+    def validate(self, rrset, rrsigs, keys):
+        """
+        @params:
+        - rrset: RRSet to validate
+        - rrsigs: RRSet of the RRSigs covering 'rrset'
+        - keys: DNSKEY RRSet of the zone which signed 'rrset'
+
+        @function:
+        - Same contract as dns.dnssec.validate, raises dns.dnssec.ValidationFailure if no RRSig validates
+        """
+        memo_key = (rrset.name.canonicalize(), rrset.rdtype,
+                    frozenset(rdata.to_digestable() for rdata in rrset),
+                    frozenset(rrsig.to_digestable() for rrsig in rrsigs),
+                    frozenset(key.to_digestable() for key in keys))
+
+        now = self.clock()
+        with self._lock:
+            memo = self._validations.get(memo_key, None)
+            if memo is not None and memo[1] > now:
+                self._validations.move_to_end(memo_key)
+                self.stats["validation_hits"] += 1
+                valid = memo[0]
+            else:
+                valid = None
+
+        if valid is None:
+            self.stats["validation_misses"] += 1
+            if self._pool is not None:
+                valid = self._pool.submit(_validate_in_worker, _rrset_args(rrset), _rrset_args(rrsigs), _rrset_args(keys)).result()
+            else:
+                try:
+                    dns.dnssec.validate(rrset, rrsigs, {keys.name: keys})
+                    valid = True
+                except dns.dnssec.ValidationFailure:
+                    valid = False
+
+            expires = min(rrsig.expiration for rrsig in rrsigs) if valid else now + self.failure_ttl
+            self._remember(self._validations, memo_key, (valid, expires))
+
+        if not valid:
+            raise dns.dnssec.ValidationFailure("no RRSIG validated")
+
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+# Verifier shared by every DNSSEC resolver which is not given a verifier of its own
+default_verifier = SignatureVerifier()
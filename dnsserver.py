@@ -0,0 +1,275 @@
+import asyncio
+import random
+import struct
+import time
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.opcode
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+from collections import defaultdict
+from asyncresolver import *
+
+# Largest UDP response sent to a client which does not advertise an EDNS buffer size
+CLASSIC_UDP_SIZE = 512
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, addr):
+        self.server._spawn(self._answer(data, addr))
+
+
+    async def _answer(self, data, addr):
+        wire = await self.server.handle(data, tcp=False)
+        if wire is not None:
+            self.transport.sendto(wire, addr)
+
+
+class DNSServer():
+    """
+    Recursive DNS server on top of AsyncDNSResolver/AsyncDNSSECResolver.
+
+    - Stub queries are accepted over UDP and TCP (length-prefixed, pipelined, RFC 7766) on one address
+    - Answers come from the resolver's cache, misses are resolved iteratively on the event loop,
+      at most 'max_concurrency' of them at the same time
+    - The TTLs sent to clients count down with the cache, so downstream caches never outlive it
+    - Queries per transport and responses per rcode are counted in the resolver's metrics, which can be
+      scraped in the Prometheus text format from http://<metrics address>/metrics, see start_metrics()
+    """
+
+    def __init__(self, resolver, host="127.0.0.1", port=5353, max_concurrency=1000, tcp_idle_timeout=10.0) -> None:
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self.metrics = resolver.metrics
+
+        self._semaphore = None
+        self._tasks = set()
+        self._udp_transport = None
+        self._tcp_server = None
+        self._metrics_server = None
+
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+    def _error(self, query, rcode):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        response.set_rcode(rcode)
+        return response
+
+
+    async def _answer(self, query):
+        """
+        @params:
+        - query: Dnspython dns.message object received from a client
+
+        @returns:
+        - response: Dnspython dns.message object to send back
+        """
+        if query.opcode() != dns.opcode.QUERY or len(query.question) != 1:
+            return self._error(query, dns.rcode.NOTIMP if query.opcode() != dns.opcode.QUERY else dns.rcode.FORMERR)
+
+        question = query.question[0]
+        type = dns.rdatatype.to_text(question.rdtype)
+        if type not in self.resolver.rdatatype:
+            return self._error(query, dns.rcode.NOTIMP)
+
+        hostname = question.name.to_text().lower()
+        context = self.resolver._begin_query(hostname, type)
+        try:
+            async with self._semaphore:
+                answer = await self.resolver.lookup(hostname, type)
+        except Exception as e:
+            self.resolver._end_query(context, error=e)
+            return self._error(query, dns.rcode.SERVFAIL)
+        self.resolver._end_query(context, answer)
+
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        if answer.secure:
+            response.flags |= dns.flags.AD
+
+        ttl = max(int(answer.expires - self.resolver.cache.clock()), 0)
+        if answer.negative is not None:
+            # The SOA lets the client cache the negative answer as well (RFC 2308)
+            if answer.negative == "NXDOMAIN":
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            if answer.soa is not None:
+                response.authority.append(dns.rrset.from_rdata_list(answer.soa.name, ttl, answer.soa))
+            return response
+
+        response.answer.append(dns.rrset.from_rdata_list(question.name, ttl, answer.records))
+        return response
+
+
+    async def handle(self, wire, tcp):
+        """
+        @params:
+        - wire: Query received from a client, in wire format
+        - tcp: Whether the query came over TCP, UDP responses are truncated to the client's buffer size
+
+        @returns:
+        - wire: Response in wire format, or None if the query could not be parsed at all
+        """
+        self.metrics.increment("server_queries", "tcp" if tcp else "udp")
+        try:
+            query = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            self.metrics.increment("server_malformed")
+            return None
+
+        response = await self._answer(query)
+        self.metrics.increment("server_responses", dns.rcode.to_text(response.rcode()))
+
+        max_size = 65535 if tcp else max(query.payload if query.edns >= 0 else 0, CLASSIC_UDP_SIZE)
+        try:
+            return response.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            # Send the header alone with TC set, the client will retry over TCP
+            self.metrics.increment("server_truncated")
+            response.answer = []
+            response.flags |= dns.flags.TC
+            return response.to_wire(max_size=max_size)
+
+
+    async def _serve_tcp(self, reader, writer):
+        """ One TCP client, every query it pipelines is answered as soon as it is resolved """
+        try:
+            while True:
+                header = await asyncio.wait_for(reader.readexactly(2), self.tcp_idle_timeout)
+                (length,) = struct.unpack("!H", header)
+                self._spawn(self._answer_tcp(await reader.readexactly(length), writer))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def _answer_tcp(self, data, writer):
+        wire = await self.handle(data, tcp=True)
+        if wire is not None and not writer.is_closing():
+            writer.write(struct.pack("!H", len(wire)) + wire)
+
+
+    async def start(self):
+        """ Bind the UDP and TCP listeners """
+        loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._udp_transport, _ = await loop.create_datagram_endpoint(lambda: _UDPProtocol(self), local_addr=(self.host, self.port))
+        self._tcp_server = await asyncio.start_server(self._serve_tcp, self.host, self.port)
+
+
+    async def _serve_metrics(self, reader, writer):
+        """ Minimal HTTP/1.0 responder for Prometheus scrapes """
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.tcp_idle_timeout)
+            while (await asyncio.wait_for(reader.readline(), self.tcp_idle_timeout)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                body = self.metrics.prometheus().encode()
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            else:
+                writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def start_metrics(self, host, port):
+        """ Serve the resolver's metrics over HTTP on host:port """
+        self._metrics_server = await asyncio.start_server(self._serve_metrics, host, port)
+
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._tcp_server.serve_forever()
+        finally:
+            self.close()
+
+
+    def close(self):
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+
+async def load_test(target, names, type="A", duration=10.0, concurrency=100, timeout=2.0, tcp=False):
+    """
+    @params:
+    - target: (ip address, port) of the server under test
+    - names: Python list of the domain names to query, picked at random
+    - type: string in ("A", "NS", "MX") determining the type of dns record
+    - duration: Seconds during which queries are sent
+    - concurrency: Number of clients, each waits for its response before sending the next query
+    - timeout: Seconds after which a query counts as lost
+    - tcp: Send the queries over TCP instead of UDP
+
+    @returns:
+    - report: Python dictionary with the sustained QPS, latency percentiles in msec and responses per rcode
+    """
+    latencies = []
+    rcodes = defaultdict(int)
+    deadline = time.monotonic() + duration
+
+    async def client():
+        while time.monotonic() < deadline:
+            query = dns.message.make_query(random.choice(names), type)
+            start_time = time.monotonic()
+            try:
+                if tcp:
+                    response = await dns.asyncquery.tcp(query, target[0], timeout=timeout, port=target[1])
+                else:
+                    response = await dns.asyncquery.udp(query, target[0], timeout=timeout, port=target[1])
+            except (dns.exception.DNSException, OSError, EOFError):
+                rcodes["TIMEOUT"] += 1
+                continue
+            latencies.append(time.monotonic() - start_time)
+            rcodes[dns.rcode.to_text(response.rcode())] += 1
+
+    start_time = time.monotonic()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start_time
+
+    latencies.sort()
+    def percentile(p):
+        return round(latencies[min(int(p * len(latencies)), len(latencies)-1)] * 1000, 3) if latencies else None
+
+    return {
+        "queries": len(latencies) + rcodes["TIMEOUT"],
+        "answered": len(latencies),
+        "qps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "rcodes": dict(rcodes),
+    }
@@ -0,0 +1,386 @@
+import random
+import socket
+import struct
+import threading
+import time
+import dns.dnssec
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdataset
+import dns.rdatatype
+import dns.rdtypes.ANY.DNSKEY
+import dns.rdtypes.ANY.RRSIG
+import dns.rrset
+import dns.zone
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+
+
+class ZoneKey():
+    """ ECDSAP256SHA256 signing key of a zone, with its DNSKEY record """
+
+    def __init__(self, flags):
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        numbers = self.private_key.public_key().public_numbers()
+        self.dnskey = dns.rdtypes.ANY.DNSKEY.DNSKEY(dns.rdataclass.IN, dns.rdatatype.DNSKEY, flags, 3,
+            dns.dnssec.ECDSAP256SHA256, numbers.x.to_bytes(32, "big") + numbers.y.to_bytes(32, "big"))
+        self.key_tag = dns.dnssec.key_id(self.dnskey)
+
+
+    def sign(self, name, rdataset, signer, inception, expiration):
+        """ RRSIG rdata over 'rdataset' owned by 'name', see RFC 4034 section 3.1.8.1 """
+        unsigned = dns.rdtypes.ANY.RRSIG.RRSIG(dns.rdataclass.IN, dns.rdatatype.RRSIG, rdataset.rdtype,
+            dns.dnssec.ECDSAP256SHA256, len(name) - 1, rdataset.ttl, expiration, inception, self.key_tag,
+            signer, b"")
+
+        data = unsigned.to_wire(origin=None)[:18] + signer.to_digestable()
+        rrfixed = struct.pack("!HHI", rdataset.rdtype, rdataset.rdclass, rdataset.ttl)
+        for rdata in sorted(rdata.to_digestable() for rdata in rdataset):
+            data += name.to_digestable() + rrfixed + struct.pack("!H", len(rdata)) + rdata
+
+        r, s = utils.decode_dss_signature(self.private_key.sign(data, ec.ECDSA(hashes.SHA256())))
+        return unsigned.replace(signature=r.to_bytes(32, "big") + s.to_bytes(32, "big"))
+
+
+def sign_zone(zone, ksk, zsk, validity=86400):
+    """ Add DNSKEY, NSEC and RRSIG records to 'zone'. Delegations and their glue are left unsigned """
+    origin = zone.origin
+    inception = int(time.time()) - 3600
+    expiration = inception + validity
+
+    zone.find_rdataset(origin, dns.rdatatype.DNSKEY, create=True).update(
+        dns.rdataset.from_rdata_list(3600, [ksk.dnskey, zsk.dnskey]))
+
+    # Names at or below a delegation point, other than the point itself, are not authoritative
+    cuts = [name for name, node in zone.nodes.items() if name != origin
+            and node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.NS) is not None]
+    def authoritative(name):
+        return not any(name != cut and name.is_subdomain(cut) for cut in cuts)
+
+    names = sorted(name for name in zone.nodes if authoritative(name))
+    for i, name in enumerate(names):
+        node = zone.nodes[name]
+        types = sorted({rdataset.rdtype for rdataset in node.rdatasets} | {dns.rdatatype.RRSIG, dns.rdatatype.NSEC})
+        next_name = names[(i+1) % len(names)]
+        nsec = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.NSEC,
+            next_name.to_text() + " " + " ".join(dns.rdatatype.to_text(t) for t in types))
+        zone.find_rdataset(name, dns.rdatatype.NSEC, create=True).update(dns.rdataset.from_rdata_list(300, [nsec]))
+
+    for name in names:
+        for rdataset in list(zone.nodes[name].rdatasets):
+            if rdataset.rdtype == dns.rdatatype.RRSIG:
+                continue
+            if name != origin and rdataset.rdtype == dns.rdatatype.NS:
+                continue
+            key = ksk if rdataset.rdtype == dns.rdatatype.DNSKEY else zsk
+            rrsig = key.sign(name, rdataset, origin, inception, expiration)
+            zone.find_rdataset(name, dns.rdatatype.RRSIG, rdataset.rdtype, create=True).add(rrsig, rdataset.ttl)
+
+
+class FakeNameserver():
+    """
+    Authoritative nameserver for a set of zones, listening on UDP and TCP on (ip, port).
+    Simulates the network with a per-response 'delay' plus up to 'jitter' seconds, drops a
+    'loss' fraction of UDP queries, and sets the TC bit on every UDP response if 'truncate'.
+    UDP responses larger than the payload size advertised by the query (512 bytes without EDNS)
+    are truncated as well. With 'no_edns', queries carrying EDNS get FORMERR like from old servers.
+    """
+
+    def __init__(self, ip, port, zones, delay=0.0, jitter=0.0, loss=0.0, truncate=False, no_edns=False):
+        self.ip = ip
+        self.port = port
+        self.zones = zones
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.truncate = truncate
+        self.no_edns = no_edns
+        self.queries = 0
+        self._sockets = []
+
+
+    def _zone_for(self, qname):
+        best = None
+        for zone in self.zones:
+            if qname.is_subdomain(zone.origin) and (best is None or len(zone.origin) > len(best.origin)):
+                best = zone
+        return best
+
+
+    def _add(self, section, zone, name, rdtype, dnssec, covers=dns.rdatatype.NONE):
+        rdataset = zone.get_rdataset(name, rdtype, covers)
+        if rdataset is None:
+            return False
+        section.append(dns.rrset.from_rdata_list(name, rdataset.ttl, list(rdataset)))
+        if dnssec and rdtype != dns.rdatatype.RRSIG:
+            self._add(section, zone, name, dns.rdatatype.RRSIG, False, rdtype)
+        return True
+
+
+    def _covering_nsec(self, zone, name):
+        """ Owner of the NSEC record whose range covers 'name' """
+        owners = sorted(owner for owner, node in zone.nodes.items()
+                        if node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.NSEC) is not None)
+        covering = owners[-1]
+        for owner in owners:
+            if owner < name:
+                covering = owner
+        return covering
+
+
+    def answer(self, query):
+        self.queries += 1
+        question = query.question[0]
+        qname, qtype = question.name, question.rdtype
+        dnssec = query.ednsflags & dns.flags.DO != 0
+        response = dns.message.make_response(query)
+        if self.no_edns and query.edns >= 0:
+            response.use_edns(False)
+            response.set_rcode(dns.rcode.FORMERR)
+            return response
+
+        zone = self._zone_for(qname)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+
+        # Referral if 'qname' is at or below a delegation point of the zone (DS is answered by the parent)
+        for k in range(len(zone.origin)+1, len(qname)+1):
+            cut = dns.name.Name(qname.labels[-k:])
+            ns = zone.get_rdataset(cut, dns.rdatatype.NS)
+            if ns is None or (cut == qname and qtype == dns.rdatatype.DS):
+                continue
+            self._add(response.authority, zone, cut, dns.rdatatype.NS, False)
+            if dnssec and not self._add(response.authority, zone, cut, dns.rdatatype.DS, True):
+                self._add(response.authority, zone, cut, dns.rdatatype.NSEC, True)
+            for rdata in ns:
+                self._add(response.additional, zone, rdata.target, dns.rdatatype.A, False)
+            return response
+
+        response.flags |= dns.flags.AA
+        node = zone.get_node(qname)
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            self._add(response.authority, zone, zone.origin, dns.rdatatype.SOA, dnssec)
+            if dnssec:
+                proofs = {self._covering_nsec(zone, qname), self._covering_nsec(zone, dns.name.from_text("*", zone.origin))}
+                for owner in sorted(proofs):
+                    self._add(response.authority, zone, owner, dns.rdatatype.NSEC, True)
+            return response
+
+        if not self._add(response.answer, zone, qname, qtype, dnssec) and \
+                not self._add(response.answer, zone, qname, dns.rdatatype.CNAME, dnssec):
+            self._add(response.authority, zone, zone.origin, dns.rdatatype.SOA, dnssec)
+            if dnssec:
+                self._add(response.authority, zone, qname, dns.rdatatype.NSEC, True)
+        return response
+
+
+    def _wait(self):
+        pause = self.delay + random.uniform(0, self.jitter)
+        if pause > 0:
+            time.sleep(pause)
+
+
+    def _serve_udp(self, sock):
+        while True:
+            try:
+                wire, address = sock.recvfrom(65535)
+            except OSError:
+                return
+            if self.loss and random.random() < self.loss:
+                continue
+            try:
+                query = dns.message.from_wire(wire)
+            except dns.exception.DNSException:
+                continue
+
+            response = self.answer(query)
+            limit = max(query.payload, 512) if query.edns >= 0 else 512
+            if self.truncate or len(response.to_wire(max_size=65535)) > limit:
+                response.flags |= dns.flags.TC
+                response.answer, response.authority, response.additional = [], [], []
+            threading.Thread(target=self._reply_udp, args=(sock, response, address), daemon=True).start() \
+                if self.delay or self.jitter else self._reply_udp(sock, response, address)
+
+
+    def _reply_udp(self, sock, response, address):
+        self._wait()
+        try:
+            sock.sendto(response.to_wire(max_size=65535), address)
+        except OSError:
+            pass
+
+
+    def _serve_tcp(self, sock):
+        while True:
+            try:
+                connection, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+
+    def _serve_connection(self, connection):
+        lock = threading.Lock()
+        def reply(query):
+            self._wait()
+            wire = self.answer(query).to_wire()
+            with lock:
+                connection.sendall(struct.pack("!H", len(wire)) + wire)
+        try:
+            while True:
+                header = self._recv_exactly(connection, 2)
+                if header is None:
+                    return
+                wire = self._recv_exactly(connection, struct.unpack("!H", header)[0])
+                if wire is None:
+                    return
+                # Queries pipelined on one connection are answered concurrently, possibly out of order
+                threading.Thread(target=reply, args=(dns.message.from_wire(wire),), daemon=True).start()
+        except (OSError, dns.exception.DNSException):
+            pass
+        finally:
+            time.sleep(0.5)
+            connection.close()
+
+
+    def _recv_exactly(self, connection, n):
+        data = b""
+        while len(data) < n:
+            chunk = connection.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+    def start(self):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp.bind((self.ip, self.port))
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp.bind((self.ip, self.port))
+        tcp.listen(128)
+        self._sockets = [udp, tcp]
+        threading.Thread(target=self._serve_udp, args=(udp,), daemon=True).start()
+        threading.Thread(target=self._serve_tcp, args=(tcp,), daemon=True).start()
+
+
+    def stop(self):
+        for sock in self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class FakeHierarchy():
+    """
+    Stand-in DNS hierarchy on loopback addresses: a root server, one server per TLD and
+    'n_servers' authoritative servers sharing 'n_names' generated second-level zones.
+    Used by benchmark.py to measure the resolvers without the internet. Every server binds its own 127.0.0.x
+    address, on Linux the whole 127.0.0.0/8 range is routed to loopback.
+
+    @params:
+    - n_names: Number of second-level zones, named name0.<tld>., name1.<tld>., ... round robin over 'tlds'
+    - tlds: TLD labels delegated from the root
+    - dnssec: Sign every zone and publish DS records in the parents
+    - port: Port shared by all the servers, each server gets its own 127.0.0.x address
+    - delay, jitter, loss, truncate, no_edns: Network simulation of every server, see FakeNameserver
+    """
+
+    def __init__(self, n_names=100, tlds=("com", "org"), n_servers=2, dnssec=False, port=5300, delay=0.0, jitter=0.0,
+                 loss=0.0, truncate=False, first_ip=2, no_edns=False):
+        self.port = port
+        self.names = []
+        self.servers = []
+        ips = ("127.0.0.%d" % i for i in range(first_ip, 255))
+
+        root_ip = next(ips)
+        tld_ips = {tld: next(ips) for tld in tlds}
+        auth_ips = [next(ips) for _ in range(n_servers)]
+
+        root = ["$TTL 86400", ". IN SOA a.root-servers.net. hostmaster. 1 1800 900 604800 86400",
+                ". IN NS a.root-servers.net.", "a.root-servers.net. IN A " + root_ip]
+        tld_zones = {}
+        for tld in tlds:
+            root += [f"{tld}. IN NS ns.nic.{tld}.", f"ns.nic.{tld}. IN A {tld_ips[tld]}"]
+            tld_zones[tld] = ["$TTL 86400", f"{tld}. IN SOA ns.nic.{tld}. hostmaster. 1 1800 900 604800 3600",
+                              f"{tld}. IN NS ns.nic.{tld}.", f"ns.nic.{tld}. IN A {tld_ips[tld]}"]
+
+        auth_zones = [[] for _ in auth_ips]
+        for i in range(n_names):
+            tld = tlds[i % len(tlds)]
+            name = f"name{i}.{tld}."
+            ip = auth_ips[i % len(auth_ips)]
+            self.names += [name]
+            tld_zones[tld] += [f"{name} IN NS ns1.{name}", f"ns1.{name} IN A {ip}"]
+            auth_zones[i % len(auth_ips)] += [dns.zone.from_text("\n".join([
+                "$TTL 300", f"{name} IN SOA ns1.{name} hostmaster.{name} 1 1800 900 604800 60",
+                f"{name} IN NS ns1.{name}", f"ns1.{name} IN A {ip}",
+                f"{name} IN A 10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}", f"www.{name} IN A 10.255.{i // 256 % 256}.{i % 256}",
+                f"{name} IN MX 10 mail.{name}", f"mail.{name} IN A 10.254.{i // 256 % 256}.{i % 256}",
+            ]), name, relativize=False)]
+
+        root = dns.zone.from_text("\n".join(root), ".", relativize=False)
+        tld_zones = {tld: dns.zone.from_text("\n".join(lines), tld+".", relativize=False) for tld, lines in tld_zones.items()}
+
+        if dnssec:
+            self._sign(root, tld_zones.values(), [zone for zones in auth_zones for zone in zones])
+
+        options = dict(delay=delay, jitter=jitter, loss=loss, truncate=truncate, no_edns=no_edns)
+        self.servers += [FakeNameserver(root_ip, port, [root], **options)]
+        self.servers += [FakeNameserver(tld_ips[tld], port, [tld_zones[tld]], **options) for tld in tlds]
+        self.servers += [FakeNameserver(ip, port, zones, **options) for ip, zones in zip(auth_ips, auth_zones)]
+        self.root_servers = [root_ip]
+        self.root_zone = root
+
+
+    def _sign(self, root, tld_zones, auth_zones):
+        def sign(zone, parent):
+            ksk, zsk = ZoneKey(257), ZoneKey(256)
+            if parent is not None:
+                ds = dns.dnssec.make_ds(zone.origin, ksk.dnskey, "SHA256")
+                parent.find_rdataset(zone.origin, dns.rdatatype.DS, create=True).update(dns.rdataset.from_rdata_list(3600, [ds]))
+            return lambda: sign_zone(zone, ksk, zsk)
+
+        # Children publish their DS in the parent before the parent gets signed
+        signers = [sign(root, None)]
+        for tld_zone in tld_zones:
+            signers += [sign(tld_zone, root)]
+            for zone in auth_zones:
+                if zone.origin.parent() == tld_zone.origin:
+                    signers += [sign(zone, tld_zone)]
+        for signer in reversed(signers):
+            signer()
+
+
+    def queries(self):
+        return sum(server.queries for server in self.servers)
+
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+        return self
+
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,162 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds of the latency histogram buckets in seconds, one more bucket holds everything slower
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+# Name of the Prometheus label of the counters which have one, "label" for the others
+COUNTER_LABELS = {"rcode": "rcode", "cache": "result", "errors": "error", "server_queries": "transport",
+                  "server_responses": "rcode", "prefetch": "kind"}
+
+
+class LatencyHistogram():
+    """ Fixed-bucket latency histogram, it takes the same memory after one observation or a billion """
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+    def percentile(self, p):
+        """ Latency in seconds below which a fraction 'p' of the observations fall, interpolated inside the bucket """
+        if self.count == 0:
+            return None
+        rank = p * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lower = LATENCY_BUCKETS[index-1] if index > 0 else 0.0
+                return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+        return LATENCY_BUCKETS[-1]
+
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Metrics():
+    """
+    Thread-safe latency histograms and counters of the resolvers.
+
+    - observe() records the duration of a phase of the resolution (an upstream exchange, a hop down one zone level,
+      a DNSSEC fetch, ...) keyed by phase and zone level, and by phase and server ip when a server is given
+    - increment() counts events such as retries, timeouts, rcodes and cache hits
+    - Server ips beyond 'max_servers' are aggregated under "other", so memory stays bounded
+    - snapshot() returns everything as Python dictionaries, prometheus() in the Prometheus text format
+    """
+
+    def __init__(self, max_servers=1000, prefix="mydig") -> None:
+        self.max_servers = max_servers
+        self.prefix = prefix
+
+        self._phases = defaultdict(LatencyHistogram)
+        self._servers = defaultdict(LatencyHistogram)
+        self._server_ips = set()
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+
+    def observe(self, phase, seconds, level="", server=None):
+        """
+        @params:
+        - phase: What was timed. E.g: exchange, hop, tcp, nameserver_lookup, dnssec_fetch, dnssec_validate, resolve
+        - seconds: Duration, measured with a monotonic clock
+        - level: Zone level, 0 for the root, 1 for TLDs, ... or "" when it does not apply
+        - server: Ip address of the nameserver involved, if any
+        """
+        with self._lock:
+            self._phases[(phase, str(level))].observe(seconds)
+            if server is not None:
+                if server not in self._server_ips:
+                    if len(self._server_ips) >= self.max_servers:
+                        server = "other"
+                    else:
+                        self._server_ips.add(server)
+                self._servers[(phase, server)].observe(seconds)
+
+
+    def increment(self, name, label="", amount=1):
+        """ Add 'amount' to the counter 'name', E.g: increment("rcode", "NOERROR") """
+        with self._lock:
+            self._counters[(name, label)] += amount
+
+
+    def snapshot(self):
+        """ Python dictionary with the latency summaries (count, sum, p50, p90, p99 in seconds) and the counters """
+        with self._lock:
+            latency = defaultdict(dict)
+            for (phase, level), histogram in self._phases.items():
+                latency[phase][level] = histogram.summary()
+            server_latency = defaultdict(dict)
+            for (phase, server), histogram in self._servers.items():
+                server_latency[phase][server] = histogram.summary()
+            counters = defaultdict(dict)
+            for (name, label), value in self._counters.items():
+                counters[name][label] = value
+        return {"latency": dict(latency), "server_latency": dict(server_latency), "counters": dict(counters)}
+
+
+    def _histogram_lines(self, name, labels, histogram):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+            cumulative += count
+            lines += [f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}']
+        lines += [f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}']
+        lines += [f'{name}_sum{{{labels}}} {histogram.sum}', f'{name}_count{{{labels}}} {histogram.count}']
+        return lines
+
+
+    def prometheus(self):
+        """ All the metrics in the Prometheus text exposition format """
+        phase_name = f"{self.prefix}_latency_seconds"
+        server_name = f"{self.prefix}_server_latency_seconds"
+        with self._lock:
+            lines = [f"# HELP {phase_name} Duration of each phase of the resolution, by zone level",
+                     f"# TYPE {phase_name} histogram"]
+            for (phase, level), histogram in sorted(self._phases.items()):
+                lines += self._histogram_lines(phase_name, f'phase="{phase}",level="{level}"', histogram)
+
+            lines += [f"# HELP {server_name} Duration of each phase of the resolution, by nameserver",
+                      f"# TYPE {server_name} histogram"]
+            for (phase, server), histogram in sorted(self._servers.items()):
+                lines += self._histogram_lines(server_name, f'phase="{phase}",server="{server}"', histogram)
+
+            for name in sorted(set(name for name, _ in self._counters)):
+                counter_name = f"{self.prefix}_{name}_total"
+                label_name = COUNTER_LABELS.get(name, "label")
+                lines += [f"# TYPE {counter_name} counter"]
+                for (counter, label), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines += [f'{counter_name}{{{label_name}="{label}"}} {value}' if label else f"{counter_name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+            self._servers.clear()
+            self._server_ips.clear()
+            self._counters.clear()
+
+
+# Metrics shared by every resolver which is not given metrics of its own
+default_metrics = Metrics()
@@ -1,17 +1,233 @@
 from dnsresolver import *
 from dnssecresolver import *
 import argparse
+import asyncio
+import json
+import sys
+
+
+def _address(text, default_port):
+    host, _, port = text.rpartition(":")
+    return (host, int(port)) if host else (text, default_port)
+
+
+def _cache(cache_file, stale_window=0):
+    """ Persistent cache in 'cache_file', or None for the default in-memory cache """
+    if cache_file is None:
+        return DNSCache(stale_window=stale_window) if stale_window else None
+    from persistentcache import PersistentDNSCache
+    return PersistentDNSCache(cache_file, stale_window=stale_window)
+
+
+def _serve(argv):
+    from dnsserver import DNSServer
+
+    parser=argparse.ArgumentParser(prog="mydig.py serve", description="run a recursive DNS server")
+    parser.add_argument("--listen", type=str, default="127.0.0.1:5353")
+    parser.add_argument("--dnssec", action='store_true')
+    parser.add_argument("--max-concurrency", type=int, default=1000)
+    parser.add_argument("--race", action='store_true')
+    parser.add_argument("--log-level", choices=["off", "query", "hop"], default="query")
+    parser.add_argument("--metrics", type=str, default=None, help="host:port to serve Prometheus metrics on")
+    # Load testing hooks: point the resolver at a stand-in hierarchy instead of the real root servers
+    parser.add_argument("--root-servers", type=str, default=None, help="comma separated ip addresses")
+    parser.add_argument("--upstream-port", type=int, default=53)
+    parser.add_argument("--cache-file", type=str, default=None, help="sqlite file keeping the cache across runs")
+    parser.add_argument("--prefetch", action='store_true', help="refresh popular entries before they expire")
+    parser.add_argument("--prefetch-threshold", type=float, default=0.1, help="fraction of the TTL left when refreshing")
+    parser.add_argument("--prefetch-min-hits", type=int, default=3)
+    parser.add_argument("--prefetch-rate", type=float, default=20.0, help="refreshes per second at most")
+    parser.add_argument("--stale-window", type=float, default=0, help="seconds expired answers may be served stale")
+    parser.add_argument("--stale-deadline", type=float, default=None,
+                        help="seconds to wait for upstream before answering stale")
+    parser.add_argument("--edns-payload", type=int, default=1232, help="udp payload size advertised upstream")
+    parser.add_argument("--udp-sockets", type=int, default=0, help="share this many udp sockets between upstream queries")
+    parser.add_argument("--root-zone", type=str, default=None, help="root zone file answering the TLD referrals locally")
+    parser.add_argument("--root-zone-refresh", type=float, default=86400, help="seconds between reloads of --root-zone")
+    args = parser.parse_args(argv)
+
+    from asyncresolver import AsyncDNSResolver, AsyncDNSSECResolver
+    from prefetch import Prefetcher
+    from udptransport import UDPMultiplexer
+    cache = _cache(args.cache_file, args.stale_window)
+    prefetcher = Prefetcher(args.prefetch_threshold, args.prefetch_min_hits, args.prefetch_rate) if args.prefetch else None
+    resolver_class = AsyncDNSSECResolver if args.dnssec else AsyncDNSResolver
+    udp_transport = UDPMultiplexer(args.udp_sockets) if args.udp_sockets > 0 else None
+    root_zone = LocalRootZone(args.root_zone, args.root_zone_refresh).start() if args.root_zone else None
+    resolver = resolver_class(cache=cache, race=args.race, prefetcher=prefetcher, stale_deadline=args.stale_deadline,
+                              udp_transport=udp_transport, root_zone=root_zone)
+    resolver.port = args.upstream_port
+    resolver.edns_payload = args.edns_payload
+    resolver.logger.level = LEVELS[args.log_level]
+    if args.root_servers:
+        resolver.root_servers_ip = args.root_servers.split(",")
+
+    host, port = _address(args.listen, 53)
+    server = DNSServer(resolver, host, port, max_concurrency=args.max_concurrency)
+    print(f"Listening on {host}:{port} (UDP and TCP)")
+
+    async def run():
+        if args.metrics:
+            await server.start_metrics(*_address(args.metrics, 9153))
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    stats = {"metrics": resolver.metrics.snapshot()["counters"], "cache": dict(resolver.cache.stats)}
+    if prefetcher is not None:
+        prefetcher.close()
+        stats["prefetch"] = dict(prefetcher.stats)
+    if udp_transport is not None:
+        udp_transport.close()
+        stats["udp"] = dict(udp_transport.stats)
+    if root_zone is not None:
+        root_zone.close()
+        stats["root_zone"] = dict(root_zone.stats)
+    print(json.dumps(stats))
+
+
+def _loadtest(argv):
+    from dnsserver import load_test
+
+    parser=argparse.ArgumentParser(prog="mydig.py loadtest", description="measure the sustained QPS of a DNS server")
+    parser.add_argument("names", type=str, help="file with one domain name per line")
+    parser.add_argument("--target", type=str, default="127.0.0.1:5353")
+    parser.add_argument("--type", type=str, default="A")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--tcp", action='store_true')
+    args = parser.parse_args(argv)
+
+    with open(args.names) as fp:
+        names = [line.strip() for line in fp if line.strip()]
+
+    report = asyncio.run(load_test(_address(args.target, 53), names, args.type, args.duration, args.concurrency, tcp=args.tcp))
+    print(json.dumps(report))
+
+
+def _sharded(argv):
+    from sharding import ShardedResolver
+
+    parser=argparse.ArgumentParser(prog="mydig.py sharded", description="resolve a list of names on several cores")
+    parser.add_argument("names", type=str, help="file with one domain name per line")
+    parser.add_argument("--type", type=str, default="A")
+    parser.add_argument("--dnssec", action='store_true')
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, the number of cores by default")
+    parser.add_argument("--threads", type=int, default=32, help="lookups in flight in each worker")
+    parser.add_argument("--log-level", choices=["off", "query", "hop"], default="query")
+    parser.add_argument("--root-servers", type=str, default=None, help="comma separated ip addresses")
+    parser.add_argument("--upstream-port", type=int, default=53)
+    args = parser.parse_args(argv)
+
+    settings = {"port": args.upstream_port}
+    if args.root_servers:
+        settings["root_servers_ip"] = args.root_servers.split(",")
+
+    def queries():
+        with open(args.names) as fp:
+            for line in fp:
+                if line.strip():
+                    yield line.strip(), args.type
+
+    sharded = ShardedResolver(args.workers, "dnssec" if args.dnssec else "dns", threads=args.threads,
+                              log_level=LEVELS[args.log_level], settings=settings)
+    with sharded:
+        for hostname, type, reply, error in sharded.resolve_many(queries()):
+            print(reply if error is None else f"\n{hostname} {type}: {error.__class__.__name__}: {error}")
+    print(json.dumps(sharded.stats), file=sys.stderr)
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "serve":
+    _serve(sys.argv[2:])
+    sys.exit(0)
+
+if len(sys.argv) > 1 and sys.argv[1] == "loadtest":
+    _loadtest(sys.argv[2:])
+    sys.exit(0)
+
+if len(sys.argv) > 1 and sys.argv[1] == "sharded":
+    _sharded(sys.argv[2:])
+    sys.exit(0)
+
+def _bulk_queries(fp, default_type):
+    """ (hostname, type) tuples read lazily from the lines of 'fp', each line holds a name and optionally a type """
+    for line in fp:
+        fields = line.split()
+        if fields and not fields[0].startswith("#"):
+            yield fields[0], fields[1].upper() if len(fields) > 1 else default_type
+
+
+def _bulk_record(hostname, type, result, error):
+    """ JSON line for one outcome of resolve_many(..., structured=True) """
+    if error is None:
+        return json.dumps(result.as_dict())
+    status = {NXDomainError: "NXDOMAIN", NoDataError: "NODATA"}.get(error.__class__, "ERROR")
+    return json.dumps({"name": hostname, "type": type, "status": status,
+                       "error": f"{error.__class__.__name__}: {' '.join(str(error).split())}"})
+
+
+def _bulk(args):
+    """ Resolve the names of 'args.bulk' (a file, or - for stdin), printing each result as soon as it is known """
+    fp = sys.stdin if args.bulk == "-" else open(args.bulk)
+    queries = _bulk_queries(fp, args.type)
+
+    settings = {"port": args.upstream_port}
+    if args.root_servers:
+        settings["root_servers_ip"] = args.root_servers.split(",")
+
+    if args.workers:
+        from sharding import ShardedResolver
+        resolver = ShardedResolver(args.workers, "dnssec" if args.dnssec else "dns", threads=args.concurrency,
+                                   settings=settings)
+        resolver.start()
+        outcomes = resolver.resolve_many(queries, max_pending=4*args.workers*args.concurrency, structured=True)
+    else:
+        resolver = DNSSECResolver(cache=_cache(args.cache_file)) if args.dnssec else DNSResolver(cache=_cache(args.cache_file))
+        for name, value in settings.items():
+            setattr(resolver, name, value)
+        outcomes = resolver.resolve_many(queries, max_workers=args.concurrency, structured=True)
+
+    try:
+        for hostname, type, result, error in outcomes:
+            if args.format == "jsonl":
+                print(_bulk_record(hostname, type, result, error), flush=True)
+            else:
+                print(result.reply if error is None else f"{hostname} {type}: {error}\n", flush=True)
+    finally:
+        if args.workers:
+            resolver.close()
+        if fp is not sys.stdin:
+            fp.close()
+
 
 parser=argparse.ArgumentParser(description="add numbers")
-parser.add_argument("server", type=str)
-parser.add_argument("type", type=str)
+parser.add_argument("server", type=str, nargs="?")
+parser.add_argument("type", type=str, nargs="?")
 parser.add_argument("--dnssec", action='store_true')
+parser.add_argument("--cache-file", type=str, default=None)
+parser.add_argument("--bulk", type=str, default=None, help="file with one name (and optionally a type) per line, - for stdin")
+parser.add_argument("--type", type=str, default="A", dest="bulk_type", help="type of the names without one in --bulk")
+parser.add_argument("--concurrency", type=int, default=32, help="lookups in flight in --bulk mode")
+parser.add_argument("--format", choices=["dig", "jsonl"], default="dig", help="output of --bulk mode")
+parser.add_argument("--workers", type=int, default=0, help="resolve --bulk names in this many processes")
+parser.add_argument("--root-servers", type=str, default=None, help="comma separated ip addresses")
+parser.add_argument("--upstream-port", type=int, default=53)
 args = parser.parse_args()
 
+if args.bulk is not None:
+    args.type = args.bulk_type.upper()
+    _bulk(args)
+    sys.exit(0)
+
+if args.server is None or args.type is None:
+    parser.error("the following arguments are required: server, type")
+
 if args.dnssec:
-    resolver = DNSSECResolver()
+    resolver = DNSSECResolver(cache=_cache(args.cache_file))
 else:
-    resolver = DNSResolver()
+    resolver = DNSResolver(cache=_cache(args.cache_file))
 
 response = resolver.resolve(args.server, args.type)
-print(response)
\ No newline at end of file
+print(response)
@@ -0,0 +1,189 @@
+import base64
+import bisect
+import dns.dnssec
+import dns.name
+import dns.rdatatype
+import dns.rdtypes.ANY.NSEC3
+
+
+# NSEC3 records hashed with more iterations are not indexed, proving a name against them costs too much (RFC 9276)
+MAX_NSEC3_ITERATIONS = 100
+
+
+def _types(rdata):
+    """ Set of the record types in the type bitmap of an NSEC/NSEC3 record """
+    types = set()
+    for window, bitmap in rdata.windows:
+        for i, byte in enumerate(bitmap):
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    types.add(window * 256 + i * 8 + bit)
+    return types
+
+
+class ZoneDenials():
+    """
+    Validated NSEC and NSEC3 records of one zone, as sorted ranges (RFC 8198).
+
+    - NSEC ranges are kept in canonical name order, NSEC3 ranges in hash order, and the range holding a
+      name is found by bisection. Each range expires on its own, see add_nsec/add_nsec3
+    - deny() tells whether the ranges prove a name does not exist (NXDOMAIN, wildcard included), or has no
+      records of a type (NODATA), so that the query never goes upstream
+    - At most 'max_ranges' ranges of each kind are kept, the ones closest to expiry are dropped first
+    """
+
+    def __init__(self, zone, max_ranges=1000) -> None:
+        self.zone = dns.name.from_text(zone)
+        self.max_ranges = max_ranges
+        self.soa = None
+
+        # owner -> (next name, types, expires)
+        self._nsec = {}
+        self._nsec_owners = []
+
+        # hash -> (next hash, types, opt-out, expires), all hashed with 'self._nsec3_params'
+        self._nsec3 = {}
+        self._nsec3_hashes = []
+        self._nsec3_params = None
+
+
+    def _insert(self, ranges, keys, key, value):
+        if key not in ranges:
+            bisect.insort(keys, key)
+        ranges[key] = value
+        while len(keys) > self.max_ranges:
+            first = min(keys, key=lambda k: ranges[k][-1])
+            keys.remove(first)
+            del ranges[first]
+
+
+    def add_nsec(self, owner, rdata, expires):
+        """ NSEC record of 'owner' (dns.name.Name), validated and usable until 'expires' """
+        self._insert(self._nsec, self._nsec_owners, owner, (rdata.next, _types(rdata), expires))
+
+
+    def add_nsec3(self, owner, rdata, expires):
+        """ NSEC3 record of 'owner' (<hash>.<zone>), validated and usable until 'expires' """
+        if rdata.algorithm != dns.dnssec.NSEC3Hash.SHA1 or rdata.iterations > MAX_NSEC3_ITERATIONS:
+            return
+        params = (rdata.algorithm, rdata.iterations, rdata.salt)
+        if params != self._nsec3_params:
+            # The zone was signed again with other parameters, the old hashes are useless
+            self._nsec3, self._nsec3_hashes, self._nsec3_params = {}, [], params
+
+        owner_hash = owner.labels[0].decode().lower()
+        next_hash = base64.b32encode(rdata.next).decode().translate(dns.rdtypes.ANY.NSEC3.b32_normal_to_hex).lower()
+        optout = bool(rdata.flags & dns.rdtypes.ANY.NSEC3.OPTOUT)
+        self._insert(self._nsec3, self._nsec3_hashes, owner_hash, (next_hash, _types(rdata), optout, expires))
+
+
+    def _find(self, ranges, keys, key, now):
+        """
+        @returns:
+        - (owner, range): Range holding 'key', either starting at it or covering it. The last range wraps
+          around to the first key of the zone. (None, None) if there is no such range or it expired
+        """
+        i = bisect.bisect_right(keys, key) - 1
+        owner = keys[i] if keys else None
+        if owner is None:
+            return None, None
+        entry = ranges[owner]
+        if entry[-1] <= now:
+            return None, None
+        if owner == key:
+            return owner, entry
+
+        next_key = entry[0]
+        last = next_key <= owner
+        if (owner < key or (i == -1 and last)) and (key < next_key or last):
+            return owner, entry
+        return None, None
+
+
+    def _deny_nsec(self, name, rdtype, now):
+        owner, entry = self._find(self._nsec, self._nsec_owners, name, now)
+        if entry is None:
+            return None
+        next_name, types, _ = entry
+
+        # Names below a delegation point or a DNAME are not proven by the records of this zone
+        if name != owner and name.is_subdomain(owner) and \
+                (dns.rdatatype.DNAME in types or (dns.rdatatype.NS in types and dns.rdatatype.SOA not in types)):
+            return None
+
+        if owner == name:
+            if rdtype in types or dns.rdatatype.CNAME in types or \
+                    (dns.rdatatype.NS in types and dns.rdatatype.SOA not in types):
+                return None
+            return "NODATA", entry[-1]
+
+        # A name with descendants but no records of its own (empty non-terminal) exists
+        if next_name.is_subdomain(name):
+            return "NODATA", entry[-1]
+
+        # The closest encloser is the deepest ancestor shared with either end of the range, and the
+        # wildcard below it must not exist either
+        common = max(name.fullcompare(owner)[2], name.fullcompare(next_name)[2])
+        closest_encloser = name.split(common)[1]
+        wildcard = dns.name.from_text("*", closest_encloser)
+        wildcard_owner, wildcard_entry = self._find(self._nsec, self._nsec_owners, wildcard, now)
+        if wildcard_entry is None or wildcard_owner == wildcard:
+            return None
+        return "NXDOMAIN", min(entry[-1], wildcard_entry[-1])
+
+
+    def _hash(self, name):
+        algorithm, iterations, salt = self._nsec3_params
+        return dns.dnssec.nsec3_hash(name, salt, iterations, algorithm).lower()
+
+
+    def _deny_nsec3(self, name, rdtype, now):
+        if self._nsec3_params is None:
+            return None
+
+        owner, entry = self._find(self._nsec3, self._nsec3_hashes, self._hash(name), now)
+        if entry is not None and owner == self._hash(name):
+            _, types, _, expires = entry
+            if rdtype in types or dns.rdatatype.CNAME in types or \
+                    (dns.rdatatype.NS in types and dns.rdatatype.SOA not in types):
+                return None
+            return "NODATA", expires
+
+        # Closest encloser proof (RFC 5155 section 8.4): an ancestor which exists, the next closer name
+        # covered by a range without opt-out, and the wildcard below the closest encloser covered
+        next_closer = name
+        closest_encloser = name.parent()
+        while True:
+            owner, encloser_entry = self._find(self._nsec3, self._nsec3_hashes, self._hash(closest_encloser), now)
+            if encloser_entry is not None and owner == self._hash(closest_encloser):
+                _, types, _, _ = encloser_entry
+                if dns.rdatatype.DNAME in types or (dns.rdatatype.NS in types and dns.rdatatype.SOA not in types):
+                    return None
+                break
+            if closest_encloser == self.zone:
+                return None
+            next_closer, closest_encloser = closest_encloser, closest_encloser.parent()
+
+        owner, next_closer_entry = self._find(self._nsec3, self._nsec3_hashes, self._hash(next_closer), now)
+        if next_closer_entry is None or owner == self._hash(next_closer) or next_closer_entry[2]:
+            return None
+        wildcard = self._hash(dns.name.from_text("*", closest_encloser))
+        owner, wildcard_entry = self._find(self._nsec3, self._nsec3_hashes, wildcard, now)
+        if wildcard_entry is None or owner == wildcard:
+            return None
+        return "NXDOMAIN", min(encloser_entry[-1], next_closer_entry[-1], wildcard_entry[-1])
+
+
+    def deny(self, hostname, rdtype, now):
+        """
+        @params:
+        - hostname: Fully qualified domain name in the zone. E.g: nope.stonybrook.edu.
+        - rdtype: Dnspython record type of the query
+        - now: Current time of the cache clock
+
+        @returns:
+        - (negative, expires): "NXDOMAIN" or "NODATA" and the time the ranges of the proof expire, or None
+        """
+        name = dns.name.from_text(hostname)
+        return self._deny_nsec(name, rdtype, now) or self._deny_nsec3(name, rdtype, now)
+
@@ -48,8 +48,9 @@ exp1_timings = []
 for site in sites:
     total_query_time = 0
     for i in range(10):
-        response = resolver.resolve(site, "A")
-        query_time = int(re.findall(r'Query time: (.*?) msec', response)[0])
+        # Start every run cold, otherwise 9 out of 10 runs only measure a cache hit
+        resolver.cache = DNSCache()
+        query_time = resolver.resolve(site, "A", structured=True).elapsed_ms
         total_query_time += query_time
     avg_time = total_query_time/10 
     exp1_timings += [avg_time]
@@ -0,0 +1,221 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+from dnscache import *
+
+
+class PersistentDNSCache(DNSCache):
+    """
+    DNSCache backed by an sqlite file, so that a new process starts warm.
+
+    - Entries are kept in memory as in DNSCache. A miss in memory is looked up in the file, and entries
+      found there are loaded with their absolute expiry time, so they are never served past their TTL
+    - New entries are written to the file in batches by a background thread, every 'flush_every' entries or
+      'flush_interval' seconds, and when the cache is closed (also at exit). A lookup never waits for the file
+      lock, and entries learnt last are written even if the process stops learning new ones
+    - The file is in WAL mode, several processes can read and write it at the same time
+    - The clock is always time.time, expiry times stored in the file must mean the same thing in every process
+    - Expired entries stay in the file for the stale window, so that a new process can serve them stale as well
+    """
+
+    def __init__(self, path, max_entries=10000, flush_every=64, flush_interval=1.0, stale_window=0) -> None:
+        super().__init__(max_entries, clock=time.time, stale_window=stale_window)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        # Entries not written yet, and the ones being written by the current flush
+        self._pending = {}
+        self._flushing = {}
+        self._db_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._db = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (kind TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, "
+                         "ttl INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID")
+        self._db.execute("DELETE FROM entries WHERE expires <= ?", (self.clock() - self.stale_window,))
+        # Flushes write through their own connection, reads never wait for a write transaction
+        self._writer = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        atexit.register(self.close)
+
+
+    def _encode_key(self, name, key):
+        return " ".join(key) if name == "answer" else key
+
+
+    def _encode(self, name, entry):
+        """ Entry as JSON text, records are stored in their presentation format """
+        if name == "delegation":
+            return json.dumps([entry.nameservers, entry.glue])
+        if name == "address":
+            return json.dumps(entry.addresses)
+        if name == "answer":
+            soa = [entry.soa.name.to_text(), entry.soa[0].to_text()] if entry.soa is not None else None
+            return json.dumps({"records": [[record.rdtype, record.to_text()] for record in entry.records],
+                               "secure": entry.secure, "negative": entry.negative, "soa": soa})
+        return json.dumps([entry.keys.name.to_text(), [key.to_text() for key in entry.keys]])
+
+
+    def _decode(self, name, key, expires, ttl, data):
+        data = json.loads(data)
+        if name == "delegation":
+            return Delegation(key, data[0], data[1], ttl, expires)
+        if name == "address":
+            return NameserverAddresses(key, data, ttl, expires)
+        if name == "answer":
+            hostname, type = key
+            records = [dns.rdata.from_text(dns.rdataclass.IN, rdtype, text) for rdtype, text in data["records"]]
+            soa = None
+            if data["soa"] is not None:
+                soa = dns.rrset.from_text(data["soa"][0], ttl, dns.rdataclass.IN, dns.rdatatype.SOA, data["soa"][1])
+            return CachedAnswer(hostname, type, records, ttl, expires, data["secure"], data["negative"], soa)
+        keys = dns.rrset.from_text_list(dns.name.from_text(data[0]), ttl, dns.rdataclass.IN, dns.rdatatype.DNSKEY, data[1])
+        return TrustedKeys(key, keys, ttl, expires)
+
+
+    def _get(self, table, name, key):
+        entry = super()._get(table, name, key)
+        if entry is None:
+            # Entries kept in memory for the stale window are not loaded again
+            with self._lock:
+                if key in table:
+                    return None
+            entry = self._load(name, key)
+            if entry is not None:
+                self._insert(table, name, key, entry)
+                if entry.expires <= self.clock():
+                    entry = None
+        return entry
+
+
+    def _load(self, name, key):
+        """ Entry from the file if it is still valid or within the stale window, or None """
+        db_key = self._encode_key(name, key)
+        with self._db_lock:
+            row = self._pending.get((name, db_key), None) or self._flushing.get((name, db_key), None)
+            if row is None and self._db is not None:
+                row = self._db.execute("SELECT expires, ttl, data FROM entries WHERE kind = ? AND key = ?",
+                                       (name, db_key)).fetchone()
+
+        if row is None or row[0] + self.stale_window <= self.clock():
+            self.stats[name+"_disk_misses"] += 1
+            return None
+        self.stats[name+"_disk_hits"] += 1
+        return self._decode(name, key, *row)
+
+
+    def _put(self, table, name, key, entry):
+        super()._put(table, name, key, entry)
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._pending[(name, self._encode_key(name, key))] = (entry.expires, entry.ttl, self._encode(name, entry))
+            full = len(self._pending) >= self.flush_every
+            # Started on the first write rather than in __init__, so that a cache created before a fork works in the child
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name="cache-flush", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # The entries stay pending and are written by the next flush
+                self.stats["flush_failures"] += 1
+
+
+    def flush(self):
+        """ Write the pending entries to the file in one transaction """
+        with self._write_lock:
+            with self._db_lock:
+                if not self._pending or self._writer is None:
+                    return
+                self._flushing, self._pending = self._pending, {}
+
+            rows = [(name, key, expires, ttl, data) for (name, key), (expires, ttl, data) in self._flushing.items()]
+            try:
+                self._writer.execute("BEGIN IMMEDIATE")
+                self._writer.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+                self._writer.execute("COMMIT")
+            except sqlite3.Error:
+                if self._writer.in_transaction:
+                    self._writer.execute("ROLLBACK")
+                with self._db_lock:
+                    self._pending = {**self._flushing, **self._pending}
+                    self._flushing = {}
+                raise
+            with self._db_lock:
+                self._flushing = {}
+            self.stats["flushes"] += 1
+
+
+    def clear(self):
+        super().clear()
+        with self._write_lock, self._db_lock:
+            self._pending.clear()
+            if self._writer is not None:
+                self._writer.execute("DELETE FROM entries")
+
+
+    def close(self):
+        with self._db_lock:
+            if self._db is None:
+                return
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        with self._write_lock, self._db_lock:
+            self._db.close()
+            self._writer.close()
+            self._db, self._writer = None, None
+
+
+class SharedDNSCache(PersistentDNSCache):
+    """
+    PersistentDNSCache shared by several live processes, see ShardedResolver.
+
+    - Every entry is handed to the background flush as soon as it is learnt, not in batches
+    - A miss in memory, or an entry expired in memory, is looked up in the file, where another process may
+      have stored it (or a fresher copy of it) since. Delegations and answers learnt by one process are
+      therefore used by the others from their next lookup on
+    - The in-memory tables are a private LRU in front of the file, put the file on a memory-backed filesystem
+      (/dev/shm) so that reading it through costs no disk access
+    """
+
+    def __init__(self, path, max_entries=10000, stale_window=0) -> None:
+        super().__init__(path, max_entries, flush_every=1, stale_window=stale_window)
+
+
+    def _get(self, table, name, key):
+        entry = DNSCache._get(self, table, name, key)
+        if entry is not None:
+            return entry
+
+        loaded = self._load(name, key)
+        if loaded is None:
+            return None
+        with self._lock:
+            current = table.get(key, None)
+            if current is None or current.expires < loaded.expires:
+                self._insert(table, name, key, loaded)
+        return loaded if loaded.expires > self.clock() else None
@@ -0,0 +1,121 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import defaultdict
+
+
+class Prefetcher():
+    """
+    Refresh-ahead of popular cache entries.
+
+    - The cache counts the hits of every entry. Once an answer or a delegation has been hit 'min_hits' times
+      and less than 'threshold' of its TTL remains, the resolver re-resolves it in the background, so the
+      clients asking after it would have expired never pay for the iterative walk
+    - At most one refresh per entry is in flight, and refreshes are rate-limited by a token bucket of
+      'rate' refreshes per second and 'burst' tokens, so prefetch traffic never swamps the upstream servers
+    - Started, completed, failed and rate-limited refreshes are counted per kind of entry in 'stats'
+    """
+
+    def __init__(self, threshold=0.1, min_hits=3, rate=20.0, burst=50, max_workers=4) -> None:
+        self.threshold = threshold
+        self.min_hits = min_hits
+        self.rate = rate
+        self.burst = burst
+        self.stats = defaultdict(int)
+
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._pending = set()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+
+    def due(self, entry, now):
+        """
+        @params:
+        - entry: CachedAnswer or Delegation object just returned by the cache
+        - now: Current time of the cache clock
+
+        @returns:
+        - due: Whether the entry is popular enough and close enough to its expiry to be refreshed
+        """
+        return entry.hits >= self.min_hits and entry.ttl > 0 and entry.expires - now <= self.threshold * entry.ttl
+
+
+    def _acquire(self, key):
+        """ Reserve a refresh of 'key', unless one is already in flight or the rate limit is reached """
+        with self._lock:
+            if key in self._pending:
+                return False
+
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                self.stats[key[0]+"_rate_limited"] += 1
+                return False
+
+            self._tokens -= 1
+            self._pending.add(key)
+            self.stats[key[0]+"_started"] += 1
+            return True
+
+
+    def _release(self, key, failed):
+        with self._lock:
+            self._pending.discard(key)
+            self.stats[key[0]+("_failed" if failed else "_completed")] += 1
+
+
+    def _run(self, key, function):
+        try:
+            function()
+        except Exception:
+            self._release(key, True)
+        else:
+            self._release(key, False)
+
+
+    async def _run_async(self, key, coroutine_function):
+        try:
+            await coroutine_function()
+        except Exception:
+            self._release(key, True)
+        else:
+            self._release(key, False)
+
+
+    def submit(self, key, function):
+        """
+        @params:
+        - key: Identifies the entry, its first item is the kind of entry. E.g: ("answer", "amazon.com.", "A")
+        - function: Callable doing the refresh, run in a thread of the prefetcher
+
+        @returns:
+        - submitted: False if the refresh was skipped
+        """
+        if not self._acquire(key):
+            return False
+        self._executor.submit(self._run, key, function)
+        return True
+
+
+    def submit_async(self, key, coroutine_function):
+        """ submit() for asyncio resolvers, the refresh runs as a task of the running event loop """
+        if not self._acquire(key):
+            return False
+        task = asyncio.get_running_loop().create_task(self._run_async(key, coroutine_function))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
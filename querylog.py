@@ -0,0 +1,188 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Logging levels, every level records what the previous one does
+LOG_OFF = 0     # Nothing is recorded
+LOG_QUERY = 1   # One record per query: name, type, outcome and time taken
+LOG_HOP = 2     # Same record, with an event for every hop of the resolution
+
+LEVELS = {"off": LOG_OFF, "query": LOG_QUERY, "hop": LOG_HOP}
+
+
+class QueryContext():
+    """ Everything recorded about one query while it is being resolved """
+    __slots__ = ("hostname", "type", "start_time", "started", "elapsed", "cached", "hops", "events")
+
+    def __init__(self, hostname, type, hops):
+        self.hostname = hostname
+        self.type = type
+        # Wall clock time for the records, durations are measured with the monotonic clock
+        self.start_time = time.time()
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.cached = False
+        self.hops = []
+        # None when per-hop logging is off, see DNSResolver._log
+        self.events = [] if hops else None
+
+
+    def event(self, msg, args):
+        """ Events keep their arguments apart, the message is only formatted by the writer """
+        self.events.append((time.monotonic() - self.started, msg, args))
+
+
+class RotatingJSONLWriter():
+    """
+    Appends JSON Lines to 'path'. Once the file grows past 'max_bytes' it is renamed to
+    'path'.1 (shifting older files up to 'path'.'backups') and a new file is started.
+    """
+
+    def __init__(self, path, max_bytes=10*1024*1024, backups=5) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._fp = None
+
+
+    def _rotate(self):
+        self._fp.close()
+        self._fp = None
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index+1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+    def write(self, lines):
+        """ Write a batch of already serialized records """
+        if self._fp is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fp = open(self.path, "a")
+        self._fp.write("\n".join(lines) + "\n")
+        self._fp.flush()
+        if self._fp.tell() >= self.max_bytes:
+            self._rotate()
+
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class QueryLogger():
+    """
+    Buffered structured logging of the queries answered by the resolvers.
+
+    - A query only costs an append to a bounded in-memory ring buffer, when it is full the oldest records are dropped
+    - A background thread serializes the buffered records as JSON Lines and hands them to 'writer' in batches,
+      every 'flush_interval' seconds or as soon as 'batch_size' records are waiting
+    - 'level' can be changed at any time, LOG_QUERY keeps one record per query and turns per-hop logging into a no-op
+    - Any object with write(lines) and close() methods can replace the default RotatingJSONLWriter
+    """
+
+    def __init__(self, writer=None, level=LOG_HOP, buffer_size=10000, flush_interval=1.0, batch_size=512) -> None:
+        if writer is None:
+            writer = RotatingJSONLWriter(os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "queries.jsonl"))
+        self.writer = writer
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.stats = {"records": 0, "dropped": 0, "batches": 0}
+
+        self._buffer = deque(maxlen=buffer_size)
+        self._wake_up = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+
+    def begin(self, hostname, type):
+        """ Context of a new query. The resolver fills it in even when nothing is logged, it backs ResolutionResult """
+        return QueryContext(hostname, type, self.level >= LOG_HOP)
+
+
+    def end(self, context, **fields):
+        """
+        @params:
+        - context: QueryContext returned by begin(), or None
+        - fields: Outcome of the query, added to its record. E.g: records, ttl, error.
+          Values which are not JSON types are written as str(value) by the background thread
+        """
+        if context is None:
+            return
+        context.elapsed = time.monotonic() - context.started
+        if self.level <= LOG_OFF:
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.stats["dropped"] += 1
+        self._buffer.append((context, fields))
+
+        if self._thread is None:
+            self._start()
+        if len(self._buffer) >= self.batch_size:
+            self._wake_up.set()
+
+
+    def _start(self):
+        with self._write_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+                self._thread.start()
+
+
+    def _run(self):
+        while not self._closed:
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            self.flush()
+
+
+    def _record(self, context, fields):
+        record = {
+            "time": round(context.start_time, 6),
+            "name": context.hostname,
+            "type": context.type,
+            "cached": context.cached,
+            "elapsed_ms": round(context.elapsed * 1000, 3),
+            "hops": len(context.hops),
+        }
+        record.update(fields)
+        if context.events is not None:
+            record["events"] = [{"t_ms": round(offset * 1000, 3), "msg": msg % args if args else msg}
+                                for offset, msg, args in context.events]
+        return json.dumps(record, default=str)
+
+
+    def flush(self):
+        """ Write every buffered record now """
+        with self._write_lock:
+            lines = []
+            while self._buffer:
+                lines.append(self._record(*self._buffer.popleft()))
+            if lines:
+                self.writer.write(lines)
+                self.stats["records"] += len(lines)
+                self.stats["batches"] += 1
+
+
+    def close(self):
+        """ Stop the background writer, flushing the records still buffered """
+        self._closed = True
+        self._wake_up.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self.writer.close()
+
+
+# Logger shared by every resolver which is not given a logger of its own
+default_logger = QueryLogger()
+atexit.register(default_logger.close)
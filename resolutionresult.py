@@ -0,0 +1,94 @@
+import datetime
+
+
+class Hop():
+    """ One upstream query sent while resolving a name """
+    __slots__ = ("name", "zone", "server", "latency", "response")
+
+    def __init__(self, name, zone, server, latency, response):
+        self.name = name
+        self.zone = zone
+        self.server = server
+        self.latency = latency
+        self.response = response
+
+
+    def __repr__(self):
+        return f"Hop({self.name!r}, {self.zone!r}, {self.server!r}, {round(self.latency * 1000, 3)} msec)"
+
+
+class ResolutionResult():
+    """
+    Outcome of resolve(..., structured=True).
+
+    - records, ttl: Records of the answer and their TTL. E.g: [<10.0.0.1>], 300
+    - hops: Hop objects of the upstream queries, in the order they were sent. Lookups of nameservers which came
+      without glue appear as hops for their own name, their latency is part of the hop which needed them
+    - elapsed: Seconds taken by the whole resolution
+    - cached, secure: Whether the answer came from the cache, and went through a chain of trust
+    - stale: Whether the answer is an expired one, served because upstream resolution failed or was too slow
+    - The dig-style reply of resolve() is only built when 'reply' or str() is used
+    """
+    __slots__ = ("hostname", "type", "records", "ttl", "hops", "start_time", "elapsed", "cached", "secure", "stale")
+
+    def __init__(self, context, answer):
+        """
+        @params:
+        - context: QueryContext of the query, see DNSResolver._begin_query
+        - answer: CachedAnswer object returned by lookup()
+        """
+        self.hostname = context.hostname
+        self.type = context.type
+        self.records = answer.records
+        self.ttl = answer.ttl
+        self.hops = context.hops
+        self.start_time = context.start_time
+        self.elapsed = context.elapsed
+        self.cached = context.cached
+        self.secure = answer.secure
+        self.stale = answer.stale
+
+
+    @property
+    def elapsed_ms(self):
+        return int(round(self.elapsed * 1000))
+
+
+    @property
+    def wire_bytes(self):
+        """ Size in wire format of all the responses received upstream """
+        return sum(len(hop.response.to_wire()) for hop in self.hops)
+
+
+    @property
+    def msg_size(self):
+        """ Size in wire format of the response which carried the answer, 0 if it came from the cache """
+        return len(self.hops[-1].response.to_wire()) if self.hops and not self.cached else 0
+
+
+    @property
+    def reply(self):
+        records = "\n".join([record.to_text() for record in self.records])
+        response = str(records).rstrip("\n")
+
+        timestamp = datetime.datetime.fromtimestamp(self.start_time).strftime("%a %b %d %H:%M:%S %Y")
+
+        return f"QUESTION SECTION:\n{self.hostname}\t\tIN\t{self.type}\n\nANSWER SECTION:\n{response}\
+            \n\nQuery time: {self.elapsed_ms} msec\nWHEN: {timestamp}\n\nMSG SIZE rcvd: {self.msg_size}\n"
+
+
+    def as_dict(self):
+        """ Result as a JSON-serializable dict, see 'mydig.py --bulk --format jsonl' """
+        return {"name": self.hostname, "type": self.type, "status": "NOERROR",
+                "records": [record.to_text() for record in self.records], "ttl": self.ttl,
+                "elapsed_ms": self.elapsed_ms, "hops": len(self.hops), "cached": self.cached,
+                "secure": self.secure, "stale": self.stale}
+
+
+    def __str__(self):
+        return self.reply
+
+
+    def __repr__(self):
+        return f"ResolutionResult({self.hostname!r}, {self.type!r}, {[record.to_text() for record in self.records]}, " \
+            f"ttl={self.ttl}, hops={len(self.hops)}, {self.elapsed_ms} msec, cached={self.cached}, stale={self.stale})"
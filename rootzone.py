@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import defaultdict
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.zone
+from dnscache import *
+
+
+class LocalRootZone():
+    """
+    Local copy of the root zone (RFC 8806), so that the referral to a TLD never costs a query to a root server.
+
+    - 'source' is the path of a zone file (e.g. https://www.internic.net/domain/root.zone), a dns.zone.Zone object,
+      or a callable returning one, e.g. lambda: dns.zone.from_xfr(dns.query.xfr("192.0.47.132", "."))
+    - The zone is indexed by TLD: the NS names with their glue, and the DS RRSet with its signatures
+    - refresh() loads the source again and swaps the index if the SOA serial went up. start() does it every
+      'refresh_interval' seconds in a background thread. A copy older than the SOA expire timer of the zone is
+      no longer used, the resolver then asks the root servers again
+    - Names under a TLD missing from the copy are still sent to the root servers
+    """
+
+    def __init__(self, source, refresh_interval=86400) -> None:
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.stats = defaultdict(int)
+
+        self.serial = None
+        self._tlds = {}
+        self._keys = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.refresh()
+
+
+    def _load(self):
+        source = self.source() if callable(self.source) else self.source
+        if isinstance(source, dns.zone.Zone):
+            return source
+        return dns.zone.from_file(source, origin=".", relativize=False)
+
+
+    def _index(self, zone):
+        """ Python dictionary of (Delegation, DS RRSet, RRSig RRSet) tuples indexed by TLD. E.g: "com." """
+        tlds = {}
+        for name, node in zone.nodes.items():
+            name = name if name.is_absolute() else name.derelativize(zone.origin)
+            ns = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.NS)
+            if ns is None or name == dns.name.root:
+                continue
+
+            nameservers = [record.target.to_text().lower() for record in ns]
+            glue = {}
+            ttl = ns.ttl
+            for nameserver in nameservers:
+                addresses = zone.get_rdataset(nameserver, dns.rdatatype.A)
+                if addresses is not None:
+                    glue[nameserver] = [record.address for record in addresses]
+                    ttl = min(ttl, addresses.ttl)
+
+            zone_name = name.to_text().lower()
+            ds = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.DS)
+            rrsig = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.RRSIG, dns.rdatatype.DS)
+            tlds[zone_name] = (Delegation(zone_name, nameservers, glue, ttl), ds, rrsig)
+        return tlds
+
+
+    def refresh(self):
+        """ Load the source again, the copy in use is kept if loading fails or the serial did not go up """
+        try:
+            zone = self._load()
+            soa = zone.get_rdataset(dns.name.root, dns.rdatatype.SOA)[0]
+        except Exception:
+            self.stats["refresh_failures"] += 1
+            return False
+
+        with self._lock:
+            if self.serial is not None and soa.serial <= self.serial:
+                self._expires = time.time() + soa.expire
+                self.stats["refresh_unchanged"] += 1
+                return False
+
+        tlds = self._index(zone)
+        keys = zone.get_rdataset(dns.name.root, dns.rdatatype.DNSKEY)
+        keys_rrsig = zone.get_rdataset(dns.name.root, dns.rdatatype.RRSIG, dns.rdatatype.DNSKEY)
+        with self._lock:
+            self.serial = soa.serial
+            self._tlds = tlds
+            self._keys = (keys, keys_rrsig)
+            self._expires = time.time() + soa.expire
+        self.stats["refreshes"] += 1
+        return True
+
+
+    def usable(self):
+        return time.time() < self._expires
+
+
+    def referral(self, hostname):
+        """
+        @params:
+        - hostname: Fully qualified domain name with trailing dot. E.g: cs.stonybrook.edu.
+
+        @returns:
+        - delegation: Delegation of the TLD of 'hostname', as a root server would give it, or None
+        """
+        tld = hostname.rstrip(".").split(".")[-1].lower() + "."
+        with self._lock:
+            entry = self._tlds.get(tld, None) if self.usable() else None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["referrals"] += 1
+        delegation = entry[0]
+        return Delegation(delegation.zone, delegation.nameservers, delegation.glue, delegation.ttl, self._expires)
+
+
+    def response(self, zone_name, rdtype):
+        """
+        @params:
+        - zone_name: "." for the DNSKEY RRSet of the root, a TLD for its DS RRSet. E.g: com.
+        - rdtype: dns.rdatatype.DNSKEY or dns.rdatatype.DS
+
+        @returns:
+        - response: Response a root server would send to the DNSKEY/DS query with the DO bit, or None
+        """
+        with self._lock:
+            if not self.usable():
+                return None
+            if rdtype == dns.rdatatype.DNSKEY and zone_name == ".":
+                rdatasets = self._keys
+            elif rdtype == dns.rdatatype.DS and zone_name in self._tlds:
+                rdatasets = self._tlds[zone_name][1:]
+            else:
+                return None
+        if rdatasets is None or rdatasets[0] is None:
+            return None
+
+        name = dns.name.from_text(zone_name)
+        response = dns.message.make_response(dns.message.make_query(name, rdtype, want_dnssec=True))
+        for rdataset in rdatasets:
+            if rdataset is not None:
+                rrset = response.find_rrset(response.answer, name, dns.rdataclass.IN, rdataset.rdtype,
+                                            rdataset.covers, create=True)
+                rrset.update(rdataset)
+        self.stats["dnssec_responses"] += 1
+        return response
+
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+
+    def start(self):
+        """ Refresh the copy every 'refresh_interval' seconds in a background thread """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name="root-zone-refresh", daemon=True)
+            self._thread.start()
+        return self
+
+
+    def close(self):
+        self._stop.set()
@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from collections import defaultdict
+
+
+class ServerStats():
+    """ Smoothed round trip time, failure state and EDNS support of one nameserver ip """
+    __slots__ = ("srtt", "rttvar", "timeouts", "held_until", "edns")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.timeouts = 0
+        self.held_until = 0
+        self.edns = True
+
+
+class ServerSelector():
+    """
+    Thread-safe nameserver selection based on smoothed round trip times, in the spirit of
+    BIND and Unbound.
+
+    - Servers are ranked by their smoothed RTT, servers never measured are ranked as 'unknown_rtt'
+    - With probability 'explore' a random server is tried first, so that rankings stay fresh
+    - The retransmission timeout is srtt + 4 * rttvar (RFC 6298), at least 'min_timeout', doubled for every
+      consecutive timeout
+    - Servers which time out 'max_timeouts' times in a row, or answer lamely, are held down for
+      'holddown' seconds and only tried when nothing else is left
+    - Servers which rejected a query with EDNS are remembered, they are only sent plain queries afterwards
+    """
+
+    def __init__(self, unknown_rtt=0.376, min_timeout=0.2, max_timeout=5.0, explore=0.05, max_timeouts=3,
+                 holddown=60.0, clock=time.monotonic) -> None:
+        self.unknown_rtt = unknown_rtt
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.explore = explore
+        self.max_timeouts = max_timeouts
+        self.holddown = holddown
+        self.clock = clock
+
+        self._stats = {}
+        self._race_wins = defaultdict(int)
+        self._lock = threading.Lock()
+
+
+    def _get(self, ip):
+        stats = self._stats.get(ip, None)
+        if stats is None:
+            stats = self._stats[ip] = ServerStats()
+        return stats
+
+
+    def rank(self, ips):
+        """
+        @params:
+        - ips: Python list of ip addresses of the nameservers of one zone
+
+        @returns:
+        - ips: The same addresses, in the order they should be tried
+        """
+        now = self.clock()
+        with self._lock:
+            def key(ip):
+                stats = self._get(ip)
+                srtt = stats.srtt if stats.srtt is not None else self.unknown_rtt
+                return (stats.held_until > now, srtt)
+            ranked = sorted(ips, key=key)
+
+        if len(ranked) > 1 and random.random() < self.explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+
+        return ranked
+
+
+    def timeout(self, ip):
+        """ Retransmission timeout in seconds for the next query to 'ip' """
+        with self._lock:
+            stats = self._get(ip)
+            if stats.srtt is None:
+                rto = 2 * self.unknown_rtt
+            else:
+                rto = stats.srtt + 4 * stats.rttvar
+            # Clamped before backing off, otherwise a fast server's timeout stays at the floor for several timeouts
+            rto = max(rto, self.min_timeout) * 2 ** stats.timeouts
+        return min(rto, self.max_timeout)
+
+
+    def record_rtt(self, ip, rtt):
+        with self._lock:
+            stats = self._get(ip)
+            if stats.srtt is None:
+                stats.srtt = rtt
+                stats.rttvar = rtt / 2
+            else:
+                stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+                stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+            stats.timeouts = 0
+            stats.held_until = 0
+
+
+    def record_timeout(self, ip):
+        with self._lock:
+            stats = self._get(ip)
+            stats.timeouts += 1
+            if stats.timeouts >= self.max_timeouts:
+                stats.held_until = self.clock() + self.holddown
+
+
+    def record_lame(self, ip):
+        """ The server answered, but with SERVFAIL/REFUSED or an otherwise unusable response """
+        with self._lock:
+            self._get(ip).held_until = self.clock() + self.holddown
+
+
+    def record_no_edns(self, ip):
+        """ The server answered FORMERR or NOTIMP to a query with EDNS (RFC 6891) """
+        with self._lock:
+            self._get(ip).edns = False
+
+
+    def supports_edns(self, ip):
+        with self._lock:
+            stats = self._stats.get(ip, None)
+            return stats is None or stats.edns
+
+
+    def is_held_down(self, ip):
+        with self._lock:
+            return self._get(ip).held_until > self.clock()
+
+
+    def record_race(self, position):
+        """ A staggered race was won by the server ranked at 'position' (0 is the primary) """
+        with self._lock:
+            self._race_wins[position] += 1
+
+
+    def race_stats(self):
+        """ How often races were won by the primary and by the servers launched after the stagger """
+        with self._lock:
+            races = sum(self._race_wins.values())
+            return {
+                "races": races,
+                "won_by_primary": self._race_wins[0],
+                "won_by_other": races - self._race_wins[0],
+                "wins_by_position": dict(self._race_wins),
+            }
+
+
+    def snapshot(self):
+        """ Python dictionary of ip -> (srtt, rttvar, consecutive timeouts, held down) """
+        now = self.clock()
+        with self._lock:
+            return {ip: (stats.srtt, stats.rttvar, stats.timeouts, stats.held_until > now)
+                    for ip, stats in self._stats.items()}
+
+
+# Selector shared by every resolver which is not given a selector of its own
+default_selector = ServerSelector()
@@ -0,0 +1,232 @@
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import zlib
+from dnssecresolver import *
+from persistentcache import *
+
+
+# Second-level labels under which country code TLDs hand out names. E.g: co.uk, com.au, ne.jp
+PUBLIC_SECOND_LEVEL = {"ac", "co", "com", "edu", "go", "gob", "gov", "ltd", "mil", "ne", "net", "nic", "or", "org", "plc"}
+
+
+def registrable_zone(hostname):
+    """
+    @params:
+    - hostname: Domain name. E.g: www.bbc.co.uk.
+
+    @returns:
+    - zone: Zone the name was registered as, without trailing dot. E.g: bbc.co.uk
+    """
+    labels = hostname.rstrip(".").lower().split(".")
+    depth = 3 if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in PUBLIC_SECOND_LEVEL else 2
+    return ".".join(labels[-depth:])
+
+
+def shard_of(hostname, n_shards):
+    """
+    @params:
+    - hostname: Domain name. E.g: cs.stonybrook.edu.
+    - n_shards: Number of worker processes
+
+    @returns:
+    - shard: Index of the worker which resolves 'hostname'. Names are hashed by their registrable zone, so that
+      a zone is only ever walked by one worker, which keeps its delegations hot in its private LRU
+    """
+    return zlib.crc32(registrable_zone(hostname).encode()) % n_shards
+
+
+def _portable(error):
+    """ 'error' if it survives pickling, otherwise a RuntimeError with the same message """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{error.__class__.__name__}: {' '.join(str(error).split())}")
+
+
+def _worker(index, resolver_name, cache_path, settings, log_level, threads, requests, results):
+    """
+    Body of a worker process: resolve the (hostname, type) requests read from 'requests' with 'threads' lookups
+    in flight, and put (hostname, type, result, error) on 'results'. A None request stops the worker, which then
+    puts ("stats", index, counters, cache stats) on 'results'
+    """
+    logger = QueryLogger(RotatingJSONLWriter(os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs",
+                                                          f"queries.{index}.jsonl")), level=log_level)
+    cache = SharedDNSCache(cache_path)
+    resolver_class = DNSSECResolver if resolver_name == "dnssec" else DNSResolver
+    resolver = resolver_class(cache=cache, logger=logger, metrics=Metrics())
+    for name, value in settings.items():
+        setattr(resolver, name, value)
+
+    # Requests are handed to the pool as they arrive, a lookup never waits for the next request to be read.
+    # At most 2*threads of them are queued in the worker, the others wait in 'requests'
+    slots = threading.BoundedSemaphore(2*threads)
+
+    def reply(hostname, type):
+        def done(future):
+            error = future.exception()
+            results.put((hostname, type, None if error is not None else future.result(),
+                         None if error is None else _portable(error)))
+            slots.release()
+        return done
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        request = requests.get()
+        while request is not None:
+            slots.acquire()
+            hostname, type = request
+            executor.submit(resolver.resolve, hostname, type, True).add_done_callback(reply(hostname, type))
+            request = requests.get()
+
+    cache.close()
+    logger.close()
+    results.put(("stats", index, resolver.metrics.snapshot()["counters"], dict(cache.stats)))
+
+
+class ShardedResolver():
+    """
+    Resolver spread over 'n_workers' processes, so that parsing and DNSSEC crypto use several cores.
+
+    - Queries are routed to the workers by a hash of their zone, see shard_of
+    - The workers share one cache, a SharedDNSCache over an sqlite file in WAL mode on a memory-backed filesystem
+      (/dev/shm when it exists). Each worker keeps a private LRU in front of it, writes every entry it learns
+      through to the file and reads the file on a miss, so a delegation or an answer learnt by one worker is
+      reused by the others and adding workers does not multiply upstream traffic
+    - Each worker writes its query log to logs/queries.<worker>.jsonl
+    """
+
+    # Seconds between two checks that the workers are alive while waiting for results
+    poll_interval = 1.0
+
+    def __init__(self, n_workers=None, resolver_name="dns", cache_path=None, threads=32, log_level=LOG_QUERY,
+                 settings=None) -> None:
+        """
+        @params:
+        - n_workers: Number of worker processes, the number of cores by default
+        - resolver_name: "dns" or "dnssec"
+        - cache_path: sqlite file of the shared cache, a new file in shared memory by default
+        - threads: Lookups in flight in each worker
+        - settings: Resolver attributes set in every worker. E.g: {"port": 5300, "root_servers_ip": [...]}
+        """
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.resolver_name = resolver_name
+        self.threads = threads
+        self.log_level = log_level
+        self.settings = settings or {}
+        self.stats = {}
+
+        self._owns_cache = cache_path is None
+        if cache_path is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            descriptor, cache_path = tempfile.mkstemp(prefix="mydig-cache-", suffix=".db", dir=directory)
+            os.close(descriptor)
+        self.cache_path = cache_path
+
+        # Workers are forked where possible: spawning re-imports the main module, and mydig.py runs on import.
+        # The workers build all their components anew, nothing held by threads of the parent is used after the fork
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        self._workers = []
+        self._requests = []
+        self._results = None
+
+
+    def start(self):
+        # Create the table before the workers race to do it
+        SharedDNSCache(self.cache_path).close()
+
+        self._results = self._context.Queue()
+        for index in range(self.n_workers):
+            requests = self._context.Queue()
+            worker = self._context.Process(target=_worker, name=f"mydig-worker-{index}", daemon=True,
+                                           args=(index, self.resolver_name, self.cache_path, self.settings,
+                                                 self.log_level, self.threads, requests, self._results))
+            worker.start()
+            self._requests += [requests]
+            self._workers += [worker]
+
+
+    def resolve_many(self, queries, max_pending=10000, structured=False):
+        """
+        @params:
+        - queries: Iterable of (hostname, type) tuples, consumed lazily
+        - max_pending: Queries handed to the workers and not answered yet, at most
+        - structured: Yield ResolutionResult objects instead of formatted replies
+
+        @returns:
+        - Generator of (hostname, type, reply, error) tuples in completion order, as DNSResolver.resolve_many.
+          Errors which cannot be sent between processes come back as RuntimeError with the same message
+        """
+        if not self._workers:
+            self.start()
+
+        queries = iter(queries)
+        pending = 0
+        exhausted = False
+        while True:
+            while not exhausted and pending < max_pending:
+                try:
+                    hostname, type = next(queries)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self._requests[shard_of(hostname, self.n_workers)].put((hostname, type))
+                pending += 1
+
+            if pending == 0:
+                return
+
+            hostname, type, result, error = self._next_result()
+            pending -= 1
+            if result is not None and not structured:
+                result = "\n" + result.reply
+            yield hostname, type, result, error
+
+
+    def _next_result(self):
+        """ Next result of the workers, raises RuntimeError if one of them died instead of waiting forever """
+        while True:
+            try:
+                return self._results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+            for worker in self._workers:
+                if not worker.is_alive():
+                    raise RuntimeError(f"{worker.name} exited with code {worker.exitcode}")
+
+
+    def close(self):
+        """ Stop the workers, collect their counters in 'stats' and remove the shared cache if it was created here """
+        for requests in self._requests:
+            requests.put(None)
+        # Answers nobody consumed may still come before the counters
+        while len(self.stats) < len(self._workers):
+            try:
+                message = self._results.get(timeout=30)
+            except queue.Empty:
+                break
+            if message[0] == "stats":
+                _, index, counters, cache_stats = message
+                self.stats[index] = {"metrics": counters, "cache": cache_stats}
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._workers, self._requests = [], []
+
+        if self._owns_cache:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.cache_path + suffix):
+                    os.remove(self.cache_path + suffix)
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import threading
+
+# Keys of the flights led by the current task, see AsyncSingleFlight.do
+_led_flights = contextvars.ContextVar("led_flights", default=frozenset())
+
+
+class _Flight():
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """
+    Coalesces identical work running concurrently in several threads: the first caller
+    for a key (the leader) runs the function, later callers for the same key block until
+    it finishes and receive the same result, or the same exception.
+
+    A leader asking for its own key again (e.g. a glueless nameserver lookup below the zone
+    cut it is resolving) runs the function itself instead of waiting for itself forever.
+    """
+
+    def __init__(self) -> None:
+        self.stats = {"leaders": 0, "followers": 0, "reentries": 0}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    def do(self, key, fn):
+        led = getattr(self._local, "keys", frozenset())
+        if key in led:
+            self.stats["reentries"] += 1
+            return fn()
+
+        with self._lock:
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+
+        if not leader:
+            flight.done.wait()
+        else:
+            self._local.keys = led | {key}
+            try:
+                flight.result = fn()
+            except Exception as e:
+                flight.error = e
+            finally:
+                self._local.keys = led
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+class AsyncSingleFlight():
+    """
+    Coroutine version of SingleFlight, for tasks running on one event loop.
+
+    The work of a flight runs in a task of its own, which every caller awaits through a shield:
+    a cancelled caller, leader included, never cancels the work shared with the others
+    """
+
+    def __init__(self) -> None:
+        self.stats = {"leaders": 0, "followers": 0, "reentries": 0}
+        self._flights = {}
+
+
+    def _done(self, key, task):
+        if self._flights.get(key, None) is task:
+            del self._flights[key]
+        # Nobody may be waiting anymore, don't let asyncio report the exception as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+
+    async def do(self, key, coroutine_fn):
+        led = _led_flights.get()
+        if key in led:
+            self.stats["reentries"] += 1
+            return await coroutine_fn()
+
+        task = self._flights.get(key, None)
+        if task is not None:
+            self.stats["followers"] += 1
+        else:
+            self.stats["leaders"] += 1
+            # The task copies the current context, nested calls in it see the key as led
+            token = _led_flights.set(led | {key})
+            try:
+                task = self._flights[key] = asyncio.get_running_loop().create_task(coroutine_fn())
+            finally:
+                _led_flights.reset(token)
+            task.add_done_callback(lambda task: self._done(key, task))
+        return await asyncio.shield(task)
@@ -0,0 +1,223 @@
+import socket
+import struct
+import threading
+import time
+import dns.exception
+import dns.message
+import dns.query
+
+
+class TCPConnection():
+    """
+    Keep-alive TCP connection to one nameserver (RFC 7766). Several threads can have queries
+    outstanding on it at once: whichever thread is reading hands every response it receives to
+    the thread waiting for that message id, so responses may arrive in any order.
+    """
+
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.closed = False
+        self.last_used = time.monotonic()
+
+        self._send_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._waiting = set()
+        self._responses = {}
+        self._reading = False
+        self._buffer = b""
+
+
+    def outstanding(self):
+        with self._condition:
+            return len(self._waiting)
+
+
+    def can_send(self, message_id):
+        with self._condition:
+            return not self.closed and message_id not in self._waiting
+
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+    def _read_frames(self, timeout):
+        """ Read from the socket once and file every complete response under its message id """
+        self.sock.settimeout(max(timeout, 0.001))
+        data = self.sock.recv(65535)
+        if not data:
+            raise EOFError
+
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            (length,) = struct.unpack("!H", self._buffer[:2])
+            if len(self._buffer) < 2 + length:
+                break
+            wire = self._buffer[2:2+length]
+            self._buffer = self._buffer[2+length:]
+            if len(wire) >= 2:
+                self._responses[struct.unpack("!H", wire[:2])[0]] = wire
+
+
+    def exchange(self, query, timeout):
+        """
+        @params:
+        - query: Dnspython dns.message object
+        - timeout: Seconds to wait for the response
+
+        @returns:
+        - wire: Response to 'query', matched by message id
+        """
+        with self._condition:
+            self._waiting.add(query.id)
+        try:
+            wire = query.to_wire()
+            with self._send_lock:
+                self.sock.settimeout(timeout)
+                self.sock.sendall(struct.pack("!H", len(wire)) + wire)
+            self.last_used = time.monotonic()
+
+            deadline = time.monotonic() + timeout
+            with self._condition:
+                while query.id not in self._responses:
+                    remaining = deadline - time.monotonic()
+                    if self.closed:
+                        raise EOFError
+                    if remaining <= 0:
+                        raise dns.exception.Timeout(timeout=timeout)
+
+                    if self._reading:
+                        self._condition.wait(remaining)
+                        continue
+
+                    # Nobody is reading, read on behalf of every thread waiting on this connection
+                    self._reading = True
+                    self._condition.release()
+                    try:
+                        self._read_frames(remaining)
+                    except socket.timeout:
+                        pass
+                    except (OSError, EOFError):
+                        self.closed = True
+                        raise
+                    finally:
+                        self._condition.acquire()
+                        self._reading = False
+                        self._condition.notify_all()
+
+                self.last_used = time.monotonic()
+                return self._responses.pop(query.id)
+        finally:
+            with self._condition:
+                self._waiting.discard(query.id)
+                self._responses.pop(query.id, None)
+
+
+class TCPConnectionPool():
+    """
+    Thread-safe pool of keep-alive TCP connections, keyed by nameserver (ip, port).
+
+    - Queries to a server are pipelined on its open connections, up to 'max_pipelined' outstanding each
+    - Connections idle for 'idle_timeout' seconds, or closed by the server, are evicted
+    - 'stats' counts the connections opened, reused and evicted
+    """
+
+    def __init__(self, idle_timeout=10.0, max_pipelined=16, connect_timeout=2.0) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_pipelined = max_pipelined
+        self.connect_timeout = connect_timeout
+        self.stats = {"opened": 0, "reused": 0, "evicted": 0}
+
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+
+    def _evict(self, connection):
+        # Called with the pool lock held
+        connections = self._connections.get(connection.server, [])
+        if connection in connections:
+            connections.remove(connection)
+            self.stats["evicted"] += 1
+        connection.close()
+
+
+    def _sweep(self):
+        """ Evict idle and closed connections, at most once per second """
+        now = time.monotonic()
+        if now - self._last_sweep < 1.0:
+            return
+        self._last_sweep = now
+        for connections in list(self._connections.values()):
+            for connection in list(connections):
+                if connection.closed or (connection.outstanding() == 0 and now - connection.last_used > self.idle_timeout):
+                    self._evict(connection)
+
+
+    def _acquire(self, server, message_id):
+        with self._lock:
+            self._sweep()
+            connections = self._connections.setdefault(server, [])
+            usable = [connection for connection in connections
+                      if connection.can_send(message_id) and connection.outstanding() < self.max_pipelined]
+            if usable:
+                self.stats["reused"] += 1
+                return min(usable, key=lambda connection: connection.outstanding()), True
+
+        sock = socket.create_connection(server, timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = TCPConnection(sock, server)
+        with self._lock:
+            self._connections.setdefault(server, []).append(connection)
+            self.stats["opened"] += 1
+        return connection, False
+
+
+    def query(self, query, where, port=53, timeout=5.0):
+        """
+        @params:
+        - query: Dnspython dns.message object
+        - where: Ip address of the nameserver
+        - port, timeout: As for dns.query.tcp
+
+        @function:
+        - Send 'query' on a pooled connection to the server, opening one if none can take it
+        - A reused connection may have been closed by the server in the meantime,
+          in which case the query is sent once more on a new connection
+
+        @returns:
+        - response: Dnspython dns.message object
+        """
+        for attempt in range(2):
+            connection, reused = self._acquire((where, port), query.id)
+            try:
+                wire = connection.exchange(query, timeout)
+                break
+            except (OSError, EOFError):
+                with self._lock:
+                    self._evict(connection)
+                if not reused or attempt == 1:
+                    raise
+
+        response = dns.message.from_wire(wire)
+        if not query.is_response(response):
+            raise dns.query.BadResponse
+        return response
+
+
+    def close(self):
+        with self._lock:
+            for connections in list(self._connections.values()):
+                for connection in list(connections):
+                    self._evict(connection)
+
+
+# Pool shared by every resolver which is not given a pool of its own
+default_tcp_pool = TCPConnectionPool()
@@ -0,0 +1,93 @@
+import asyncio
+import itertools
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import _make_resolver
+from fakehierarchy import *
+from asyncresolver import *
+
+
+# Every test gets servers on a port of its own, sockets of a previous test never answer its queries
+_ports = itertools.count(5400)
+
+
+class FakeClock():
+    """ Clock of a DNSCache which only moves when told to """
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def resolve(resolver, hostname, type):
+    """ resolve() of sync and async resolvers alike, returns the ResolutionResult """
+    if isinstance(resolver, AsyncDNSResolver):
+        return asyncio.run(asyncio.wait_for(resolver.resolve(hostname, type, structured=True), 30))
+    return resolver.resolve(hostname, type, structured=True)
+
+
+def make_resolver(resolver_class, hierarchy, race=False, cache=None, root_zone=None):
+    """ Resolver of 'resolver_class' pointed at 'hierarchy', with short timeouts so that failures are quick """
+    resolver = _make_resolver(resolver_class, hierarchy, race)
+    resolver.selector = ServerSelector(unknown_rtt=0.1, max_timeout=0.5, explore=0)
+    if cache is not None:
+        resolver.cache = cache
+    resolver.root_zone = root_zone
+    return resolver
+
+
+def zone(origin, lines):
+    return dns.zone.from_text("\n".join(["$TTL 300"] + lines), origin, relativize=False)
+
+
+@pytest.fixture
+def port():
+    return next(_ports)
+
+
+@pytest.fixture
+def hierarchy(port):
+    """ Factory of started FakeHierarchy objects, stopped after the test """
+    started = []
+
+    def start(**options):
+        started.append(FakeHierarchy(port=port, **options).start())
+        return started[-1]
+
+    yield start
+    for fake in started:
+        fake.stop()
+
+
+@pytest.fixture
+def nameservers(port):
+    """ Factory of started FakeNameserver objects on the port of the test, stopped after the test """
+    started = []
+
+    class Hierarchy():
+        def __init__(self, root_servers):
+            self.port = port
+            self.root_servers = root_servers
+            self.servers = started
+
+        def queries(self):
+            return sum(server.queries for server in started)
+
+    def start(servers, root_servers):
+        for ip, zones in servers:
+            started.append(FakeNameserver(ip, port, zones))
+            started[-1].start()
+        return Hierarchy(root_servers)
+
+    yield start
+    for server in started:
+        server.stop()
@@ -0,0 +1,61 @@
+from conftest import *
+
+
+def answer(hostname, ttl):
+    return CachedAnswer(hostname, "A", [dns.rdata.from_text("IN", "A", "10.0.0.1")], ttl)
+
+
+def test_entries_expire_with_their_ttl():
+    clock = FakeClock()
+    cache = DNSCache(clock=clock)
+    cache.add_answer(answer("a.com.", 10))
+
+    clock.advance(9)
+    assert cache.get_answer("a.com.", "A") is not None
+    clock.advance(1)
+    assert cache.get_answer("a.com.", "A") is None
+    assert cache.stats["answer_expirations"] == 1
+
+
+def test_expired_answers_are_kept_for_the_stale_window():
+    clock = FakeClock()
+    cache = DNSCache(clock=clock, stale_window=60)
+    cache.add_answer(answer("a.com.", 10))
+
+    clock.advance(30)
+    assert cache.get_answer("a.com.", "A") is None
+    assert cache.get_stale_answer("a.com.", "A") is not None
+    clock.advance(40)
+    assert cache.get_stale_answer("a.com.", "A") is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = DNSCache(max_entries=2)
+    cache.add_answer(answer("a.com.", 300))
+    cache.add_answer(answer("b.com.", 300))
+    cache.get_answer("a.com.", "A")
+    cache.add_answer(answer("c.com.", 300))
+
+    assert cache.get_answer("b.com.", "A") is None
+    assert cache.get_answer("a.com.", "A") is not None
+    assert cache.stats["answer_evictions"] == 1
+
+
+def test_delegation_chain_skips_labels_which_are_not_zone_cuts():
+    cache = DNSCache()
+    cache.add_delegation(Delegation("jp.", ["a.dns.jp."], {}, 300))
+    cache.add_delegation(Delegation("example.co.jp.", ["ns.example.co.jp."], {}, 300))
+
+    chain = cache.delegation_chain("host.example.co.jp.")
+    assert [delegation.zone for delegation in chain] == ["jp.", "example.co.jp."]
+
+
+def test_delegation_chain_skips_expired_levels():
+    clock = FakeClock()
+    cache = DNSCache(clock=clock)
+    cache.add_delegation(Delegation("com.", ["a.gtld-servers.net."], {}, 10))
+    cache.add_delegation(Delegation("example.com.", ["ns.example.com."], {}, 300))
+
+    clock.advance(10)
+    chain = cache.delegation_chain("www.example.com.")
+    assert [delegation.zone for delegation in chain] == ["example.com."]
@@ -0,0 +1,53 @@
+import pytest
+from conftest import *
+
+
+RESOLVERS = [DNSSECResolver, AsyncDNSSECResolver]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_signed_answers_are_secure(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, dnssec=True)
+    resolver = make_resolver(resolver_class, fake)
+
+    result = resolve(resolver, "name1.org", "A")
+    assert result.secure
+    assert [record.to_text() for record in result.records] == ["10.0.0.1"]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_validated_negative_answers_are_cached(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, dnssec=True)
+    resolver = make_resolver(resolver_class, fake)
+
+    with pytest.raises(NoDataError):
+        resolve(resolver, "mail.name0.com", "MX")
+    queries = fake.queries()
+    with pytest.raises(NoDataError):
+        resolve(resolver, "mail.name0.com", "MX")
+    assert fake.queries() == queries
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_nsec_ranges_deny_other_names_without_queries(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, dnssec=True)
+    resolver = make_resolver(resolver_class, fake)
+
+    # nope.name0.com. falls between mail.name0.com. and ns1.name0.com., so does nope2.name0.com.
+    with pytest.raises(NXDomainError):
+        resolve(resolver, "nope.name0.com", "A")
+    queries = fake.queries()
+    with pytest.raises(NXDomainError):
+        resolve(resolver, "nope2.name0.com", "A")
+    assert fake.queries() == queries
+    assert resolver.cache.stats["denial_hits"] == 1
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_local_root_zone_serves_the_root_keys(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, dnssec=True)
+    root_zone = LocalRootZone(fake.root_zone)
+    resolver = make_resolver(resolver_class, fake, root_zone=root_zone)
+
+    assert resolve(resolver, "name0.com", "A").secure
+    assert fake.servers[0].queries == 0
@@ -0,0 +1,150 @@
+import threading
+import pytest
+from conftest import *
+
+
+RESOLVERS = [DNSResolver, AsyncDNSResolver]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+@pytest.mark.parametrize("race", [False, True])
+def test_answers_are_cached(hierarchy, resolver_class, race):
+    fake = hierarchy(n_names=4)
+    resolver = make_resolver(resolver_class, fake, race)
+
+    result = resolve(resolver, "name1.org", "A")
+    assert [record.to_text() for record in result.records] == ["10.0.0.1"]
+    assert not result.cached
+
+    queries = fake.queries()
+    assert resolve(resolver, "name1.org", "A").cached
+    assert fake.queries() == queries
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_expired_answers_are_resolved_again(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4)
+    clock = FakeClock()
+    resolver = make_resolver(resolver_class, fake, cache=DNSCache(clock=clock))
+    resolve(resolver, "name0.com", "A")
+
+    clock.advance(299)
+    queries = fake.queries()
+    assert resolve(resolver, "name0.com", "A").cached
+
+    # The answer expired, the delegations of the TLD and of the zone did not: only the zone is asked again
+    clock.advance(1)
+    assert not resolve(resolver, "name0.com", "A").cached
+    assert fake.queries() == queries + 1
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_negative_answers_are_cached(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4)
+    resolver = make_resolver(resolver_class, fake)
+
+    with pytest.raises(NXDomainError):
+        resolve(resolver, "nope.name0.com", "A")
+    with pytest.raises(NoDataError):
+        resolve(resolver, "mail.name0.com", "MX")
+
+    queries = fake.queries()
+    with pytest.raises(NXDomainError):
+        resolve(resolver, "nope.name0.com", "A")
+    with pytest.raises(NoDataError):
+        resolve(resolver, "mail.name0.com", "MX")
+    assert fake.queries() == queries
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_truncated_responses_are_fetched_over_tcp(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, truncate=True)
+    resolver = make_resolver(resolver_class, fake)
+
+    result = resolve(resolver, "name2.com", "A")
+    assert [record.to_text() for record in result.records] == ["10.0.0.2"]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_servers_rejecting_edns_are_asked_without_it(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4, no_edns=True)
+    resolver = make_resolver(resolver_class, fake)
+
+    result = resolve(resolver, "name2.com", "A")
+    assert [record.to_text() for record in result.records] == ["10.0.0.2"]
+    assert not resolver.selector.supports_edns(fake.root_servers[0])
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_stale_answers_are_served_when_upstream_fails(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4)
+    clock = FakeClock()
+    resolver = make_resolver(resolver_class, fake, cache=DNSCache(clock=clock, stale_window=3600))
+    resolve(resolver, "name0.com", "A")
+
+    clock.advance(600)
+    fake.stop()
+    result = resolve(resolver, "name0.com", "A")
+    assert result.stale
+    assert [record.to_text() for record in result.records] == ["10.0.0.0"]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_race_retransmits_to_a_server_which_timed_out(hierarchy, resolver_class):
+    fake = hierarchy(n_names=1, tlds=("com",), n_servers=1)
+    resolver = make_resolver(resolver_class, fake, race=True)
+    resolve(resolver, "name0.com", "NS")
+
+    # The only server of the zone drops the first query, the retransmission gets through
+    authoritative = fake.servers[-1]
+    authoritative.loss = 1.0
+    threading.Timer(0.1, lambda: setattr(authoritative, "loss", 0.0)).start()
+    result = resolve(resolver, "name0.com", "A")
+    assert [record.to_text() for record in result.records] == ["10.0.0.0"]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_local_root_zone_replaces_the_root_servers(hierarchy, resolver_class):
+    fake = hierarchy(n_names=4)
+    root_zone = LocalRootZone(fake.root_zone)
+    resolver = make_resolver(resolver_class, fake, root_zone=root_zone)
+
+    resolve(resolver, "name0.com", "A")
+    resolve(resolver, "name1.org", "A")
+    assert fake.servers[0].queries == 0
+    assert root_zone.stats["referrals"] == 2
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_zones_below_labels_which_are_not_zone_cuts(nameservers, resolver_class):
+    # example.co.jp. is delegated by jp. directly, co.jp. is not a zone of its own
+    root = zone(".", [". IN SOA a. h. 1 1 1 1 60", ". IN NS a.", "a. IN A 127.0.0.40",
+                      "jp. IN NS ns.jp.", "ns.jp. IN A 127.0.0.41"])
+    jp = zone("jp.", ["jp. IN SOA ns.jp. h. 1 1 1 1 60", "jp. IN NS ns.jp.", "ns.jp. IN A 127.0.0.41",
+                      "example.co.jp. IN NS ns.example.co.jp.", "ns.example.co.jp. IN A 127.0.0.42"])
+    example = zone("example.co.jp.", ["example.co.jp. IN SOA ns.example.co.jp. h. 1 1 1 1 60",
+                                      "example.co.jp. IN NS ns.example.co.jp.", "ns.example.co.jp. IN A 127.0.0.42",
+                                      "a.example.co.jp. IN A 10.0.0.1", "b.example.co.jp. IN A 10.0.0.2"])
+    fake = nameservers([("127.0.0.40", [root]), ("127.0.0.41", [jp]), ("127.0.0.42", [example])], ["127.0.0.40"])
+    resolver = make_resolver(resolver_class, fake)
+    resolve(resolver, "a.example.co.jp", "A")
+
+    queries = [server.queries for server in fake.servers]
+    result = resolve(resolver, "b.example.co.jp", "A")
+    assert [record.to_text() for record in result.records] == ["10.0.0.2"]
+    assert [server.queries for server in fake.servers] == [queries[0], queries[1], queries[2] + 1]
+
+
+@pytest.mark.parametrize("resolver_class", RESOLVERS)
+def test_glueless_nameserver_inside_its_own_zone_fails_instead_of_hanging(nameservers, resolver_class):
+    # name0.com. is served by ns.sub.name0.com., whose address can only be found by asking name0.com.
+    root = zone(".", [". IN SOA a. h. 1 1 1 1 60", ". IN NS a.", "a. IN A 127.0.0.40",
+                      "com. IN NS ns.com.", "ns.com. IN A 127.0.0.41"])
+    com = zone("com.", ["com. IN SOA ns.com. h. 1 1 1 1 60", "com. IN NS ns.com.", "ns.com. IN A 127.0.0.41",
+                        "name0.com. IN NS ns.sub.name0.com."])
+    fake = nameservers([("127.0.0.40", [root]), ("127.0.0.41", [com])], ["127.0.0.40"])
+    resolver = make_resolver(resolver_class, fake)
+
+    with pytest.raises(ResolutionError):
+        resolve(resolver, "a.sub.name0.com", "A")
+    assert resolver.inflight.stats["reentries"] >= 1
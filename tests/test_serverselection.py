@@ -0,0 +1,42 @@
+import pytest
+from conftest import *
+
+
+def test_timeout_is_clamped_before_backing_off():
+    selector = ServerSelector(min_timeout=0.2, max_timeout=5.0, max_timeouts=10)
+    selector.record_rtt("10.0.0.1", 0.001)
+
+    timeouts = []
+    for _ in range(5):
+        timeouts += [selector.timeout("10.0.0.1")]
+        selector.record_timeout("10.0.0.1")
+    assert timeouts == pytest.approx([0.2, 0.4, 0.8, 1.6, 3.2])
+
+
+def test_timeout_is_capped_by_max_timeout():
+    selector = ServerSelector(min_timeout=0.2, max_timeout=1.0, max_timeouts=10)
+    for _ in range(6):
+        selector.record_timeout("10.0.0.1")
+    assert selector.timeout("10.0.0.1") == 1.0
+
+
+def test_a_response_resets_the_backoff():
+    selector = ServerSelector(min_timeout=0.2, max_timeouts=10)
+    selector.record_rtt("10.0.0.1", 0.05)
+    selector.record_timeout("10.0.0.1")
+    selector.record_timeout("10.0.0.1")
+    selector.record_rtt("10.0.0.1", 0.05)
+    assert selector.timeout("10.0.0.1") == pytest.approx(0.2)
+
+
+def test_held_down_servers_are_ranked_last():
+    clock = FakeClock()
+    selector = ServerSelector(max_timeouts=2, holddown=60, explore=0, clock=clock)
+    selector.record_rtt("10.0.0.1", 0.01)
+    selector.record_rtt("10.0.0.2", 0.1)
+    selector.record_timeout("10.0.0.1")
+    selector.record_timeout("10.0.0.1")
+
+    assert selector.rank(["10.0.0.1", "10.0.0.2"]) == ["10.0.0.2", "10.0.0.1"]
+    clock.advance(60)
+    assert selector.rank(["10.0.0.1", "10.0.0.2"]) == ["10.0.0.1", "10.0.0.2"]
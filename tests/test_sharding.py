@@ -0,0 +1,31 @@
+import pickle
+import pytest
+from conftest import *
+from sharding import *
+from sharding import _portable
+
+
+def test_names_are_sharded_by_registrable_zone():
+    assert registrable_zone("www.bbc.co.uk.") == "bbc.co.uk"
+    assert registrable_zone("a.b.example.com") == "example.com"
+    assert shard_of("x.google.co.jp", 8) == shard_of("y.google.co.jp", 8)
+
+
+@pytest.mark.parametrize("error", [ResolutionError("name0.com.", ["127.0.0.5"]), NXDomainError("nope.name0.com."),
+                                   NoDataError("mail.name0.com.", "MX"), KSKVerificationError("name0.com.")])
+def test_errors_are_sent_between_processes_intact(error):
+    received = pickle.loads(pickle.dumps(_portable(error)))
+    assert type(received) is type(error)
+    assert str(received) == str(error)
+
+
+def test_sharded_resolver(hierarchy):
+    fake = hierarchy(n_names=8)
+    settings = {"port": fake.port, "root_servers_ip": fake.root_servers}
+    with ShardedResolver(2, settings=settings, threads=4, log_level=LOG_OFF) as resolver:
+        queries = [(name, "A") for name in fake.names] + [("nope.name0.com.", "A")]
+        results = {hostname: error for hostname, _, _, error in resolver.resolve_many(queries)}
+
+    assert len(results) == len(queries)
+    assert all(results[name] is None for name in fake.names)
+    assert isinstance(results["nope.name0.com."], NXDomainError)
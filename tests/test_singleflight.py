@@ -0,0 +1,115 @@
+import threading
+import time
+import pytest
+from conftest import *
+
+
+def test_concurrent_calls_share_one_flight():
+    flights = SingleFlight()
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return 42
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", work))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [42] * 8
+    assert len(calls) == 1
+    assert flights.stats["leaders"] == 1 and flights.stats["followers"] == 7
+
+
+def test_followers_receive_the_error_of_the_leader():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def work():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("upstream failed")
+
+    errors = []
+
+    def follow():
+        started.wait()
+        try:
+            flights.do("key", work)
+        except ValueError as e:
+            errors.append(e)
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    with pytest.raises(ValueError):
+        flights.do("key", work)
+    follower.join()
+    assert len(errors) == 1
+
+
+def test_a_leader_asking_for_its_own_key_does_not_deadlock():
+    flights = SingleFlight()
+    depth = []
+
+    def work():
+        depth.append(1)
+        return flights.do("key", work) if len(depth) < 3 else "done"
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(flights.do("key", work)), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert result == ["done"]
+    assert flights.stats["reentries"] == 2
+
+
+def test_async_calls_share_one_flight():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 42
+
+    async def main():
+        return await asyncio.gather(*[flights.do("key", work) for _ in range(8)])
+
+    assert asyncio.run(main()) == [42] * 8
+    assert len(calls) == 1
+
+
+def test_a_cancelled_async_leader_does_not_cancel_its_followers():
+    flights = AsyncSingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.1)
+        return 42
+
+    async def main():
+        leader = asyncio.create_task(flights.do("key", work))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flights.do("key", work))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        result = await follower
+        return leader.cancelled(), result
+
+    assert asyncio.run(main()) == (True, 42)
+    assert flights._flights == {}
+
+
+def test_an_async_leader_asking_for_its_own_key_does_not_deadlock():
+    flights = AsyncSingleFlight()
+    depth = []
+
+    async def work():
+        depth.append(1)
+        return await flights.do("key", work) if len(depth) < 3 else "done"
+
+    assert asyncio.run(asyncio.wait_for(flights.do("key", work), 5)) == "done"
+    assert flights.stats["reentries"] == 2
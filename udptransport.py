@@ -0,0 +1,182 @@
+import asyncio
+import concurrent.futures
+import random
+import selectors
+import socket
+import struct
+import threading
+from collections import defaultdict
+import dns.exception
+import dns.flags
+import dns.message
+
+
+class UDPMultiplexer():
+    """
+    Upstream UDP transport sharing a few long-lived sockets between all the queries in flight.
+
+    - 'n_sockets' non-blocking sockets are bound to random source ports the first time a query is sent,
+      and each query goes out on one of them at random. No socket is created or closed per query
+    - A single receiver thread reads the responses and hands each one to the query it answers, matched by
+      socket, server address, server port and message id, then by question section. Anything else, late
+      answers to abandoned queries as well as spoofed ones, is dropped and counted in 'stats'
+    - Thread-safe. query() blocks the calling thread, query_async() awaits on the caller's event loop
+    """
+
+    def __init__(self, n_sockets=4, min_port=1024, max_port=65535) -> None:
+        self.n_sockets = n_sockets
+        self.min_port = min_port
+        self.max_port = max_port
+        self.stats = defaultdict(int)
+
+        self._sockets = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+
+    def _bind(self):
+        """ Non-blocking socket bound to a random source port, retried until a free port is found """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(100):
+            try:
+                sock.bind(("", random.randint(self.min_port, self.max_port)))
+                break
+            except OSError:
+                continue
+        else:
+            sock.bind(("", 0))
+        sock.setblocking(False)
+        return sock
+
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self._closed:
+                raise OSError("UDP transport is closed")
+            self._sockets = [self._bind() for _ in range(self.n_sockets)]
+            self._thread = threading.Thread(target=self._receive_loop, name="udp-receiver", daemon=True)
+            self._thread.start()
+
+
+    def submit(self, query, server_ip, port=53):
+        """
+        @params:
+        - query: Dnspython dns.message object
+        - server_ip, port: Address of the nameserver
+
+        @function:
+        - Send 'query' from one of the shared sockets. If another query to the same server with the same message id
+          is in flight, a new id is drawn for this one
+
+        @returns:
+        - future: concurrent.futures.Future resolved with the response. Cancelling it abandons the query
+        """
+        self._start()
+        wire = query.to_wire()
+        sock = random.choice(self._sockets)
+        future = concurrent.futures.Future()
+
+        with self._lock:
+            message_id = query.id
+            while (sock.fileno(), server_ip, port, message_id) in self._pending:
+                message_id = random.randint(0, 65535)
+            key = (sock.fileno(), server_ip, port, message_id)
+            self._pending[key] = (future, query.question)
+        if message_id != query.id:
+            wire = struct.pack("!H", message_id) + wire[2:]
+        future.add_done_callback(lambda _: self._forget(key, future))
+
+        try:
+            sock.sendto(wire, (server_ip, port))
+        except OSError as e:
+            future.set_exception(e)
+            return future
+        self.stats["sent"] += 1
+        return future
+
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key, (None,))[0] is future:
+                del self._pending[key]
+
+
+    def query(self, query, server_ip, port=53, timeout=None):
+        """ Blocking exchange, raises dns.exception.Timeout if no response arrives within 'timeout' seconds """
+        future = self.submit(query, server_ip, port)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.stats["timeouts"] += 1
+            raise dns.exception.Timeout(timeout=timeout)
+
+
+    async def query_async(self, query, server_ip, port=53, timeout=None):
+        """ Coroutine version of query(), the event loop is never blocked """
+        future = self.submit(query, server_ip, port)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            self.stats["timeouts"] += 1
+            raise dns.exception.Timeout(timeout=timeout)
+
+
+    def _receive_loop(self):
+        events = selectors.DefaultSelector()
+        for sock in self._sockets:
+            events.register(sock, selectors.EVENT_READ)
+
+        while not self._closed:
+            for key, _ in events.select(0.5):
+                try:
+                    wire, (server_ip, port) = key.fileobj.recvfrom(65535)
+                except OSError:
+                    continue
+                self._dispatch(key.fileobj.fileno(), server_ip, port, wire)
+        events.close()
+
+
+    def _dispatch(self, fileno, server_ip, port, wire):
+        """ Resolve the future of the query answered by 'wire', or drop it """
+        if len(wire) < 12:
+            self.stats["malformed"] += 1
+            return
+
+        with self._lock:
+            pending = self._pending.get((fileno, server_ip, port, struct.unpack("!H", wire[:2])[0]), None)
+        if pending is None:
+            self.stats["unmatched"] += 1
+            return
+
+        future, question = pending
+        try:
+            response = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            self.stats["malformed"] += 1
+            return
+        if not response.flags & dns.flags.QR or response.question != question:
+            self.stats["unmatched"] += 1
+            return
+
+        self.stats["received"] += 1
+        try:
+            future.set_result(response)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []